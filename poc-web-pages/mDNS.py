@@ -1,25 +1,78 @@
+import argparse
+import json
+import selectors
 import socket
 import struct
+import sys
+import time
+
+MCAST_GRP = '224.0.0.251'
+MCAST_PORT = 5353
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+RESOURCE_RECORD = struct.Struct("!HHIH")
+SRV = struct.Struct("!HHH")
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_AAAA = 28
+TYPE_SRV = 33
+# A name has at most 127 labels, following more compression pointers than that means they loop
+MAX_POINTER_JUMPS = 127
+MAX_NAME_LENGTH = 255
+
+# Capture mode (--capture)
+# Datagrams read per wakeup before checking the stats timer
+BATCH_SIZE = 256
+# mDNS packets can be up to 9000 bytes (RFC 6762, section 17)
+MAX_PACKET_BYTES = 9000
+# Kernel receive buffer, so bursts from many browsers are queued instead of dropped
+RCVBUF_BYTES = 4 * 2 ** 20
+# Seconds between the packets/s and drops reports (and flushes of the sink)
+STATS_INTERVAL = 5
+SINK_BUFFER_BYTES = 2 ** 20
+# Linux socket option to get the kernel's count of datagrams dropped on this socket with every read
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40) if sys.platform.startswith("linux") else None
 
 def decode_name(data, offset):
+    """
+    Decode a possibly compressed name from data (bytes or memoryview) at offset, without recursion.
+    Raises ValueError on compression pointer loops and names that are too long or run past the end of the packet.
+    Returns the name and the offset after it.
+    """
     labels = []
+    name_length = 0
+    jumps = 0
+    end = None
     while True:
+        if offset >= len(data):
+            raise ValueError("name runs past the end of the packet")
         length = data[offset]
         if length == 0:
             offset += 1
             break
         # Handle name compression
         elif length & 0xC0 == 0xC0:
-            pointer = struct.unpack("!H", data[offset:offset+2])[0] & 0x3FFF
-            label, _ = decode_name(data, pointer)
-            labels.append(label)
-            offset += 2
-            break
+            if offset + 1 >= len(data):
+                raise ValueError("name runs past the end of the packet")
+            jumps += 1
+            if jumps > MAX_POINTER_JUMPS:
+                raise ValueError("compression pointer loop")
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length & 0xC0:
+            raise ValueError(f"unsupported label type {length:#x}")
         else:
             offset += 1
-            labels.append(data[offset:offset+length].decode())
+            if offset + length > len(data):
+                raise ValueError("name runs past the end of the packet")
+            name_length += length + 1
+            if name_length > MAX_NAME_LENGTH:
+                raise ValueError("name too long")
+            labels.append(str(data[offset:offset+length], "utf-8", "replace"))
             offset += length
-    return ".".join(labels), offset
+    return ".".join(labels), end if end is not None else offset
 
 def parse_dns(data):
     transaction_id = data[0:2]
@@ -52,20 +105,70 @@ def parse_dns(data):
             ip6 = ":".join([rdata[i:i+2].hex() for i in range(0, 16, 2)])
             print(f"📦 Response: {name} has AAAA record {ip6}")
         elif atype == 12:  # PTR
-            ptr_name, _ = decode_name(rdata, 0)
+            # Compression pointers in the data are offsets in the whole packet
+            ptr_name, _ = decode_name(data, offset - rdlength)
             print(f"📦 Response: {name} is PTR to {ptr_name}")
         else:
             print(f"📦 Response: {name} Type {atype} (not decoded)")
 
-def listen_mdns():
-    MCAST_GRP = '224.0.0.251'
-    MCAST_PORT = 5353
+def decode_rdata(data, rtype, offset, length):
+    """
+    Decode the data of an A, AAAA, PTR or SRV record at offset in the packet.
+    Returns the address, the name or "priority weight port target" for SRV, None for other types.
+    """
+    if rtype == TYPE_A and length == 4:
+        return socket.inet_ntop(socket.AF_INET, data[offset:offset+4])
+    if rtype == TYPE_AAAA and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, data[offset:offset+16])
+    if rtype == TYPE_PTR:
+        return decode_name(data, offset)[0]
+    if rtype == TYPE_SRV and length > SRV.size:
+        priority, weight, port = SRV.unpack_from(data, offset)
+        return f"{priority} {weight} {port} {decode_name(data, offset + SRV.size)[0]}"
+    return None
 
+def parse_mdns(data):
+    """
+    Parse an mDNS packet (bytes or memoryview, e.g. of a reused receive buffer) without copying it.
+    Raises ValueError or struct.error on malformed packets.
+    Returns a dict with the id, the flags, the questions (name, type, class) and the records of every section
+    (section, name, type, class, ttl, data, see decode_rdata).
+    """
+    transaction_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data, 0)
+    offset = HEADER.size
+    questions = []
+    for _ in range(qdcount):
+        name, offset = decode_name(data, offset)
+        qtype, qclass = QUESTION.unpack_from(data, offset)
+        offset += QUESTION.size
+        questions.append({"name": name, "type": qtype, "class": qclass})
+
+    records = []
+    for section, count in (("answer", ancount), ("authority", nscount), ("additional", arcount)):
+        for _ in range(count):
+            name, offset = decode_name(data, offset)
+            rtype, rclass, ttl, rdlength = RESOURCE_RECORD.unpack_from(data, offset)
+            offset += RESOURCE_RECORD.size
+            if offset + rdlength > len(data):
+                raise ValueError("record data runs past the end of the packet")
+            records.append({"section": section, "name": name, "type": rtype, "class": rclass, "ttl": ttl,
+                            "data": decode_rdata(data, rtype, offset, rdlength)})
+            offset += rdlength
+    return {"id": transaction_id, "flags": flags, "questions": questions, "records": records}
+
+def open_mdns_socket(rcvbuf_bytes=RCVBUF_BYTES, blocking=True):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if rcvbuf_bytes:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf_bytes)
     sock.bind(('', MCAST_PORT))
     mreq = struct.pack("=4sl", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(blocking)
+    return sock
+
+def listen_mdns():
+    sock = open_mdns_socket(rcvbuf_bytes=None)
 
     print("🔎 Listening for mDNS queries and responses...")
 
@@ -77,5 +180,125 @@ def listen_mdns():
         except Exception as e:
             print(f"❌ Failed to parse packet: {e}")
 
+class JsonlSink:
+    """
+    Buffered JSON lines sink for the capture records, stdout for "-".
+    """
+    def __init__(self, path, buffer_bytes=SINK_BUFFER_BYTES):
+        self.file = sys.stdout if path == "-" else open(path, "a", buffering=buffer_bytes, encoding="utf-8")
+        self.encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    def write(self, record):
+        self.file.write(self.encode(record) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class CaptureStats:
+    """
+    Packet, error and drop counters of a capture, reported as rates since the last report.
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.parse_errors = 0
+        self.truncated = 0
+        # Cumulative count of the kernel (SO_RXQ_OVFL), None if the platform does not report it
+        self.dropped = None
+        self.started = self.reported = time.monotonic()
+        self.reported_packets = 0
+
+    def report(self, final=False):
+        now = time.monotonic()
+        since = self.started if final else self.reported
+        packets = self.packets if final else self.packets - self.reported_packets
+        rate = packets / max(now - since, 1e-9)
+        dropped = "unknown" if self.dropped is None else self.dropped
+        print(f"📊 {rate:.0f} packets/s, {self.packets} packets ({self.bytes / 2 ** 20:.1f} MB), {dropped} dropped, "
+              f"{self.parse_errors} unparsable, {self.truncated} truncated", file=sys.stderr, flush=True)
+        self.reported = now
+        self.reported_packets = self.packets
+
+def receive_batch(sock, view, batch_size, stats):
+    """
+    Read up to batch_size datagrams from a non-blocking socket into the buffer behind view, one at a time.
+    Yields (payload view, address) for every datagram, only valid until the next one is read.
+    """
+    for _ in range(batch_size):
+        try:
+            if SO_RXQ_OVFL is not None:
+                nbytes, ancdata, msg_flags, address = sock.recvmsg_into([view], 64)
+                for level, kind, value in ancdata:
+                    if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                        stats.dropped = struct.unpack("=I", value[:4])[0]
+                if msg_flags & socket.MSG_TRUNC:
+                    stats.truncated += 1
+            else:
+                nbytes, address = sock.recvfrom_into(view)
+        except (BlockingIOError, InterruptedError):
+            return
+        stats.packets += 1
+        stats.bytes += nbytes
+        yield view[:nbytes], address
+
+def capture_mdns(output_path="-", batch_size=BATCH_SIZE, stats_interval=STATS_INTERVAL, rcvbuf_bytes=RCVBUF_BYTES, duration=None):
+    """
+    Capture mDNS packets until interrupted (or for duration seconds) and write one JSON record per packet to output_path:
+    the receive time, the source address and port and the parse_mdns fields.
+    Reports the packets/s and the drops on stderr every stats_interval seconds.
+    """
+    sock = open_mdns_socket(rcvbuf_bytes, blocking=False)
+    stats = CaptureStats()
+    if SO_RXQ_OVFL is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            # The kernel only adds the counter to reads once it is not 0
+            stats.dropped = 0
+        except OSError:
+            pass
+    sink = JsonlSink(output_path)
+    view = memoryview(bytearray(MAX_PACKET_BYTES))
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    deadline = time.monotonic() + duration if duration else None
+    print(f"🔎 Capturing mDNS packets to {output_path}...", file=sys.stderr)
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            selector.select(stats_interval)
+            for payload, address in receive_batch(sock, view, batch_size, stats):
+                try:
+                    packet = parse_mdns(payload)
+                except (ValueError, struct.error):
+                    stats.parse_errors += 1
+                    continue
+                record = {"time": time.time(), "source": address[0], "port": address[1]}
+                record.update(packet)
+                sink.write(record)
+            if time.monotonic() - stats.reported >= stats_interval:
+                sink.flush()
+                stats.report()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.close()
+        selector.close()
+        sock.close()
+        stats.report(final=True)
+
 if __name__ == "__main__":
-    listen_mdns()
+    parser = argparse.ArgumentParser(description="Print mDNS queries and responses, or capture them as JSON lines with --capture")
+    parser.add_argument("--capture", metavar="PATH", help="write one JSON record per packet to PATH (- for stdout)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="datagrams read per wakeup")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL, help="seconds between packets/s and drops reports")
+    parser.add_argument("--rcvbuf", type=int, default=RCVBUF_BYTES, help="socket receive buffer in bytes")
+    parser.add_argument("--duration", type=float, help="stop capturing after this many seconds")
+    args = parser.parse_args()
+    if args.capture:
+        capture_mdns(args.capture, args.batch, args.stats_interval, args.rcvbuf, args.duration)
+    else:
+        listen_mdns()
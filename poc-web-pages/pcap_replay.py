@@ -0,0 +1,330 @@
+import argparse
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+from mDNS import MCAST_PORT, JsonlSink, parse_mdns
+from webRTC import extract_ufrag
+from webRTC_turn import parse_username
+
+# Replays pcap and pcapng captures through the parsers of mDNS.py, webRTC.py and webRTC_turn.py, without a network:
+#   python pcap_replay.py capture.pcapng --mdns mdns.jsonl --stun stun.jsonl
+# Without outputs, only the throughput of the parsers is reported.
+
+PCAP_MAGIC = {
+    # magic as read little-endian -> (byte order, timestamp units per second)
+    0xA1B2C3D4: ("<", 10 ** 6),
+    0xD4C3B2A1: (">", 10 ** 6),
+    0xA1B23C4D: ("<", 10 ** 9),
+    0x4D3CB2A1: (">", 10 ** 9),
+}
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_IF_TSRESOL = 9
+# Bytes of the fixed fields of a block body, shorter blocks are skipped
+PCAPNG_MIN_BODY = {PCAPNG_INTERFACE_DESCRIPTION: 8, PCAPNG_PACKET: 20, PCAPNG_SIMPLE_PACKET: 4, PCAPNG_ENHANCED_PACKET: 20}
+# Bytes of the smallest capture, the pcap file header (a pcapng section header is longer)
+MIN_CAPTURE_SIZE = 24
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+# Raw IP on some BSDs
+LINKTYPE_RAW_BSD = (12, 14)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+IPPROTO_UDP = 17
+# IPv6 extension headers skipped on the way to UDP, a fragment header (44) ends the search
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+
+UDP_HEADER = struct.Struct("!HHHH")
+STUN_MAGIC_COOKIE = b'\x21\x12\xa4\x42'
+
+def pcap_packets(data, stats):
+    """
+    Yield (timestamp, link type, packet view) for every packet of a pcap file (the bytes or mmap in data).
+    """
+    if len(data) < MIN_CAPTURE_SIZE:
+        stats["truncated_packets"] += 1
+        return
+    byte_order, units = PCAP_MAGIC[struct.unpack_from("<I", data, 0)[0]]
+    linktype = struct.unpack_from(byte_order + "I", data, 20)[0] & 0x0FFFFFFF
+    record_header = struct.Struct(byte_order + "IIII")
+    view = memoryview(data)
+    offset = 24
+    while offset + record_header.size <= len(data):
+        seconds, fraction, captured_length, _original_length = record_header.unpack_from(data, offset)
+        offset += record_header.size
+        if offset + captured_length > len(data):
+            stats["truncated_packets"] += 1
+            return
+        yield seconds + fraction / units, linktype, view[offset:offset + captured_length]
+        offset += captured_length
+
+def interface_resolution(options, byte_order):
+    """
+    Timestamp units per second of a pcapng interface from the if_tsresol option in its options view, microseconds by default.
+    """
+    option_header = struct.Struct(byte_order + "HH")
+    offset = 0
+    while offset + option_header.size <= len(options):
+        code, length = option_header.unpack_from(options, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_IF_TSRESOL and length >= 1 and offset + option_header.size < len(options):
+            value = options[offset + 4]
+            return 2 ** (value & 0x7F) if value & 0x80 else 10 ** value
+        offset += option_header.size + (length + 3) // 4 * 4
+    return 10 ** 6
+
+def pcapng_packets(data, stats):
+    """
+    Yield (timestamp, link type, packet view) for every packet of a pcapng file (the bytes or mmap in data),
+    from the enhanced, simple and obsolete packet blocks of every section and interface.
+    """
+    view = memoryview(data)
+    byte_order = "<"
+    interfaces = []
+    offset = 0
+    while offset + 12 <= len(data):
+        block_type = struct.unpack_from(byte_order + "I", data, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # The byte order magic tells the byte order of the whole section, including this block's length
+            byte_order = "<" if struct.unpack_from("<I", data, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            interfaces = []
+        block_length = struct.unpack_from(byte_order + "I", data, offset + 4)[0]
+        if block_length < 12 or offset + block_length > len(data):
+            stats["truncated_packets"] += 1
+            return
+        body = offset + 8
+        end = offset + block_length - 4
+        if end - body < PCAPNG_MIN_BODY.get(block_type, 0):
+            stats["parse_errors"] += 1
+        elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack_from(byte_order + "H", data, body)[0]
+            interfaces.append((linktype, interface_resolution(view[body + 8:end], byte_order)))
+        elif block_type == PCAPNG_ENHANCED_PACKET or block_type == PCAPNG_PACKET:
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured_length, _original_length = struct.unpack_from(byte_order + "IIIII", data, body)
+            else:
+                interface, _drops, high, low, captured_length, _original_length = struct.unpack_from(byte_order + "HHIIII", data, body)
+            packet = body + 20
+            # A packet of an interface not described before, or longer than its block
+            if interface >= len(interfaces) or packet + captured_length > end:
+                stats["parse_errors"] += 1
+            else:
+                linktype, units = interfaces[interface]
+                yield ((high << 32) | low) / units, linktype, view[packet:packet + captured_length]
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            if not interfaces:
+                stats["parse_errors"] += 1
+            else:
+                # No timestamp, the packet is cut to the block (the snap length of the only interface)
+                original_length = struct.unpack_from(byte_order + "I", data, body)[0]
+                packet = body + 4
+                yield None, interfaces[0][0], view[packet:min(packet + original_length, end)]
+        offset += block_length
+
+def read_packets(data, stats):
+    """
+    Yield (timestamp, link type, packet view) for every packet of a pcap or pcapng capture.
+    """
+    if len(data) < MIN_CAPTURE_SIZE:
+        raise ValueError(f"not a pcap or pcapng file ({len(data)} bytes)")
+    magic = struct.unpack_from("<I", data, 0)[0]
+    if magic == PCAPNG_SECTION_HEADER:
+        return pcapng_packets(data, stats)
+    if magic in PCAP_MAGIC:
+        return pcap_packets(data, stats)
+    raise ValueError(f"not a pcap or pcapng file (magic {magic:#010x})")
+
+def ip_packet(linktype, packet):
+    """
+    Strip the link layer header of a packet.
+    Returns the IP version and the IP packet view, None for other protocols.
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = (packet[offset] << 8) | packet[offset + 1]
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = (packet[offset] << 8) | packet[offset + 1]
+        offset += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = (packet[14] << 8) | packet[15]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = (packet[0] << 8) | packet[1]
+        offset = 20
+    elif linktype == LINKTYPE_NULL:
+        # The address family in the byte order of the capturing host: 2 for IPv4, 24, 28 or 30 for IPv6
+        family = packet[0] or packet[3]
+        ethertype = ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6 if family in (24, 28, 30) else None
+        offset = 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6) or linktype in LINKTYPE_RAW_BSD:
+        offset = 0
+        version = packet[0] >> 4 if len(packet) else None
+        ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else None
+    else:
+        return None
+    if ethertype == ETHERTYPE_IPV4:
+        return 4, packet[offset:]
+    if ethertype == ETHERTYPE_IPV6:
+        return 6, packet[offset:]
+    return None
+
+def udp_datagram(version, ip, stats):
+    """
+    Get the addresses, ports and payload of a UDP packet, the payload as a view of the capture.
+    Fragments are counted and skipped, they would need reassembly.
+    Returns (source, source port, destination, destination port, payload) or None if it is not a UDP packet.
+    """
+    if version == 4:
+        header_length = (ip[0] & 0x0F) * 4
+        total_length = (ip[2] << 8) | ip[3]
+        fragment = ((ip[6] << 8) | ip[7]) & 0x3FFF
+        if ip[9] != IPPROTO_UDP:
+            return None
+        if fragment:
+            stats["fragments"] += 1
+            return None
+        source = socket.inet_ntop(socket.AF_INET, ip[12:16])
+        destination = socket.inet_ntop(socket.AF_INET, ip[16:20])
+        # The total length drops the Ethernet padding of short packets
+        udp = ip[header_length:total_length]
+    else:
+        next_header = ip[6]
+        offset = 40
+        while next_header in IPV6_EXTENSION_HEADERS:
+            next_header = ip[offset]
+            offset += (ip[offset + 1] + 1) * 8
+        if next_header == 44:
+            stats["fragments"] += 1
+            return None
+        if next_header != IPPROTO_UDP:
+            return None
+        source = socket.inet_ntop(socket.AF_INET6, ip[8:24])
+        destination = socket.inet_ntop(socket.AF_INET6, ip[24:40])
+        udp = ip[offset:40 + ((ip[4] << 8) | ip[5])]
+    source_port, destination_port, length, _checksum = UDP_HEADER.unpack_from(udp, 0)
+    return source, source_port, destination, destination_port, udp[UDP_HEADER.size:length]
+
+def is_stun(payload):
+    return len(payload) >= 20 and payload[0] & 0xC0 == 0 and payload[4:8] == STUN_MAGIC_COOKIE
+
+def stun_record(timestamp, source, source_port, destination_port, payload):
+    """
+    The record of a STUN message: the ufrag of a Binding Request as webRTC.py extracts it
+    and the full USERNAME of any message as webRTC_turn.py parses it.
+    """
+    return {"time": timestamp, "source": source, "port": source_port, "destination_port": destination_port,
+            "type": (payload[0] << 8) | payload[1], "ufrag": extract_ufrag(payload), "username": parse_username(payload)}
+
+def replay_packets(packets, mdns_sink, stun_sink, stun_ports, stats):
+    for timestamp, linktype, packet in packets:
+        stats["packets"] += 1
+        stats["bytes"] += len(packet)
+        try:
+            ip = ip_packet(linktype, packet)
+            if ip is None:
+                stats["unsupported_packets"] += 1
+                continue
+            datagram = udp_datagram(ip[0], ip[1], stats)
+            if datagram is None:
+                continue
+            source, source_port, _destination, destination_port, payload = datagram
+            stats["udp_packets"] += 1
+            if source_port == MCAST_PORT or destination_port == MCAST_PORT:
+                stats["mdns_packets"] += 1
+                record = {"time": timestamp, "source": source, "port": source_port}
+                record.update(parse_mdns(payload))
+                if mdns_sink is not None:
+                    mdns_sink.write(record)
+            elif (stun_ports is None or destination_port in stun_ports) and is_stun(payload):
+                stats["stun_packets"] += 1
+                record = stun_record(timestamp, source, source_port, destination_port, payload)
+                stats["ufrags"] += record["ufrag"] is not None
+                if stun_sink is not None:
+                    stun_sink.write(record)
+        except (ValueError, IndexError, struct.error):
+            stats["parse_errors"] += 1
+
+def replay(path, mdns_sink=None, stun_sink=None, stun_ports=None, stats=None):
+    """
+    Decode the mDNS (UDP 5353) and STUN packets of a capture through the live parsers and write their records to the sinks (if given).
+    mDNS records are the ones of mDNS.py --capture with the capture time, STUN records are stun_record()s.
+    STUN is looked for on the stun_ports, or on every UDP port if None.
+    Files too short or not pcap or pcapng are counted as short_captures and not_captures, and not replayed.
+    Returns the stats of the replay, added to stats if given.
+    """
+    stats = stats if stats is not None else {}
+    for name in ("packets", "bytes", "udp_packets", "mdns_packets", "stun_packets", "ufrags", "parse_errors",
+                 "fragments", "unsupported_packets", "truncated_packets", "short_captures", "not_captures", "seconds"):
+        stats.setdefault(name, 0)
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        # An empty file cannot be mapped, e.g. a capture stopped before its header was written
+        if os.fstat(f.fileno()).st_size < MIN_CAPTURE_SIZE:
+            stats["short_captures"] += 1
+            return stats
+        # The packets are views of the mapped file, nothing is copied before the parsers
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                packets = read_packets(data, stats)
+            except ValueError:
+                # Skipped like a short capture, the other files of the run are still replayed
+                stats["not_captures"] += 1
+                return stats
+            try:
+                replay_packets(packets, mdns_sink, stun_sink, stun_ports, stats)
+            finally:
+                # Releases the views, the file cannot be unmapped before
+                packets.close()
+    stats["seconds"] += time.perf_counter() - started
+    return stats
+
+def print_stats(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    print(f"📊 {stats['packets']} packets ({stats['bytes'] / 2 ** 20:.1f} MB) in {stats['seconds']:.2f}s: "
+          f"{stats['packets'] / seconds:.0f} packets/s, {stats['bytes'] / 2 ** 20 / seconds:.1f} MB/s", file=sys.stderr)
+    print(f"   {stats['mdns_packets']} mDNS, {stats['stun_packets']} STUN ({stats['ufrags']} ufrags), {stats['parse_errors']} unparsable, "
+          f"{stats['fragments']} fragments, {stats['unsupported_packets']} unsupported, {stats['truncated_packets']} truncated, "
+          f"{stats['short_captures']} captures too short, {stats['not_captures']} files not captures", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay pcap/pcapng captures through the mDNS and STUN parsers")
+    parser.add_argument("captures", nargs="+", help="pcap or pcapng files")
+    parser.add_argument("--mdns", metavar="PATH", help="write the mDNS records to PATH (- for stdout)")
+    parser.add_argument("--stun", metavar="PATH", help="write the STUN records to PATH (- for stdout)")
+    parser.add_argument("--stun-ports", type=int, nargs="+", help="only look for STUN sent to these UDP ports")
+    parser.add_argument("--stats-json", metavar="PATH", help="also write the stats to PATH")
+    args = parser.parse_args()
+
+    mdns_sink = JsonlSink(args.mdns) if args.mdns else None
+    stun_sink = JsonlSink(args.stun) if args.stun else None
+    stats = {}
+    try:
+        for capture in args.captures:
+            replay(capture, mdns_sink, stun_sink, set(args.stun_ports) if args.stun_ports else None, stats)
+    finally:
+        for sink in (mdns_sink, stun_sink):
+            if sink is not None:
+                sink.close()
+    print_stats(stats)
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(stats, f, indent=4)
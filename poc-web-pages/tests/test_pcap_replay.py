@@ -0,0 +1,107 @@
+import socket
+import struct
+
+import pytest
+
+from pcap_replay import LINKTYPE_ETHERNET, LINKTYPE_RAW, replay
+
+class ListSink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+def udp(source_port, destination_port, payload):
+    return struct.pack("!HHHH", source_port, destination_port, 8 + len(payload), 0) + payload
+
+def ipv4(source, destination, payload):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), 0, 0, 64, 17, 0,
+                         socket.inet_pton(socket.AF_INET, source), socket.inet_pton(socket.AF_INET, destination))
+    return header + payload
+
+def ipv6(source, destination, payload):
+    header = struct.pack("!IHBB16s16s", 0x60000000, len(payload), 17, 64,
+                         socket.inet_pton(socket.AF_INET6, source), socket.inet_pton(socket.AF_INET6, destination))
+    return header + payload
+
+def ethernet(ip):
+    return b"\x01\x00\x5e\x00\x00\xfb" + b"\x02\x00\x00\x00\x00\x01" + b"\x08\x00" + ip
+
+def mdns_query(name):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00"
+    return struct.pack("!HHHHHH", 0, 0, 1, 0, 0, 0) + labels + struct.pack("!HH", 12, 1)
+
+def stun_binding_request(username):
+    value = username.encode()
+    attribute = struct.pack("!HH", 0x0006, len(value)) + value + b"\x00" * (-len(value) % 4)
+    return struct.pack("!HH", 0x0001, len(attribute)) + b"\x21\x12\xa4\x42" + b"\x07" * 12 + attribute
+
+def write_pcap(path, linktype, packets):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype))
+        for timestamp, packet in packets:
+            f.write(struct.pack("<IIII", int(timestamp), round(timestamp % 1 * 10 ** 6), len(packet), len(packet)) + packet)
+
+def pcapng_block(block_type, body):
+    body += b"\x00" * (-len(body) % 4)
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+def write_pcapng(path, linktype, packets):
+    with open(path, "wb") as f:
+        f.write(pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+        f.write(pcapng_block(1, struct.pack("<HHI", linktype, 0, 65535)))
+        for timestamp, packet in packets:
+            microseconds = round(timestamp * 10 ** 6)
+            f.write(pcapng_block(6, struct.pack("<IIIII", 0, microseconds >> 32, microseconds & 0xFFFFFFFF, len(packet), len(packet)) + packet))
+
+@pytest.fixture
+def captures(tmp_path):
+    pcap_path, pcapng_path = str(tmp_path / "ipv4.pcap"), str(tmp_path / "ipv6.pcapng")
+    write_pcap(pcap_path, LINKTYPE_ETHERNET, [
+        (1.5, ethernet(ipv4("192.168.1.2", "224.0.0.251", udp(5353, 5353, mdns_query("_test._tcp.local"))))),
+        (2.0, ethernet(ipv4("192.168.1.2", "127.0.0.1", udp(50000, 3478, stun_binding_request("abcd:efgh"))))),
+    ])
+    write_pcapng(pcapng_path, LINKTYPE_RAW, [
+        (3.25, ipv6("fe80::1", "ff02::fb", udp(5353, 5353, mdns_query("printer.local")))),
+        (4.0, ipv6("::1", "::1", udp(50001, 3478, stun_binding_request("wxyz:ijkl")))),
+    ])
+    return pcap_path, pcapng_path
+
+@pytest.mark.parametrize("capture", [0, 1])
+def test_replay_capture(captures, capture):
+    mdns_sink, stun_sink = ListSink(), ListSink()
+    stats = replay(captures[capture], mdns_sink, stun_sink)
+    assert (stats["packets"], stats["mdns_packets"], stats["stun_packets"], stats["ufrags"]) == (2, 1, 1, 1)
+    assert stats["parse_errors"] == stats["truncated_packets"] == 0
+    [mdns], [stun] = mdns_sink.records, stun_sink.records
+    if capture == 0:
+        assert (mdns["time"], mdns["source"], mdns["questions"][0]["name"]) == (1.5, "192.168.1.2", "_test._tcp.local")
+        assert (stun["time"], stun["source"], stun["port"], stun["ufrag"], stun["username"]) == (2.0, "192.168.1.2", 50000, "abcd", "abcd:efgh")
+    else:
+        assert (mdns["time"], mdns["source"], mdns["questions"][0]["name"]) == (3.25, "fe80::1", "printer.local")
+        assert (stun["time"], stun["source"], stun["port"], stun["ufrag"], stun["username"]) == (4.0, "::1", 50001, "wxyz", "wxyz:ijkl")
+
+def test_files_that_are_not_captures_are_counted_and_skipped(captures, tmp_path):
+    not_capture, empty = str(tmp_path / "notes.txt"), str(tmp_path / "empty.pcap")
+    with open(not_capture, "w") as f:
+        f.write("these are not the packets you are looking for\n")
+    open(empty, "w").close()
+
+    stun_sink = ListSink()
+    stats = {}
+    for path in (not_capture, captures[0], empty, captures[1]):
+        replay(path, stun_sink=stun_sink, stats=stats)
+    assert (stats["not_captures"], stats["short_captures"]) == (1, 1)
+    assert (stats["packets"], stats["stun_packets"]) == (4, 2)
+    assert [record["ufrag"] for record in stun_sink.records] == ["abcd", "wxyz"]
+
+def test_truncated_capture_keeps_whole_packets(captures, tmp_path):
+    with open(captures[0], "rb") as f:
+        data = f.read()
+    truncated = str(tmp_path / "truncated.pcap")
+    with open(truncated, "wb") as f:
+        f.write(data[:-10])
+    stats = replay(truncated)
+    assert (stats["packets"], stats["mdns_packets"], stats["truncated_packets"]) == (1, 1, 1)
@@ -0,0 +1,107 @@
+import json
+
+from ufrag_store import SnapshotWriter, UfragStore, read_snapshot
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    store = UfragStore(ttl=10, clock=clock)
+    store.record("old", "127.0.0.1", 5000)
+    clock.now += 5
+    store.record("new", "127.0.0.1", 5001)
+    clock.now += 6
+    assert store.get("old") is None and "old" not in store
+    assert store.get("new")["port"] == 5001
+    # Expired entries stay until something expires them
+    assert len(store) == 2
+    store.expire()
+    assert len(store) == 1 and store.evicted_count == 1
+    clock.now += 5
+    assert [ufrag for ufrag, entry in store.items()] == []
+
+def test_size_cap_evicts_least_recently_seen():
+    clock = Clock()
+    store = UfragStore(ttl=100, max_entries=3, clock=clock)
+    for ufrag in ("a", "b", "c"):
+        store.record(ufrag, "127.0.0.1", 5000)
+        clock.now += 1
+    # Seeing a again makes b the least recently seen
+    store.record("a", "127.0.0.1", 5000)
+    store.record("d", "127.0.0.1", 5000)
+    assert [ufrag for ufrag, entry in store.items()] == ["c", "a", "d"]
+    assert store.get("b") is None
+    assert store.evicted_count == 1
+
+def test_hits_keep_first_seen_and_latest_source():
+    clock = Clock()
+    store = UfragStore(ttl=100, clock=clock)
+    first = store.record("abcd", "127.0.0.1", 5000)
+    clock.now += 3
+    second = store.record("abcd", "::1", 5001)
+    assert first == {"ufrag": "abcd", "address": "127.0.0.1", "port": 5000, "first_seen": 1_000_000.0, "last_seen": 1_000_000.0, "hits": 1}
+    assert second == {"ufrag": "abcd", "address": "::1", "port": 5001, "first_seen": 1_000_000.0, "last_seen": 1_000_003.0, "hits": 2}
+    assert store.get("abcd") == second
+
+def test_snapshot_appends_changes_and_compacts(tmp_path):
+    clock = Clock()
+    store = UfragStore(ttl=10, clock=clock)
+    path = str(tmp_path / "ufrags.jsonl")
+    writer = SnapshotWriter(store, path, interval=1)
+    store.record("a", "127.0.0.1", 5000)
+    store.record("b", "127.0.0.1", 5001)
+    writer.compact()
+    assert len(read_lines(path)) == 3
+
+    clock.now += 8
+    store.record("a", "127.0.0.1", 5002)
+    writer.write_changes()
+    # Nothing changed since, nothing is appended
+    writer.write_changes()
+    assert len(read_lines(path)) == 5
+    snapshot = read_snapshot(path)
+    assert snapshot["a"]["port"] == 5002 and snapshot["a"]["hits"] == 2
+    assert set(snapshot) == {"a", "b"}
+
+    # b expired: it is still in the file but not in the snapshot, until the next rewrite drops it
+    clock.now += 3
+    store.record("c", "127.0.0.1", 5003)
+    writer.write_changes()
+    assert set(read_snapshot(path)) == {"a", "c"}
+    assert len(read_lines(path)) == 7
+    writer.compact()
+    lines = read_lines(path)
+    assert lines[0] == {"written": clock.now, "ttl": 10}
+    assert [line["ufrag"] for line in lines[1:]] == ["a", "c"]
+    writer.file.close()
+
+def test_writer_thread_writes_last_changes_on_stop(tmp_path):
+    store = UfragStore(ttl=100)
+    path = str(tmp_path / "ufrags.jsonl")
+    writer = SnapshotWriter(store, path, interval=0.01, compact_interval=0.05)
+    writer.start()
+    store.record("a", "127.0.0.1", 5000)
+    store.record("b", "127.0.0.1", 5001)
+    writer.stop()
+    assert set(read_snapshot(path)) == {"a", "b"}
+
+def test_read_snapshot_stops_at_half_written_line(tmp_path):
+    clock = Clock()
+    store = UfragStore(ttl=10, clock=clock)
+    path = str(tmp_path / "ufrags.jsonl")
+    writer = SnapshotWriter(store, path, interval=1)
+    store.record("a", "127.0.0.1", 5000)
+    writer.compact()
+    writer.file.write('{"ufrag": "b", "address": "127.0.0.1", "po')
+    writer.file.close()
+    assert set(read_snapshot(path)) == {"a"}
+    assert read_snapshot(str(tmp_path / "missing.jsonl")) == {}
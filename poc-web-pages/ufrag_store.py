@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds after which a ufrag that was not seen again is forgotten
+DEFAULT_TTL = 600
+# Ufrags kept at most, the least recently seen are forgotten first
+DEFAULT_MAX_ENTRIES = 100_000
+# Seconds between rewrites of the whole snapshot file, which otherwise only gets the changed entries appended
+DEFAULT_COMPACT_INTERVAL = 60
+
+def entry_dict(ufrag, entry):
+    address, port, first_seen, last_seen, hits = entry
+    return {"ufrag": ufrag, "address": address, "port": port, "first_seen": first_seen, "last_seen": last_seen, "hits": hits}
+
+class UfragStore:
+    """
+    In-memory correlation store of the ufrags received by the STUN listener (webRTC.py), keyed by ufrag,
+    so a test harness can check in O(1) whether the ufrag of a page visit arrived:
+        store.get("abcd") -> {"ufrag", "address", "port", "first_seen", "last_seen", "hits"} or None
+    address and port are the source of the latest request with the ufrag.
+    Entries are kept in least recently seen order, so expiring them past the ttl and evicting them
+    past max_entries only ever looks at the oldest ones. Safe to use from several threads.
+    Entries are immutable tuples replaced on every hit, so copying the store (see SnapshotWriter) only copies references.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Entries changed since the last take_changes()
+        self.changed = {}
+        self.evicted_count = 0
+
+    def record(self, ufrag, address, port, now=None):
+        """
+        Record a request with the ufrag from address and port.
+        Returns the ufrag's entry.
+        """
+        now = self.clock() if now is None else now
+        with self.lock:
+            entry = self.entries.get(ufrag)
+            if entry is None:
+                entry = (address, port, now, now, 1)
+            else:
+                self.entries.move_to_end(ufrag)
+                entry = (address, port, entry[2], now, entry[4] + 1)
+            self.entries[ufrag] = entry
+            self.changed[ufrag] = entry
+            self._expire(now)
+        return entry_dict(ufrag, entry)
+
+    def get(self, ufrag, now=None):
+        """
+        Get the entry of a ufrag, None if it was never seen or has expired.
+        """
+        now = self.clock() if now is None else now
+        entry = self.entries.get(ufrag)
+        if entry is None or now - entry[3] > self.ttl:
+            return None
+        return entry_dict(ufrag, entry)
+
+    def __contains__(self, ufrag):
+        return self.get(ufrag) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expire(self, now=None):
+        """
+        Forget the ufrags not seen for more than the ttl.
+        """
+        with self.lock:
+            self._expire(self.clock() if now is None else now)
+
+    def _expire(self, now):
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if len(self.entries) <= self.max_entries and now - oldest[3] <= self.ttl:
+                break
+            self.entries.popitem(last=False)
+            self.evicted_count += 1
+
+    def items(self):
+        """
+        Returns a list of (ufrag, entry tuple) of the live entries.
+        """
+        with self.lock:
+            self._expire(self.clock())
+            return list(self.entries.items())
+
+    def take_changes(self):
+        """
+        Returns a dict of ufrag -> entry tuple of the entries changed since the last call.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, {}
+        return changed
+
+class SnapshotWriter(threading.Thread):
+    """
+    Writes a UfragStore to a JSON lines file from its own thread, so the listener never waits for it.
+    Every interval only the entries changed since the last write are appended, after a {"written", "ttl"} line,
+    and every compact_interval the file is rewritten atomically with the live entries only.
+    Later lines of a ufrag replace earlier ones, see read_snapshot. Ufrags evicted by the size cap stay in the file
+    until the next rewrite, they did arrive.
+    """
+    def __init__(self, store, path, interval, compact_interval=DEFAULT_COMPACT_INTERVAL):
+        super().__init__(daemon=True)
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.compact_interval = compact_interval
+        self.stop_event = threading.Event()
+        self.file = None
+
+    def header(self):
+        return json.dumps({"written": self.store.clock(), "ttl": self.store.ttl})
+
+    def write_changes(self):
+        changes = self.store.take_changes()
+        if changes:
+            lines = [self.header()] + [json.dumps(entry_dict(ufrag, entry)) for ufrag, entry in changes.items()]
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+
+    def compact(self):
+        # Changes taken now are in the items too, later ones are appended after the rewrite
+        self.store.take_changes()
+        lines = [self.header()] + [json.dumps(entry_dict(ufrag, entry)) for ufrag, entry in self.store.items()]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def run(self):
+        self.compact()
+        compacted = time.monotonic()
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() - compacted >= self.compact_interval:
+                self.compact()
+                compacted = time.monotonic()
+            else:
+                self.write_changes()
+        self.write_changes()
+        self.file.close()
+
+    def stop(self):
+        """
+        Write the last changes and wait for the thread to finish.
+        """
+        self.stop_event.set()
+        self.join()
+
+def read_snapshot(path):
+    """
+    Read a snapshot written by a SnapshotWriter, without the entries that had expired when it was last written.
+    Returns a dict of ufrag -> entry, empty if there is no snapshot yet.
+    """
+    entries = {}
+    written, ttl = None, None
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of an append in progress
+                    break
+                if "written" in record:
+                    written, ttl = record["written"], record["ttl"]
+                else:
+                    entries[record["ufrag"]] = record
+    except FileNotFoundError:
+        return {}
+    if written is None:
+        return entries
+    return {ufrag: entry for ufrag, entry in entries.items() if written - entry["last_seen"] <= ttl}
@@ -1,9 +1,12 @@
+import argparse
+import selectors
 import socket
 import struct
 import signal
 import sys
 import threading
-import time
+
+from ufrag_store import UfragStore, SnapshotWriter, DEFAULT_TTL, DEFAULT_MAX_ENTRIES
 
 UDP_IP4 = "0.0.0.0"
 UDP_PORT4 = 10000
@@ -11,27 +14,45 @@ UDP_PORT4 = 10000
 
 UDP_IP6 = "::"
 UDP_PORT6 = 10000
+# More ports served on both IPv4 and IPv6
+EXTRA_PORTS = []
+# Datagrams read from a socket per wakeup before the other sockets get their turn
+BATCH_SIZE = 64
+# The received ufrags are kept in a UfragStore (see ufrag_store.py), their changes are written to this file
+# every SNAPSHOT_INTERVAL seconds by a SnapshotWriter thread
+SNAPSHOT_PATH = "ufrags.jsonl"
+SNAPSHOT_INTERVAL = 1.0
+# Seconds select waits at most when serving from another thread, to notice the stop event
+STOP_CHECK_INTERVAL = 0.5
+# Print every received ufrag
+VERBOSE = True
+
+# The store of the running listener, for test harnesses in the same process
+ufrags = UfragStore()
+
+STUN_HEADER = struct.Struct("!HHI")
+STUN_ATTRIBUTE = struct.Struct("!HH")
+STUN_MAGIC_COOKIE = 0x2112A442
 
 def extract_ufrag(stun_data):
+    # stun_data can be bytes or a memoryview (e.g. of a packet in a capture file, see pcap_replay.py)
     if len(stun_data) < 20:
         return None
     # Confirm STUN Binding Request (0x0001) and Magic Cookie (fixed value)
-    msg_type = struct.unpack("!H", stun_data[0:2])[0]
-    magic_cookie = stun_data[4:8]
+    msg_type, _msg_len, magic_cookie = STUN_HEADER.unpack_from(stun_data, 0)
 
-    if msg_type != 0x0001 or magic_cookie != b'\x21\x12\xa4\x42':
+    if msg_type != 0x0001 or magic_cookie != STUN_MAGIC_COOKIE:
         return None
 
     # Parse attributes starting after the 20-byte STUN header
     i = 20
     while i + 4 <= len(stun_data):
-        attr_type = struct.unpack("!H", stun_data[i:i+2])[0]
-        attr_len = struct.unpack("!H", stun_data[i+2:i+4])[0]
+        attr_type, attr_len = STUN_ATTRIBUTE.unpack_from(stun_data, i)
         attr_val = stun_data[i+4:i+4+attr_len]
 
         if attr_type == 0x0006:  # USERNAME attribute
             try:
-                full_username = attr_val.decode(errors='ignore')
+                full_username = str(attr_val, "utf-8", "ignore")
                 ufrag = full_username.split(":")[0]  # Extract local ufrag
                 return ufrag
             except Exception:
@@ -44,41 +65,83 @@ def extract_ufrag(stun_data):
 
     return None
 
-def run_ipv4():
-    sock4 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock4.bind((UDP_IP4, UDP_PORT4))
-
-    print(f"Listening for STUN Binding Requests on {UDP_IP4}:{UDP_PORT4}...")
-
-    while True:
-        data4, addr4 = sock4.recvfrom(4096)
-        ufrag4 = extract_ufrag(data4)
-        if ufrag4:
-            print(f"Received ufrag from IPv4 {addr4[0]}:{addr4[1]} → {ufrag4}")
-
-def run_ipv6():
-    sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-    sock6.bind((UDP_IP6, UDP_PORT6))
-
-    print(f"Listening for STUN Binding Requests on {UDP_IP6}:{UDP_PORT6}...")
-
-    while True:
-        data6, addr6 = sock6.recvfrom(4096)
-        ufrag6 = extract_ufrag(data6)
-        if ufrag6:
-            print(f"Received ufrag from IPv6 {addr6[0]}:{addr6[1]} → {ufrag6}")
+def open_socket(family, host, port):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_INET6:
+        # IPv4 traffic to the same port goes to the IPv4 socket, not to this one as mapped addresses
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+def handle_ufrag(ufrag, addr, ip_version):
+    ufrags.record(ufrag, addr[0], addr[1])
+    if VERBOSE:
+        print(f"Received ufrag from {ip_version} {addr[0]}:{addr[1]} → {ufrag}")
+
+def drain(sock, ip_version, batch_size=BATCH_SIZE):
+    """
+    Read up to batch_size datagrams from a ready non-blocking socket, so a busy socket cannot starve the others.
+    """
+    for _ in range(batch_size):
+        try:
+            data, addr = sock.recvfrom(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        ufrag = extract_ufrag(data)
+        if ufrag:
+            handle_ufrag(ufrag, addr, ip_version)
+
+def handle_exit(sig, frame):
+    print("\nShutting down.")
+    sys.exit(0)
+
+def serve(extra_ports=EXTRA_PORTS, batch_size=BATCH_SIZE, snapshot_path=SNAPSHOT_PATH, snapshot_interval=SNAPSHOT_INTERVAL, stop=None):
+    """
+    Serve the IPv4 and IPv6 ports and the extra ports (on both) from one thread, sleeping in select until a socket is readable.
+    The ufrags are written to snapshot_path (if given) from a separate thread, so the loop never waits for the file.
+    Runs until SIGINT/SIGTERM, or until the stop event is set when serving from another thread.
+    """
+    selector = selectors.DefaultSelector()
+    listeners = [(socket.AF_INET, UDP_IP4, port, "IPv4") for port in [UDP_PORT4] + list(extra_ports)]
+    listeners += [(socket.AF_INET6, UDP_IP6, port, "IPv6") for port in [UDP_PORT6] + list(extra_ports)]
+    for family, host, port, ip_version in listeners:
+        try:
+            sock = open_socket(family, host, port)
+        except OSError as e:
+            print(f"Cannot listen on {host}:{port}: {e}")
+            continue
+        selector.register(sock, selectors.EVENT_READ, ip_version)
+        print(f"Listening for STUN Binding Requests on {host}:{port}...")
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, handle_exit)
+        signal.signal(signal.SIGTERM, handle_exit)
+    snapshot_writer = None
+    if snapshot_path:
+        snapshot_writer = SnapshotWriter(ufrags, snapshot_path, snapshot_interval)
+        snapshot_writer.start()
+    try:
+        while stop is None or not stop.is_set():
+            for key, _events in selector.select(STOP_CHECK_INTERVAL if stop is not None else None):
+                drain(key.fileobj, key.data, batch_size)
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+        if snapshot_writer is not None:
+            snapshot_writer.stop()
 
 if __name__ == '__main__':
-    try:
-        t1 = threading.Thread(target=run_ipv4, daemon=True)
-        t2 = threading.Thread(target=run_ipv6, daemon=True)
-        
-        print("Listeners starting...")
-        t1.start()
-        time.sleep(3)
-        t2.start()
-        while True:
-            pass
-
-    except KeyboardInterrupt:
-        print("\nShutting down.")
+    parser = argparse.ArgumentParser(description="Print the ufrags of the STUN Binding Requests sent to the listening ports")
+    parser.add_argument("--extra-ports", type=int, nargs="+", default=EXTRA_PORTS, help="more UDP ports to listen on, over IPv4 and IPv6")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="datagrams read from a socket per wakeup")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="file the received ufrags are written to (see ufrag_store.read_snapshot)")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL, help="seconds between snapshots")
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL, help="seconds a ufrag is kept after it was last seen")
+    parser.add_argument("--max-ufrags", type=int, default=DEFAULT_MAX_ENTRIES, help="ufrags kept at most")
+    parser.add_argument("--quiet", action="store_true", help="do not print every received ufrag")
+    args = parser.parse_args()
+    ufrags = UfragStore(args.ttl, args.max_ufrags)
+    VERBOSE = not args.quiet
+    serve(args.extra_ports, args.batch, args.snapshot, args.snapshot_interval)
@@ -4,20 +4,19 @@ import signal
 import sys
 
 TURN_PORT = 10001
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind(("0.0.0.0", TURN_PORT))
-print(f"Listening on UDP {TURN_PORT}...")
+STUN_ATTRIBUTE = struct.Struct("!HH")
 
 def is_stun(data):
     return len(data) >= 20 and data[4:8] == b'\x21\x12\xa4\x42'
 
 def parse_username(data):
+    # data can be bytes or a memoryview (e.g. of a packet in a capture file, see pcap_replay.py)
     i = 20
     while i + 4 <= len(data):
-        attr_type, attr_len = struct.unpack("!HH", data[i:i+4])
+        attr_type, attr_len = STUN_ATTRIBUTE.unpack_from(data, i)
         val = data[i+4:i+4+attr_len]
         if attr_type == 0x0006:  # USERNAME
-            return val.decode(errors='ignore')
+            return str(val, "utf-8", "ignore")
         i += 4 + ((attr_len + 3) // 4) * 4
     return None
 
@@ -87,25 +86,34 @@ def handle_exit(sig, frame):
     print("\nExiting gracefully.")
     sys.exit(0)
 
-signal.signal(signal.SIGINT, handle_exit)
-
-while True:
-    data, addr = sock.recvfrom(4096)
-    if is_stun(data):
-        msg_type = struct.unpack("!H", data[0:2])[0]
-        transaction_id = data[8:20]
-        username = parse_username(data)
-        
-        if username:
-            print(f"From {addr}: USERNAME = {username}")
-            send_allocate_forbidden(sock, addr, transaction_id)
-            sys.exit(0)
-
-        if msg_type == 0x0001:
-            print("Received Binding Request")
-            send_binding_success(sock, addr, transaction_id)
-
-        elif msg_type == 0x0003:
-            print("Received Allocate Request")
-            send_allocate_unauthorized(sock, addr, transaction_id)
+def main():
+    # Bound here and not at import, so the parsers can be imported (e.g. by pcap_replay.py) without taking the port
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", TURN_PORT))
+    print(f"Listening on UDP {TURN_PORT}...")
+
+    signal.signal(signal.SIGINT, handle_exit)
+
+    while True:
+        data, addr = sock.recvfrom(4096)
+        if is_stun(data):
+            msg_type = struct.unpack("!H", data[0:2])[0]
+            transaction_id = data[8:20]
+            username = parse_username(data)
+
+            if username:
+                print(f"From {addr}: USERNAME = {username}")
+                send_allocate_forbidden(sock, addr, transaction_id)
+                sys.exit(0)
+
+            if msg_type == 0x0001:
+                print("Received Binding Request")
+                send_binding_success(sock, addr, transaction_id)
+
+            elif msg_type == 0x0003:
+                print("Received Allocate Request")
+                send_allocate_unauthorized(sock, addr, transaction_id)
+
+if __name__ == "__main__":
+    main()
 
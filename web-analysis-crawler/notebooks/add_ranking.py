@@ -1,15 +1,21 @@
 import json
 import glob
+import itertools
+import os
 import re
 import csv
+import shutil
 import socket
 from tld import get_fld
 from urllib.parse import urlparse
-from functools import lru_cache
 
 from concurrent.futures import ProcessPoolExecutor, as_completed, TimeoutError as concurrentTimeoutError
 from tqdm import tqdm
 
+from results_io import results_path, NORMALIZED_DIMENSIONS
+from ranking_index import open_ranking, get_rank
+from run_stats import RunStats
+
 rank_file_path = "202502.csv"
 outputSize = 100000
 
@@ -32,62 +38,134 @@ version = "_post"
 # input_file = "results/webRTC_output_" + location + version + ".csv"
 # output = "webRTC_output"
 
-input_file = "_new_results/requests_output_" + location + version + ".csv"
-output = "requests_output"
-# input_file = "_new_results/webRTC_output_" + location + version + ".csv"
-# output = "webRTC_output"
-
-TIMEOUT_SECONDS = 30
-ranking = {}
+# results_input_folder = "results/"
+results_input_folder = "_new_results/"
 
-@lru_cache(maxsize=100_000)
-def get_rank(tested_url):
-    if tested_url.endswith("/"):
-        tested_url = tested_url[:-1]
-    return ranking.get(tested_url, "?")
+# Every output of every location and version listed here is ranked in one run against the same index
+locations = [location]
+versions = [version]
+outputs = ["requests_output", "webRTC_output"]
 
-def analyze_dict(row_dict : dict):
-    tested_url = row_dict.get("tested_url", "")
-    if tested_url == "":
-        print("Error")
+# "csv", "parquet" or "normalized", as written by process_output.py, Parquet outputs are ranked into a single Parquet file
+# and normalized outputs are copied with only their pages table ranked
+results_format = "csv"
 
-    row_dict["rank"] = get_rank(tested_url)
+# Rows ranked and written at a time
+BATCH_ROWS = 10_000
 
-    return row_dict
-
-def main():
-    crawl_count = 0
+TIMEOUT_SECONDS = 30
 
-    with open(rank_file_path) as file:
+def input_files():
+    """
+    Get the (input path, output path) of every output to rank.
+    """
+    for location in locations:
+        for version in versions:
+            for output in outputs:
+                yield (results_path(results_input_folder + output + "_" + location + version, results_format),
+                       results_path(results_folder + output + "_" + location + version, results_format))
+
+def rank_rows(rows : list, tested_index : int, final_index : int, rank_index : int, stats : RunStats):
+    """
+    Set the rank of a batch of CSV rows in place, rows without a tested url are counted as missing_tested_url.
+    """
+    for row in rows:
+        tested_url = row[tested_index]
+        if tested_url == "":
+            stats.count("missing_tested_url")
+        row[rank_index] = get_rank(tested_url, row[final_index] or None)
+
+def rank_csv(input_path : str, output_path : str, progress : tqdm, stats : RunStats):
+    """
+    Rank a CSV output batch by batch, the rank column is added at the end if the input has none.
+    Returns the number of rows.
+    """
+    row_count = 0
+    with open(input_path, mode='r', newline='', encoding='utf-8') as file, open(output_path, "w", newline="", encoding='utf-8') as f1:
         reader = csv.reader(file)
-        count = 0
-
-        for row in reader:
-            ranking[row[0]] = row[1]
-            count += 1
-            if count > outputSize:
+        header = next(reader, None)
+        if header is None:
+            return 0
+        if "rank" not in header:
+            header = header + ["rank"]
+        tested_index, final_index, rank_index = header.index("tested_url"), header.index("final_url"), header.index("rank")
+        writer = csv.writer(f1)
+        written_header = False
+
+        while True:
+            # Short rows are padded like csv.DictReader fills missing fields
+            rows = [row + [""] * (len(header) - len(row)) for row in itertools.islice(reader, BATCH_ROWS)]
+            if not rows:
                 break
+            rank_rows(rows, tested_index, final_index, rank_index, stats)
+            if not written_header:
+                writer.writerow(header)
+                written_header = True
+            writer.writerows(rows)
+            row_count += len(rows)
+            progress.update(len(rows))
+    return row_count
+
+def rank_parquet(input_path : str, output_path : str, progress : tqdm, stats : RunStats):
+    """
+    Rank a Parquet output (a file or a directory of parts) record batch by record batch into a single Parquet file.
+    Returns the number of rows.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    row_count = 0
+    writer = None
+    try:
+        for batch in ds.dataset(input_path, format="parquet").to_batches(batch_size=BATCH_ROWS):
+            tested_urls = batch.column("tested_url").to_pylist()
+            final_urls = batch.column("final_url").to_pylist()
+            stats.count("missing_tested_url", sum(1 for tested_url in tested_urls if not tested_url))
+            ranks = pa.array([get_rank(tested_url or "", final_url or None) for tested_url, final_url in zip(tested_urls, final_urls)], pa.string())
+            if "rank" in batch.schema.names:
+                batch = batch.set_column(batch.schema.get_field_index("rank"), "rank", ranks)
+            else:
+                batch = batch.append_column("rank", ranks)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, batch.schema)
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+            progress.update(batch.num_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return row_count
+
+def rank_normalized(input_path : str, output_path : str, progress : tqdm, stats : RunStats):
+    """
+    Rank a normalized output: the rank is a column of the pages table, the facts and the other tables are copied unchanged.
+    Returns the number of pages.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    for name in list(NORMALIZED_DIMENSIONS) + ["facts"]:
+        if name != "pages":
+            shutil.copyfile(os.path.join(input_path, name + ".csv"), os.path.join(output_path, name + ".csv"))
+    return rank_csv(os.path.join(input_path, "pages.csv"), os.path.join(output_path, "pages.csv"), progress, stats)
 
-    with open(input_file, mode='r', newline='', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        data = [row for row in reader]
-
-    with open(results_folder + output + "_" + location + version + ".csv", "w", newline="") as f1:
-        WRITER_REQS = None
-
-        for row in data:
-
-            crawl_count += 1
-            if not crawl_count % 100:
-                print(crawl_count)
-
-            result = analyze_dict(row)
-
-            if result:
-                if WRITER_REQS is None:
-                    WRITER_REQS = csv.DictWriter(f1, fieldnames=result.keys())
-                    WRITER_REQS.writeheader()
-                WRITER_REQS.writerow(result)
+def main():
+    open_ranking(rank_file_path, outputSize)
+    stats = RunStats()
+
+    with tqdm(unit=" rows", unit_scale=True) as progress:
+        for input_path, output_path in input_files():
+            if not os.path.exists(input_path):
+                print(f"Skipping {input_path}, it does not exist")
+                continue
+            if results_format == "parquet":
+                row_count = rank_parquet(input_path, output_path, progress, stats)
+            elif results_format == "normalized":
+                row_count = rank_normalized(input_path, output_path, progress, stats)
+            else:
+                row_count = rank_csv(input_path, output_path, progress, stats)
+            print(f"Ranked {row_count} rows of {input_path} into {output_path}")
+    if stats.counts["missing_tested_url"]:
+        print(f"{stats.counts['missing_tested_url']} rows had no tested url and were ranked \"?\"")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
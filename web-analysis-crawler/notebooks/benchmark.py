@@ -0,0 +1,254 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from queue import Empty
+
+import dns_resolution
+from results_io import results_path
+from synthetic_corpus import FakeDns, generate_corpus, add_corpus_arguments, corpus_parameters
+from crawl_shards import CODECS, list_crawl_files, pack_folder
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ["analysis", "summarization"]
+LOCATION = "synthetic"
+VERSION = "_benchmark"
+
+def peak_rss_mb(who):
+    """
+    Peak resident set size of this process (resource.RUSAGE_SELF) or of its largest waited-for child (RUSAGE_CHILDREN), in MB.
+    Returns None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def folder_bytes(path : str):
+    """
+    Total size of a file, or of the files in a folder and its subfolders.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _folders, names in os.walk(path) for name in names)
+
+def run_analysis(settings : dict):
+    import process_output
+    process_output.location = LOCATION
+    process_output.version = VERSION
+    process_output.input_folder = settings["corpus"].rstrip("/\\") + "/"
+    process_output.results_folder = settings["results_folder"]
+    process_output.rank_file_path = settings["rank_file"]
+    process_output.DNS_CACHE_PATH = settings["dns_cache"]
+    process_output.MAX_WORKERS = settings["workers"]
+    process_output.OUTPUT_FORMAT = settings["format"]
+    process_output.WORKER_SHARDS = settings["worker_shards"]
+    process_output.MERGE_SORT_BY = settings["sort_by"]
+    process_output.RESUME = False
+    process_output.main()
+
+def run_summarization(settings : dict):
+    import summarize_results
+    results_folder = settings["results_folder"]
+    summarize_results.results_format = settings["format"]
+    summarize_results.webrtc_csv_path = results_path(results_folder + "webRTC_output_" + LOCATION + VERSION, settings["format"])
+    summarize_results.requests_csv_path = results_path(results_folder + "requests_output_" + LOCATION + VERSION, settings["format"])
+    summarize_results.output_json_path = results_folder + "summary_output_" + LOCATION + VERSION + ".json"
+    summarize_results.markdown_output_path = results_folder + "summary_report_" + LOCATION + VERSION + ".md"
+    summarize_results.sketch_output_base = results_folder + "summary_sketches_" + LOCATION + VERSION
+    summarize_results.CHUNK_ROWS = settings["chunk_rows"]
+    summarize_results.APPROXIMATE_DISTINCT = settings["approximate"]
+    summarize_results.main()
+
+STAGE_FUNCTIONS = {"analysis": run_analysis, "summarization": run_summarization}
+
+def stage_input_bytes(stage : str, settings : dict):
+    """
+    Bytes a stage reads: the crawl files for the analysis, the result tables for the summarization.
+    """
+    if stage == "analysis":
+        return folder_bytes(settings["corpus"])
+    base = settings["results_folder"]
+    return sum(folder_bytes(results_path(base + name + "_" + LOCATION + VERSION, settings["format"]))
+               for name in ("requests_output", "webRTC_output"))
+
+def stage_process(stage : str, settings : dict, queue):
+    """
+    Run a stage in its own process, so its peak RSS is not mixed up with the other stages, and report its measurements.
+    """
+    if not settings["verbose"]:
+        # Progress bars and prints of the stage go to the log
+        log = open(os.path.join(settings["work_folder"], stage + ".log"), "a")
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    # The failed/timedout lists of process_output are written to the working directory
+    os.chdir(settings["work_folder"])
+    dns_resolution.custom_resolver = FakeDns(settings["dns_localhost_rate"], settings["dns_failure_rate"], settings["dns_latency"], settings["seed"])
+    try:
+        start = time.perf_counter()
+        STAGE_FUNCTIONS[stage](settings)
+        seconds = time.perf_counter() - start
+    except Exception as e:
+        queue.put({"error": repr(e)})
+        return
+    queue.put({
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "workers_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    })
+
+def run_stage(stage : str, settings : dict):
+    """
+    Run a stage and time it.
+    Returns its measurements with the derived rates.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=stage_process, args=(stage, settings, queue))
+    process.start()
+    # The measurements are small, joining before reading them cannot block on a full pipe
+    process.join()
+    try:
+        measurements = queue.get(timeout=1)
+    except Empty:
+        raise RuntimeError(f"{stage} died with exit code {process.exitcode}")
+    if "error" in measurements:
+        raise RuntimeError(f"{stage} failed: {measurements['error']}")
+
+    input_bytes = stage_input_bytes(stage, settings)
+    measurements["input_mb"] = input_bytes / 2 ** 20
+    # Files per second is over the crawl files for every stage, the end-to-end throughput of the pipeline
+    measurements["files_per_second"] = settings["file_count"] / measurements["seconds"]
+    measurements["mb_per_second"] = measurements["input_mb"] / measurements["seconds"]
+    report_path = settings["results_folder"] + "run_report_" + LOCATION + VERSION + ".json"
+    if stage == "analysis" and os.path.exists(report_path):
+        # Stage times and counters inside the analysis, see process_output.build_run_report
+        with open(report_path) as f:
+            measurements["run_report"] = json.load(f)
+    return measurements
+
+def run_benchmark(settings : dict, repeat : int = 1):
+    """
+    Run every stage repeat times on the corpus, each repetition starting from empty outputs and (unless warm_dns) an empty DNS cache.
+    Without the analysis stage, the summarization reads the outputs left in the work folder by an earlier run.
+    Returns a dict of stage -> list of measurements.
+    """
+    runs = {stage: [] for stage in settings["stages"]}
+    for _ in range(repeat):
+        if "analysis" in settings["stages"]:
+            shutil.rmtree(settings["results_folder"], ignore_errors=True)
+            os.makedirs(settings["results_folder"])
+        if not settings["warm_dns"]:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(settings["dns_cache"] + suffix):
+                    os.remove(settings["dns_cache"] + suffix)
+        for stage in settings["stages"]:
+            runs[stage].append(run_stage(stage, settings))
+    return runs
+
+def format_mb(value):
+    return "n/a" if value is None else f"{value:.0f}"
+
+def print_report(runs : dict, corpus_stats : dict):
+    print(f"{corpus_stats['files']} files, {corpus_stats['bytes'] / 2 ** 20:.1f} MB")
+    print(f"{'stage':<15}{'seconds':>10}{'files/s':>10}{'MB/s':>10}{'RSS MB':>10}{'worker MB':>11}")
+    for stage, measurements in runs.items():
+        # The median run, so one slow repetition does not skew the report
+        median = sorted(measurements, key=lambda run: run["seconds"])[len(measurements) // 2]
+        print(f"{stage:<15}{median['seconds']:>10.2f}{median['files_per_second']:>10.0f}{median['mb_per_second']:>10.1f}"
+              f"{format_mb(median['peak_rss_mb']):>10}{format_mb(median['workers_peak_rss_mb']):>11}")
+        if len(measurements) > 1:
+            print(f"{'':<15}{statistics.pstdev(run['seconds'] for run in measurements):>10.2f} s standard deviation over {len(measurements)} runs")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis and summarization on a synthetic corpus, offline")
+    parser.add_argument("--corpus", help="existing corpus folder, a new one is generated if not given")
+    parser.add_argument("--rank-file", help="rank file of an existing corpus")
+    parser.add_argument("--work-folder", help="folder for the corpus and outputs, a temporary one is removed afterwards if not given")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=5, help="analysis worker processes")
+    parser.add_argument("--format", choices=["csv", "parquet", "normalized"], default="csv", help="results format")
+    parser.add_argument("--worker-shards", action="store_true", help="let the analysis workers write their own output shards")
+    parser.add_argument("--sort-by", choices=["rank", "tested_url"], help="sort the rows merged from the worker shards")
+    parser.add_argument("--chunk-rows", type=int, help="summarize in chunks of this many rows")
+    parser.add_argument("--approximate", action="store_true", help="summarize with HyperLogLog sketches")
+    parser.add_argument("--dns-localhost-rate", type=float, default=0.1, help="fraction of hostnames the fake DNS resolves to 127.0.0.1")
+    parser.add_argument("--dns-failure-rate", type=float, default=0.02, help="fraction of hostnames the fake DNS does not resolve")
+    parser.add_argument("--dns-latency", type=float, default=0.0, help="seconds per fake DNS lookup")
+    parser.add_argument("--warm-dns", action="store_true", help="keep the DNS cache between repetitions")
+    parser.add_argument("--shards", choices=list(CODECS), help="pack the generated corpus into shards of this codec and benchmark on those")
+    parser.add_argument("--json", help="also write the measurements to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the stages instead of logging it")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="crawl_benchmark_")
+    os.makedirs(work_folder, exist_ok=True)
+    work_folder = os.path.abspath(work_folder)
+    try:
+        if args.corpus:
+            corpus = os.path.abspath(args.corpus)
+            rank_file = os.path.abspath(args.rank_file) if args.rank_file else os.path.join(work_folder, "rank.csv")
+            if not args.rank_file:
+                # Without ranks every page is unranked
+                with open(rank_file, "w") as f:
+                    f.write("origin,crux_rank\n")
+            corpus_stats = {"files": sum(os.path.basename(file) != "metadata.json" for file, _key in list_crawl_files(corpus + "/")),
+                            "bytes": folder_bytes(corpus)}
+        else:
+            corpus = os.path.join(work_folder, "corpus")
+            rank_file = os.path.join(work_folder, "rank.csv")
+            shutil.rmtree(corpus, ignore_errors=True)
+            start = time.perf_counter()
+            corpus_stats = generate_corpus(corpus, args.files, rank_file, args.seed, **corpus_parameters(args))
+            print(f"Generated the corpus in {time.perf_counter() - start:.1f}s")
+            if args.shards:
+                start = time.perf_counter()
+                shard_folder = os.path.join(work_folder, "shards")
+                shutil.rmtree(shard_folder, ignore_errors=True)
+                pack_folder(corpus, shard_folder, args.shards)
+                corpus = shard_folder
+                print(f"Packed the corpus in {time.perf_counter() - start:.1f}s, {folder_bytes(corpus) / 2 ** 20:.1f} MB")
+
+        settings = {
+            "corpus": corpus,
+            "rank_file": rank_file,
+            "work_folder": work_folder,
+            "results_folder": os.path.join(work_folder, "results") + "/",
+            "dns_cache": os.path.join(work_folder, "dns_cache.sqlite"),
+            "file_count": corpus_stats["files"],
+            "stages": args.stages,
+            "workers": args.workers,
+            "format": args.format,
+            "worker_shards": args.worker_shards,
+            "sort_by": args.sort_by,
+            "chunk_rows": args.chunk_rows,
+            "approximate": args.approximate,
+            "dns_localhost_rate": args.dns_localhost_rate,
+            "dns_failure_rate": args.dns_failure_rate,
+            "dns_latency": args.dns_latency,
+            "warm_dns": args.warm_dns,
+            "seed": args.seed,
+            "verbose": args.verbose,
+        }
+        runs = run_benchmark(settings, args.repeat)
+        print_report(runs, corpus_stats)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"corpus": corpus_stats, "settings": settings, "runs": runs}, f, indent=4)
+    finally:
+        if not args.work_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import glob
+import itertools
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from results_io import iter_results
+
+KEY_COLUMNS = ["final_url", "script_domain", "port_num"]
+CHUNK_ROWS = 1_000_000
+# Multiplier that combines the hashes of the key columns into the hash of a key
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def canonical_value(value, column : str):
+    """
+    Canonical string of a key value, the same whether it was read from CSV or Parquet.
+    Missing values are "", ports are integers ("8080" for 8080, 8080.0 or "8080").
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    if column == "port_num":
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return str(value)
+        if number.is_integer():
+            return str(int(number))
+    return str(value)
+
+def key_hashes(chunk : pd.DataFrame, key_columns : list = KEY_COLUMNS):
+    """
+    Hash the keys of the rows of a results chunk to uint64.
+    Every column goes through its distinct values only, which are canonicalized and hashed with pandas' fixed-key SipHash,
+    so the hashes of the same key are the same in every crawl, run and format.
+    """
+    hashes = np.zeros(len(chunk), dtype=np.uint64)
+    for column in key_columns:
+        codes, uniques = pd.factorize(chunk[column], use_na_sentinel=False)
+        canonical = np.array([canonical_value(value, column) for value in uniques], dtype=object)
+        column_hashes = pd.util.hash_array(canonical)[codes] if len(canonical) else np.zeros(0, dtype=np.uint64)
+        hashes = hashes * HASH_MULTIPLIER + column_hashes
+    return hashes
+
+def read_chunks(path : str, columns : list = None, chunk_rows : int = CHUNK_ROWS):
+    """
+    Read a results output in chunks, CSV values stay strings as written.
+    """
+    return iter_results(path, columns, chunk_rows, dtype=str)
+
+class CrawlIndex:
+    """
+    Set of the distinct keys of a crawl's results (by default its (final_url, script_domain, port_num) triples),
+    stored as a sorted array of 64-bit key hashes: 8 bytes per distinct key, whatever the size of the results.
+    Two different keys share a hash with a probability of about n**2 / 2**65 for n keys, negligible at crawl sizes.
+    """
+    def __init__(self, hashes, key_columns : list = KEY_COLUMNS):
+        self.hashes = hashes
+        self.key_columns = list(key_columns)
+
+    @classmethod
+    def build(cls, path : str, key_columns : list = KEY_COLUMNS, chunk_rows : int = CHUNK_ROWS):
+        """
+        Index a results output in one streaming pass.
+        """
+        parts = []
+        for chunk in read_chunks(path, key_columns, chunk_rows):
+            parts.append(np.unique(key_hashes(chunk, key_columns)))
+        hashes = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.uint64)
+        return cls(hashes, key_columns)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def check_compatible(self, other : "CrawlIndex"):
+        if other.key_columns != self.key_columns:
+            raise ValueError(f"Cannot compare crawls keyed by {self.key_columns} and {other.key_columns}")
+
+    def contains(self, hashes):
+        """
+        Check which of the given key hashes are in the index.
+        Returns a boolean array.
+        """
+        positions = np.searchsorted(self.hashes, hashes)
+        found = positions < len(self.hashes)
+        found[found] = self.hashes[positions[found]] == hashes[found]
+        return found
+
+    def __and__(self, other : "CrawlIndex"):
+        self.check_compatible(other)
+        return CrawlIndex(np.intersect1d(self.hashes, other.hashes, assume_unique=True), self.key_columns)
+
+    def __or__(self, other : "CrawlIndex"):
+        self.check_compatible(other)
+        return CrawlIndex(np.union1d(self.hashes, other.hashes), self.key_columns)
+
+    def __sub__(self, other : "CrawlIndex"):
+        self.check_compatible(other)
+        return CrawlIndex(np.setdiff1d(self.hashes, other.hashes, assume_unique=True), self.key_columns)
+
+def index_path_for(path : str, key_columns : list = KEY_COLUMNS):
+    return path.rstrip("/\\") + "." + "-".join(key_columns) + ".keys.npy"
+
+def results_mtime(path : str):
+    """
+    Modification time of a results output, the newest part or table for a Parquet or normalized directory.
+    """
+    if os.path.isdir(path):
+        return max((os.path.getmtime(part) for part in glob.glob(os.path.join(path, "*.parquet")) + glob.glob(os.path.join(path, "*.csv"))), default=0)
+    return os.path.getmtime(path)
+
+def open_crawl_index(path : str, key_columns : list = KEY_COLUMNS):
+    """
+    Open the key index of a results output, (re)building and saving it next to the output if it is missing or older than the output.
+    """
+    index_path = index_path_for(path, key_columns)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= results_mtime(path):
+        return CrawlIndex(np.load(index_path), key_columns)
+    index = CrawlIndex.build(path, key_columns)
+    temp_path = index_path + ".tmp.npy"
+    np.save(temp_path, index.hashes)
+    os.replace(temp_path, index_path)
+    return index
+
+def diff(old : CrawlIndex, new : CrawlIndex):
+    """
+    Compare two crawls.
+    Returns a dict with the keys "added" (only in new), "removed" (only in old) and "common" as CrawlIndex.
+    """
+    return {"added": new - old, "removed": old - new, "common": old & new}
+
+class CrawlComparison:
+    """
+    N-way comparison of crawls: which crawls every key of their union appears in.
+    """
+    def __init__(self, indexes : dict):
+        self.names = list(indexes)
+        indexes = list(indexes.values())
+        for index in indexes[1:]:
+            indexes[0].check_compatible(index)
+        self.key_columns = indexes[0].key_columns if indexes else KEY_COLUMNS
+        self.union = np.unique(np.concatenate([index.hashes for index in indexes])) if indexes else np.zeros(0, dtype=np.uint64)
+        # One row per key of the union, one column per crawl
+        self.membership = np.column_stack([index.contains(self.union) for index in indexes]) if indexes else np.zeros((0, 0), dtype=bool)
+
+    def keys(self, present : list = (), absent : list = ()):
+        """
+        Get the keys that are in all crawls of present and in none of absent, the other crawls do not matter.
+        e.g. keys(present=["consent"], absent=["no_consent"]) for the keys only seen with consent.
+        """
+        mask = np.ones(len(self.union), dtype=bool)
+        for name in present:
+            mask &= self.membership[:, self.names.index(name)]
+        for name in absent:
+            mask &= ~self.membership[:, self.names.index(name)]
+        return CrawlIndex(self.union[mask], self.key_columns)
+
+    def pattern_counts(self):
+        """
+        Count the keys of every membership pattern, i.e. every combination of crawls a key appears in exactly.
+        Returns a DataFrame with one boolean column per crawl and a count column, largest first.
+        """
+        patterns, counts = np.unique(self.membership, axis=0, return_counts=True) if len(self.union) else (np.zeros((0, len(self.names)), dtype=bool), [])
+        table = pd.DataFrame(patterns, columns=self.names)
+        table["count"] = counts
+        return table.sort_values("count", ascending=False, kind="stable").reset_index(drop=True)
+
+def select_rows(path : str, keys : CrawlIndex, chunk_rows : int = CHUNK_ROWS):
+    """
+    Stream the rows of a results output whose key is in keys, e.g. the rows of the new crawl behind diff()["added"].
+    Yields DataFrame chunks.
+    """
+    for chunk in read_chunks(path, chunk_rows=chunk_rows):
+        selected = chunk[keys.contains(key_hashes(chunk, keys.key_columns))]
+        if len(selected):
+            yield selected
+
+def mark_rows(path : str, keys : CrawlIndex, column : str, output_path : str, chunk_rows : int = CHUNK_ROWS):
+    """
+    Copy a results output to a CSV file with an added boolean column that says whether the key of the row is in keys.
+    """
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        for number, chunk in enumerate(read_chunks(path, chunk_rows=chunk_rows)):
+            chunk[column] = keys.contains(key_hashes(chunk, keys.key_columns))
+            chunk.to_csv(f, header=number == 0, index=False)
+
+if __name__ == "__main__":
+    # Compare crawls: python crawl_diff.py results_a.csv results_b.csv [...]
+    paths = sys.argv[1:]
+    indexes = {path: open_crawl_index(path) for path in paths}
+    for old_path, new_path in itertools.combinations(paths, 2):
+        counts = {name: len(keys) for name, keys in diff(indexes[old_path], indexes[new_path]).items()}
+        print(f"{old_path} -> {new_path}: {counts['added']} added, {counts['removed']} removed, {counts['common']} common")
+    if len(paths) > 2:
+        print(CrawlComparison(indexes).pattern_counts().to_string(index=False))
@@ -0,0 +1,406 @@
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import zlib
+from array import array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A crawl file inside a shard is addressed as <shard path>#<original file name>
+RECORD_SEPARATOR = "#"
+CODECS = {"gzip": (0, ".jsonl.gz"), "zstd": (1, ".jsonl.zst")}
+SHARD_SUFFIXES = tuple(suffix for _codec_id, suffix in CODECS.values())
+DEFAULT_SHARD_BYTES = 256 * 2 ** 20
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 9}
+# Magic, format version, codec id, number of records, size of the names blob
+HEADER = struct.Struct("=8sIIII")
+MAGIC = b"SHARDIX" + (b"L" if sys.byteorder == "little" else b"B")
+FORMAT_VERSION = 1
+
+def url_hash(url : str):
+    """
+    Key of a page in the shard indexes: the first 8 bytes of the SHA-1 of its initial url, like the file names of the crawler.
+    """
+    return int.from_bytes(hashlib.sha1(url.encode("utf-8")).digest()[:8], "big")
+
+def index_path_for(shard_path : str):
+    return shard_path + ".idx"
+
+def is_shard(path : str):
+    return path.endswith(SHARD_SUFFIXES)
+
+def is_shard_record(path : str):
+    return RECORD_SEPARATOR in path and is_shard(path.rsplit(RECORD_SEPARATOR, 1)[0])
+
+# zstd contexts of this process, reused across records
+zstd_compressors = {}
+zstd_decompressor = None
+
+def compress_record(line : bytes, codec : str, level : int):
+    """
+    Compress one JSON line into a frame of its own (a zstd frame or a gzip member), so every record can be read without the others
+    while the shard as a whole stays a valid multi-frame stream for zstdcat/zcat.
+    """
+    if codec == "zstd":
+        compressor = zstd_compressors.get(level)
+        if compressor is None:
+            compressor = zstd_compressors[level] = zstandard.ZstdCompressor(level=level)
+        return compressor.compress(line)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(line) + compressor.flush()
+
+def decompress_record(frame : bytes, codec_id : int):
+    global zstd_decompressor
+    if codec_id == CODECS["zstd"][0]:
+        if zstandard is None:
+            raise ImportError("zstandard is needed to read .jsonl.zst shards")
+        if zstd_decompressor is None:
+            zstd_decompressor = zstandard.ZstdDecompressor()
+        return zstd_decompressor.decompress(frame)
+    return zlib.decompress(frame, 31)
+
+class ShardIndex:
+    """
+    Read-only, memory-mapped offset index of a shard, written next to it as <shard>.idx.
+    Records are kept in shard order: their start offsets (plus the end of the shard), url hashes and file names,
+    followed by the record numbers sorted by url hash for the lookups.
+    """
+    def __init__(self, index_path : str):
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.codec_id, self.count, _names_size = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{index_path} is not a shard index of this version and platform")
+        view = memoryview(self.data)
+        offsets_start = HEADER.size
+        hashes_start = offsets_start + 8 * (self.count + 1)
+        name_offsets_start = hashes_start + 8 * self.count
+        by_hash_start = name_offsets_start + 4 * (self.count + 1)
+        self.names_start = by_hash_start + 4 * self.count
+        self.offsets = view[offsets_start:hashes_start].cast("Q")
+        self.hashes = view[hashes_start:name_offsets_start].cast("Q")
+        self.name_offsets = view[name_offsets_start:by_hash_start].cast("I")
+        self.by_hash = view[by_hash_start:self.names_start].cast("I")
+        self.numbers = None
+
+    def __len__(self):
+        return self.count
+
+    def name(self, number : int):
+        return self.data[self.names_start + self.name_offsets[number]:self.names_start + self.name_offsets[number + 1]].decode("utf-8")
+
+    def span(self, number : int):
+        """
+        Offset and length of a record in the shard.
+        """
+        return self.offsets[number], self.offsets[number + 1] - self.offsets[number]
+
+    def number(self, name : str):
+        """
+        Get the number of the record packed from the file name.
+        Returns None if the shard has no such record.
+        """
+        if self.numbers is None:
+            self.numbers = {self.name(number): number for number in range(self.count)}
+        return self.numbers.get(name)
+
+    def find(self, url : str):
+        """
+        Binary search the records of a page by its initial url.
+        Returns the list of their numbers, empty if the page is not in the shard.
+        """
+        key = url_hash(url)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.hashes[self.by_hash[middle]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        numbers = []
+        while low < self.count and self.hashes[self.by_hash[low]] == key:
+            numbers.append(self.by_hash[low])
+            low += 1
+        return numbers
+
+def write_shard_index(index_path : str, codec : str, offsets : list, hashes : list, names : list):
+    """
+    Write the index of a shard from the start offsets of its records (plus the end of the shard), their url hashes and file names.
+    """
+    encoded_names = [name.encode("utf-8") for name in names]
+    name_offsets = array("I", [0])
+    for name in encoded_names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    by_hash = array("I", sorted(range(len(hashes)), key=hashes.__getitem__))
+    blob = b"".join(encoded_names)
+
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, CODECS[codec][0], len(hashes), len(blob)))
+        array("Q", offsets).tofile(f)
+        array("Q", hashes).tofile(f)
+        name_offsets.tofile(f)
+        by_hash.tofile(f)
+        f.write(blob)
+    os.replace(temp_path, index_path)
+
+class CrawlShard:
+    """
+    A shard of packed crawl files with its index, records are read with positioned reads of the shard.
+    """
+    def __init__(self, shard_path : str):
+        self.path = shard_path
+        self.index = ShardIndex(index_path_for(shard_path))
+        self.file = open(shard_path, "rb")
+        self.pid = os.getpid()
+
+    def read_span(self, offset : int, length : int):
+        if hasattr(os, "pread"):
+            return os.pread(self.file.fileno(), length, offset)
+        if self.pid != os.getpid():
+            # The file position is shared with the parent after a fork
+            self.file = open(self.path, "rb")
+            self.pid = os.getpid()
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def decompress(self, number : int, frame : bytes):
+        if len(frame) < self.index.span(number)[1]:
+            raise EOFError(f"Record {self.index.name(number)} of {self.path} is truncated")
+        return decompress_record(frame, self.index.codec_id)
+
+    def read(self, number : int):
+        """
+        Read a record.
+        Returns the JSON bytes of the crawl file.
+        """
+        return self.decompress(number, self.read_span(*self.index.span(number)))
+
+    def read_name(self, name : str):
+        number = self.index.number(name)
+        if number is None:
+            raise FileNotFoundError(f"{name} is not in {self.path}")
+        return self.read(number)
+
+    def find(self, url : str):
+        """
+        Read the crawls of a page by its initial url.
+        Returns a list of crawl dicts, empty if the page is not in the shard.
+        """
+        return [json.loads(self.read(number)) for number in self.index.find(url)]
+
+    def __iter__(self):
+        """
+        Iterate over (file name, JSON bytes) of all records in shard order, reading the shard sequentially.
+        """
+        with open(self.path, "rb") as f:
+            for number in range(len(self.index)):
+                _offset, length = self.index.span(number)
+                yield self.index.name(number), self.decompress(number, f.read(length))
+
+# Shards opened by this process, by path
+open_shards = {}
+
+def get_shard(shard_path : str):
+    shard = open_shards.get(shard_path)
+    if shard is None:
+        shard = open_shards[shard_path] = CrawlShard(shard_path)
+    return shard
+
+def split_record_path(path : str):
+    """
+    Split the path of a record into shard path and file name.
+    """
+    shard_path, name = path.rsplit(RECORD_SEPARATOR, 1)
+    return shard_path, name
+
+def read_crawl_bytes(path : str):
+    """
+    Read a crawl file, either a JSON file or a record of a shard.
+    Returns its JSON bytes.
+    """
+    if is_shard_record(path):
+        shard_path, name = split_record_path(path)
+        return get_shard(shard_path).read_name(name)
+    with open(path, "rb") as f:
+        return f.read()
+
+def load_crawl(path : str):
+    """
+    Load a crawl file or shard record as a dict.
+    """
+    return json.loads(read_crawl_bytes(path))
+
+def stored_size(path : str):
+    """
+    Bytes a crawl file takes on disk, compressed for a shard record.
+    """
+    if is_shard_record(path):
+        shard_path, name = split_record_path(path)
+        index = get_shard(shard_path).index
+        number = index.number(name)
+        if number is None:
+            raise FileNotFoundError(f"{name} is not in {shard_path}")
+        return index.span(number)[1]
+    return os.path.getsize(path)
+
+def crawl_file_key(path : str):
+    """
+    Key of a crawl file or shard record for the processing manifest, the same as list_crawl_files gives it.
+    """
+    if is_shard_record(path):
+        return stored_size(path), os.stat(split_record_path(path)[0]).st_mtime_ns
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def list_crawl_files(folder : str, with_shards : bool = True):
+    """
+    List the crawl files in a folder: its .json files and, if with_shards, the records of its indexed shards.
+    The key of a record is its compressed size and the modification time of its shard, like file_key() of a file.
+    Returns a list of (path, (size, mtime_ns)), paths start with folder like folder + file name.
+    """
+    files = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((folder + entry.name, (stat.st_size, stat.st_mtime_ns)))
+            elif with_shards and is_shard(entry.name) and os.path.exists(index_path_for(entry.path)):
+                mtime_ns = entry.stat().st_mtime_ns
+                index = ShardIndex(index_path_for(entry.path))
+                for number in range(len(index)):
+                    files.append((folder + entry.name + RECORD_SEPARATOR + index.name(number), (index.span(number)[1], mtime_ns)))
+    return files
+
+def pack_file(task):
+    """
+    Compact and compress one crawl file for the packer.
+    Returns the file name, its initial url and the compressed record, or None for the record if the file is not valid JSON.
+    """
+    path, codec, level = task
+    name = os.path.basename(path)
+    try:
+        with open(path, "rb") as f:
+            crawl = json.loads(f.read())
+    except (ValueError, UnicodeDecodeError):
+        return name, None, None
+    line = json.dumps(crawl, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+    initial_url = crawl.get("initialUrl") if isinstance(crawl, dict) else None
+    return name, initial_url or "", compress_record(line, codec, level)
+
+class ShardWriter:
+    """
+    Writes records to numbered shards <prefix>-00000<suffix>, ... of at most shard_bytes each (one record at least),
+    every shard is written to a temporary file and gets its index once it is complete.
+    """
+    def __init__(self, output_folder : str, codec : str, shard_bytes : int, prefix : str = "crawl"):
+        self.output_folder = output_folder
+        self.codec = codec
+        self.shard_bytes = shard_bytes
+        self.prefix = prefix
+        self.shard_paths = []
+        self.file = None
+
+    def open_shard(self):
+        path = os.path.join(self.output_folder, f"{self.prefix}-{len(self.shard_paths):05d}{CODECS[self.codec][1]}")
+        self.shard_paths.append(path)
+        self.file = open(path + ".tmp", "wb")
+        self.offsets = [0]
+        self.hashes = []
+        self.names = []
+
+    def write(self, name : str, initial_url : str, record : bytes):
+        if self.file is not None and self.offsets[-1] + len(record) > self.shard_bytes:
+            self.close_shard()
+        if self.file is None:
+            self.open_shard()
+        self.file.write(record)
+        self.offsets.append(self.offsets[-1] + len(record))
+        self.hashes.append(url_hash(initial_url))
+        self.names.append(name)
+
+    def close_shard(self):
+        path = self.shard_paths[-1]
+        self.file.close()
+        self.file = None
+        os.replace(path + ".tmp", path)
+        write_shard_index(index_path_for(path), self.codec, self.offsets, self.hashes, self.names)
+
+    def close(self):
+        if self.file is not None:
+            self.close_shard()
+
+def pack_folder(input_folder : str, output_folder : str, codec : str = None, level : int = None,
+                shard_bytes : int = DEFAULT_SHARD_BYTES, workers : int = None):
+    """
+    Pack the .json crawl files of a folder into compressed JSON-lines shards with offset indexes in output_folder.
+    metadata.json and files that are not valid JSON (e.g. empty files of failed crawls) are copied as they are,
+    so the analysis still sees and reports them.
+    Returns the list of shard paths and the list of copied files.
+    """
+    codec = codec or ("zstd" if zstandard is not None else "gzip")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("zstandard is needed for zstd shards")
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    os.makedirs(output_folder, exist_ok=True)
+    names = sorted(name for name in os.listdir(input_folder) if name.endswith(".json"))
+    copied = []
+    tasks = []
+    for name in names:
+        if name == "metadata.json":
+            shutil.copy2(os.path.join(input_folder, name), os.path.join(output_folder, name))
+            copied.append(name)
+        else:
+            tasks.append((os.path.join(input_folder, name), codec, level))
+
+    writer = ShardWriter(output_folder, codec, shard_bytes)
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the order of the files, so packing the same folder twice gives the same shards
+        for name, initial_url, record in pool.imap(pack_file, tasks, chunksize=16):
+            if record is None:
+                shutil.copy2(os.path.join(input_folder, name), os.path.join(output_folder, name))
+                copied.append(name)
+            else:
+                writer.write(name, initial_url, record)
+    writer.close()
+    return writer.shard_paths, copied
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack crawl folders into indexed, compressed JSON-lines shards and read them back")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="pack the crawl files of a folder")
+    pack.add_argument("input_folder")
+    pack.add_argument("output_folder")
+    pack.add_argument("--codec", choices=list(CODECS))
+    pack.add_argument("--level", type=int)
+    pack.add_argument("--shard-mb", type=int, default=DEFAULT_SHARD_BYTES // 2 ** 20)
+    pack.add_argument("--workers", type=int)
+    get = commands.add_parser("get", help="print the crawls of a page from a shard folder")
+    get.add_argument("folder")
+    get.add_argument("url", help="initial url of the page")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        shards, copied = pack_folder(args.input_folder, args.output_folder, args.codec, args.level, args.shard_mb * 2 ** 20, args.workers)
+        packed_bytes = sum(os.path.getsize(path) for path in shards)
+        print(f"Packed into {len(shards)} shards of {packed_bytes / 2 ** 20:.1f} MB in total, copied {len(copied)} files as they are")
+    else:
+        for name in sorted(os.listdir(args.folder)):
+            if is_shard(name) and os.path.exists(index_path_for(os.path.join(args.folder, name))):
+                for crawl in get_shard(os.path.join(args.folder, name)).find(args.url):
+                    print(json.dumps(crawl, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+LOCALHOST_IPS = {"127.0.0.1", "::1", "0.0.0.0"}
+DNS_CONCURRENCY = 256
+DNS_TIMEOUT = 2
+
+DNS_CACHE_TTL = 7 * 24 * 3600
+# Hostnames that did not resolve (or timed out) are retried sooner
+DNS_NEGATIVE_TTL = 24 * 3600
+SQLITE_MAX_VARIABLES = 500
+
+# Function hostname -> list of addresses used instead of the system resolver if set,
+# e.g. the offline FakeDns of synthetic_corpus.py for benchmarks
+custom_resolver = None
+
+class DnsCache:
+    """
+    Persistent hostname -> addresses cache in SQLite, shared across runs and worker processes.
+    The database runs in WAL mode, so readers never block the single writer.
+    Every process has to open its own DnsCache, connections must not be shared across a fork.
+    Entries resolved before refresh_before are treated as expired, which is used to force a refresh.
+    """
+    def __init__(self, path : str, ttl : float = DNS_CACHE_TTL, negative_ttl : float = DNS_NEGATIVE_TTL, refresh_before : float = 0):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_before = refresh_before
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dns_cache ("
+            "hostname TEXT PRIMARY KEY, addresses TEXT NOT NULL, resolved_at REAL NOT NULL, ttl REAL NOT NULL)"
+        )
+
+    def is_fresh(self, resolved_at : float, ttl : float, now : float):
+        """
+        Check if an entry resolved at resolved_at can still be used.
+        """
+        return resolved_at >= self.refresh_before and resolved_at + ttl > now
+
+    def get(self, hostname : str):
+        """
+        Get the cached addresses of hostname.
+        Returns None if the hostname is not cached or its entry expired.
+        """
+        row = self.connection.execute(
+            "SELECT addresses, resolved_at, ttl FROM dns_cache WHERE hostname = ?", (hostname,)
+        ).fetchone()
+        if row is None or not self.is_fresh(row[1], row[2], time.time()):
+            return None
+        return json.loads(row[0])
+
+    def get_many(self, hostnames):
+        """
+        Get the cached addresses of several hostnames.
+        Returns a dict of hostname -> addresses for the hostnames with a fresh entry.
+        """
+        hostnames = list(hostnames)
+        now = time.time()
+        found = {}
+        for i in range(0, len(hostnames), SQLITE_MAX_VARIABLES):
+            batch = hostnames[i:i + SQLITE_MAX_VARIABLES]
+            rows = self.connection.execute(
+                "SELECT hostname, addresses, resolved_at, ttl FROM dns_cache WHERE hostname IN (" + ",".join("?" * len(batch)) + ")",
+                batch
+            )
+            for hostname, addresses, resolved_at, ttl in rows:
+                if self.is_fresh(resolved_at, ttl, now):
+                    found[hostname] = json.loads(addresses)
+        return found
+
+    def put_many(self, resolved : dict):
+        """
+        Store the addresses of several hostnames in one transaction.
+        """
+        now = time.time()
+        rows = [
+            (hostname, json.dumps(addresses), now, self.ttl if addresses else self.negative_ttl)
+            for hostname, addresses in resolved.items()
+        ]
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("INSERT OR REPLACE INTO dns_cache VALUES (?, ?, ?, ?)", rows)
+
+    def put(self, hostname : str, addresses : list):
+        """
+        Store the addresses of a hostname.
+        """
+        self.put_many({hostname: addresses})
+
+    def close(self):
+        self.connection.close()
+
+def lookup_addresses(hostname : str):
+    """
+    Resolve hostname with custom_resolver if set, else the system resolver (getaddrinfo, so IPv4 and IPv6 and /etc/hosts).
+    Every lookup of the analysis goes through here, so a hostname gets the same answer whichever path resolved it first.
+    Returns the sorted list of its addresses.
+    """
+    if custom_resolver is not None:
+        return sorted(set(custom_resolver(hostname)))
+    return sorted({info[4][0] for info in socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)})
+
+async def resolve_hostname(loop, semaphore : asyncio.Semaphore, hostname : str, timeout : float):
+    """
+    Resolve a single hostname, waiting at most timeout seconds.
+    Returns the hostname and the sorted list of its addresses, empty if it could not be resolved.
+    """
+    async with semaphore:
+        try:
+            return hostname, await asyncio.wait_for(loop.run_in_executor(None, lookup_addresses, hostname), timeout)
+        except (asyncio.TimeoutError, OSError, UnicodeError, ValueError):
+            return hostname, []
+
+async def resolve_all(hostnames, concurrency : int, timeout : float):
+    """
+    Resolve all hostnames concurrently, with at most concurrency lookups in flight.
+    Returns a dict of hostname -> list of addresses.
+    """
+    loop = asyncio.get_running_loop()
+    # getaddrinfo runs in the default executor, so size it to the concurrency bound
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(resolve_hostname(loop, semaphore, hostname, timeout) for hostname in hostnames))
+    return dict(results)
+
+def resolve_hostnames(hostnames, concurrency : int = DNS_CONCURRENCY, timeout : float = DNS_TIMEOUT, cache : DnsCache = None, stats=None):
+    """
+    Resolve a batch of distinct hostnames with a bounded asyncio resolver.
+    If a cache is given, only the hostnames without a fresh entry are resolved and the results are stored in it.
+    The cache hits and lookups are counted in stats (a RunStats) if given.
+    Returns a dict of hostname -> list of addresses.
+    """
+    hostnames = set(hostnames)
+    resolved = cache.get_many(hostnames) if cache is not None else {}
+    missing = sorted(hostnames.difference(resolved))
+    if stats is not None:
+        stats.count("dns_cache_hits", len(resolved))
+        stats.count("dns_lookups", len(missing))
+    if not missing:
+        return resolved
+
+    newly_resolved = asyncio.run(resolve_all(missing, concurrency, timeout))
+    if cache is not None:
+        cache.put_many(newly_resolved)
+    resolved.update(newly_resolved)
+    return resolved
+
+def points_to_localhost(addresses):
+    """
+    Check if any of the resolved addresses is a localhost address.
+    """
+    return any(ip in LOCALHOST_IPS for ip in addresses)
@@ -1,4 +1,4 @@
-import pandas as pd
+from crawl_diff import open_crawl_index, mark_rows
 
 # version = "_frankfurt_100k"
 # version = "_new_york_100k"
@@ -21,16 +21,12 @@ requests_file_consent = "results/Yandex_sites" + version_consent + ".csv"
 version_result = "_new_york"
 
 def main():
-    webRTC_df = pd.read_csv(webRTC_file)
-    requests_df = pd.read_csv(requests_file)
-    webRTC_consent_df = pd.read_csv(webRTC_file_consent)
-    requests_consent_df = pd.read_csv(requests_file_consent)
+    # Index the final urls of the crawls without consent once, then stream the consent crawls past them
+    webRTC_index = open_crawl_index(webRTC_file, ['final_url'])
+    requests_index = open_crawl_index(requests_file, ['final_url'])
 
-    webRTC_consent_df['sends_before_consent'] = webRTC_consent_df['final_url'].isin(webRTC_df['final_url'])
-    requests_consent_df['sends_before_consent'] = requests_consent_df['final_url'].isin(requests_df['final_url'])
-
-    webRTC_consent_df.to_csv("results/Facebook_sites" + version_result + ".csv", index=False)
-    requests_consent_df.to_csv("results/Yandex_sites" + version_result + ".csv", index=False)
+    mark_rows(webRTC_file_consent, webRTC_index, 'sends_before_consent', "results/Facebook_sites" + version_result + ".csv")
+    mark_rows(requests_file_consent, requests_index, 'sends_before_consent', "results/Yandex_sites" + version_result + ".csv")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,11 +1,12 @@
-import json
-import glob
-import re
 import csv
 from tld import get_fld
 from urllib.parse import urlparse
 from collections import defaultdict
 
+from port_results import PortResults
+from crawl_shards import list_crawl_files, load_crawl
+from webrtc_candidates import candidate_ports
+
 input_folder = "new_york_data/data\\"
 # input_folder = "frankfurt_data/data\\"
 results_folder = "results/"
@@ -15,7 +16,6 @@ version = "_new_york_100k"
 SCRIPT_URL_CUTOFF = 512
 INCLUDE_SDP_LOCAL = False
 
-files = glob.glob(input_folder + '*.json', recursive = False)
 
 def is_localhost_request(url : str):
     """
@@ -73,7 +73,7 @@ def analyze_request_data(request_data : list):
         if not request_result:
             continue
 
-        port = request_result["port"]
+        port = request_result["port_num"]
         script_domain = request_result["script_domain"]
         if request_result["protocol"] == "HTTP":
             HTTP_results[port].add(script_domain)
@@ -82,19 +82,6 @@ def analyze_request_data(request_data : list):
 
     return HTTP_results, websocket_results
 
-def extract_ports(candidate_string):
-    """
-    Extracts port numbers from a WebRTC candidate.
-    Returns a list of port numbers or ["N/A"] if none are found.
-    """
-    # Define regex patterns
-    ip_port_pattern = re.findall(r'(\d+\.\d+\.\d+\.\d+)\s+(\d+)', candidate_string)
-    sctp_port_pattern = re.findall(r'a=sctp-port:(\d+)', candidate_string)
-    
-    # Extract ports from matches
-    ports = [port for _, port in ip_port_pattern] + sctp_port_pattern
-    return ports if ports else ["N/A"]
-
 def analyze_webRTC_call(webRTC_call : dict):
     """
     Analyze a request call for setting up a localhost connection.
@@ -111,7 +98,7 @@ def analyze_webRTC_call(webRTC_call : dict):
         return [], ""
 
     candidate = webRTC_call.get("candidate", "")
-    all_ports = set(extract_ports(candidate))
+    all_ports = candidate_ports(candidate)
 
     initiator = webRTC_call.get("source", "Unknown")
     initiator_domain = get_fld(initiator, fail_silently=True)
@@ -138,15 +125,13 @@ def analyze_file(file_name : str):
     Analyze the file for any localhost requests or WebRTC calls.
     Returns two lists for both request results and WebRTC results.
     """
-    # Load the data from the .json file
-    f = open(file_name, encoding="utf-8") 
-    file_data = json.load(f)
-    f.close()
+    # Load the data from the .json file or shard record
+    file_data = load_crawl(file_name)
 
     data = file_data.get("data", None)
     if not data:
         print(f"Error! No Data for {file_name}")
-        return None, None
+        return None, None, None
 
     request_data = data.get("requests", [])
     HTTP_results, websocket_results = analyze_request_data(request_data)
@@ -157,11 +142,13 @@ def analyze_file(file_name : str):
     return HTTP_results, websocket_results, webRTC_results
 
 def main():
+    # process_output.py writes the same port_results_*.json while it processes a corpus (PORT_RESULTS),
+    # this separate pass is only needed for corpora that were processed without it
     crawl_count = 0
-    HTTP_port_domain_results = defaultdict(set)
-    websocket_port_domain_results = defaultdict(set)
-    webRTC_port_domain_results = defaultdict(set)
+    port_results = PortResults()
 
+    # The .json files of the folder and the records of its shards (see crawl_shards.py)
+    files = [file for file, _key in list_crawl_files(input_folder)]
     for file in files:
         if file == input_folder + "metadata.json":
             continue
@@ -171,23 +158,16 @@ def main():
             print(crawl_count)
 
         HTTP_results, websocket_results, webRTC_results = analyze_file(file)
+        if HTTP_results is None:
+            continue
+
+        port_results.merge({
+            "HTTP_port_domain_results": HTTP_results,
+            "websocket_port_domain_results": websocket_results,
+            "webRTC_port_domain_results": webRTC_results,
+        })
 
-        for port, domains in HTTP_results.items():
-            HTTP_port_domain_results[port].update(domains)
-        for port, domains in websocket_results.items():
-            websocket_port_domain_results[port].update(domains)
-        for port, domains in webRTC_results.items():
-            webRTC_port_domain_results[port].update(domains)
-
-    results = {
-        "HTTP_port_domain_results": {port: list(domains) for port, domains in HTTP_port_domain_results.items()},
-        "websocket_port_domain_results": {port: list(domains) for port, domains in websocket_port_domain_results.items()},
-        "webRTC_port_domain_results": {port: list(domains) for port, domains in webRTC_port_domain_results.items()}
-    }
-
-    with open(results_folder + "port_results" + version + ".json", 'w', encoding='utf-8') as fp:
-        json.dump(results, fp, default=tuple, sort_keys=False, indent=4)
-        fp.close()
+    port_results.save(results_folder + "port_results" + version + ".json")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
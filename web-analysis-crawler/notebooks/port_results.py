@@ -0,0 +1,60 @@
+import json
+import os
+from collections import defaultdict
+
+PORT_RESULT_KEYS = ["HTTP_port_domain_results", "websocket_port_domain_results", "webRTC_port_domain_results"]
+
+def file_port_results(request_results : list, webRTC_results : list):
+    """
+    Build the port -> script domains maps of one file from its analysis results.
+    Requests only count if they go to a localhost variant (not to a hostname resolving to localhost),
+    script domains without a registrable domain are None, like get_fld(..., fail_silently=True) returns them.
+    Returns a dict of PORT_RESULT_KEYS -> {port: set of script domains}.
+    """
+    results = {key: defaultdict(set) for key in PORT_RESULT_KEYS}
+    for request_result in request_results or []:
+        if request_result["search_type"] == "resolves":
+            continue
+        key = "HTTP_port_domain_results" if request_result["protocol"] == "HTTP" else "websocket_port_domain_results"
+        results[key][str(request_result["port_num"])].add(request_result["script_domain"] or None)
+    for call_result in webRTC_results or []:
+        results["webRTC_port_domain_results"][str(call_result["port_num"])].add(call_result["script_domain"] or None)
+    return results
+
+class PortResults:
+    """
+    Port -> script domains maps over a whole corpus, merged from the partial maps of its files.
+    Ports are kept as strings, the keys they have in the JSON output.
+    """
+    def __init__(self):
+        self.results = {key: defaultdict(set) for key in PORT_RESULT_KEYS}
+
+    def merge(self, partial : dict):
+        for key, ports in partial.items():
+            merged = self.results[key]
+            for port, domains in ports.items():
+                merged[str(port)].update(domains)
+
+    def to_json(self):
+        return {key: {port: sorted(domains, key=lambda domain: (domain is None, domain or "")) for port, domains in ports.items()}
+                for key, ports in self.results.items()}
+
+    def save(self, path : str):
+        """
+        Write the maps to a port_results_*.json file, atomically so an interrupted run leaves the previous version.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as fp:
+            json.dump(self.to_json(), fp, indent=4)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path : str):
+        """
+        Read the maps written by save(), empty if the file does not exist.
+        """
+        port_results = cls()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                port_results.merge(json.load(fp))
+        return port_results
@@ -1,16 +1,33 @@
 import json
-import glob
 import re
 import csv
-import socket
-import subprocess
-from tld import get_fld
-from urllib.parse import urlparse
+import io
+import itertools
+import mmap
+import os
+import shutil
+import time
 from functools import lru_cache
 
-from concurrent.futures import ProcessPoolExecutor, as_completed, TimeoutError as concurrentTimeoutError
 from tqdm import tqdm
 
+from dns_resolution import DnsCache, resolve_hostnames, points_to_localhost
+from processing_manifest import ProcessingManifest, read_file_list
+from worker_pool import WatchdogPool
+from results_io import open_results_writer, merge_result_shards, restore_results, results_path, CsvResultsWriter, MERGE_RUN_ROWS
+from port_results import PortResults, file_port_results
+from crawl_shards import is_shard_record, read_crawl_bytes, stored_size, list_crawl_files, crawl_file_key
+from run_stats import RunStats, write_run_report
+import ranking_index
+from ranking_index import open_ranking, get_rank
+from webrtc_candidates import candidate_ports
+from url_classification import classify_requests, page_domain, initiator_domain
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # location = "frankfurt"
 location = "new_york"
 
@@ -37,82 +54,91 @@ LOCALHOST_IPS = {"127.0.0.1", "::1", "0.0.0.0"}
 SCRIPT_URL_CUTOFF = 512
 INCLUDE_SDP_LOCAL = False
 MAX_WORKERS = 5
+# Wall-clock budget per file, a worker stuck on a file for longer is killed and replaced
 TIMEOUT_SECONDS = 60
-
-ranking = {}
-
-
-
-@lru_cache(maxsize=100_000)
-def safe_get_fld(url):
-    """
-    Get domain with cache.
-    """
-    try:
-        return get_fld(url, fail_silently=True)
-    except Exception:
-        return None
-
-def resolves_to_localhost_with_timeout(hostname, timeout=2):
+# Each worker gets a chunk of files at a time, so only MAX_WORKERS chunks are in flight
+FILES_PER_TASK = 16
+# Replace workers after this many chunks, to cap the growth of the per-process caches
+MAX_TASKS_PER_WORKER = 500
+# Only pull initialUrl, finalUrl, data.requests and data.webRTC out of each file instead of json.load-ing everything
+STREAMING_JSON = True
+# Resolve every hostname with an explicit port once, before the analysis, instead of per worker
+PRERESOLVE_DNS = True
+# Persistent DNS cache shared by all runs, set to None to disable
+DNS_CACHE_PATH = "dns_cache.sqlite"
+# Ignore the cached entries from earlier runs and resolve everything again
+FORCE_DNS_REFRESH = False
+# Skip the files recorded in the manifest of an earlier run and append to its outputs.
+# Refused if files processed by the earlier run changed since, their old rows could not be removed from the outputs.
+RESUME = False
+# Only process the files listed in failed_*.txt and timedout_*.txt, appending to the outputs of the earlier runs whatever RESUME is
+RETRY_FAILED_ONLY = False
+MANIFEST_FLUSH_INTERVAL = 500
+# "csv", "parquet" for typed, columnar outputs (a directory of part files per output),
+# or "normalized" for a directory of CSV tables per output that stores every page, script and candidate once (see results_io.py)
+OUTPUT_FORMAT = "csv"
+# Scan the raw bytes of each file first and skip the files that cannot produce a result
+PREFILTER_FILES = True
+# Also build the port -> script domains maps of get_ports_list.py (port_results_*.json) in the same scan of the corpus
+PORT_RESULTS = True
+# Write per-stage times and counters of the run to run_report_*.json next to the outputs
+RUN_REPORT = True
+# Show the live read rate, skipped files and DNS lookups of the workers in the progress bar
+PROGRESS_STATS = True
+# Workers write their rows to their own CSV shards (shards_*/ next to the outputs) instead of sending them to the main process,
+# which only records the finished files and merges the shards into the outputs at the end of the run
+WORKER_SHARDS = False
+# Order of the rows merged from the worker shards: None (as processed), "rank" or "tested_url".
+# When appending to the outputs of earlier runs, only the rows of this run are sorted
+MERGE_SORT_BY = None
+
+# URLs with a localhost host or an explicit port, anything localhost_request_result could report
+URL_CANDIDATE_PATTERN = re.compile(rb'//(?:[^/"\s?#]*@)?(?i:localhost|127\.0\.0\.1|0\.0\.0\.0|\[::1\])|//[^/"\s?#]*:\d')
+# WebRTC calls in which the crawler detected localhost
+WEBRTC_CANDIDATE_PATTERN = re.compile(rb'"localhost":\s*"(?!None")')
+
+# hostname -> resolves to localhost, filled in each worker by init_worker when PRERESOLVE_DNS is set
+preresolved_hostnames = {}
+# Entries of the DNS cache resolved before this time are ignored, set by main() when FORCE_DNS_REFRESH is set
+dns_refresh_before = 0
+dns_cache = None
+# Output shards of this worker, set by init_worker when WORKER_SHARDS is set
+worker_shards = None
+# Stage times and counters of this process, workers send theirs to the main process after every chunk
+stats = RunStats()
+
+
+
+def get_dns_cache():
     """
-    Resolve hostname and check if it points to localhost.
+    Get the DNS cache of this process, opening it on first use.
+    Returns None if the cache is disabled.
     """
-    try:
-        # Run nslookup with timeout
-        result = subprocess.run(
-            ["nslookup", hostname],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=timeout,
-            text=True
-        )
-        output = result.stdout
-        return any(ip in LOCALHOST_IPS for ip in re.findall(r"\b(?:\d{1,3}\.){3}\d{1,3}\b", output))
-    except subprocess.TimeoutExpired:
-        print(f"⏱️ DNS timeout: {hostname}")
-        return False
-    except Exception as e:
-        return False
+    global dns_cache
+    if dns_cache is None and DNS_CACHE_PATH:
+        dns_cache = DnsCache(DNS_CACHE_PATH, refresh_before=dns_refresh_before)
+    return dns_cache
 
 @lru_cache(maxsize=100_000)
 def resolves_to_localhost(hostname):
     """
     Resolve hostname and check if it points to localhost.
+    Uses the pre-resolved hostnames, others are resolved the same way through the persistent DNS cache if available,
+    which keeps failed lookups as negative entries.
     """
-    return resolves_to_localhost_with_timeout(hostname)
-    # try:
-    #     ips = socket.gethostbyname_ex(hostname)[2]
-    #     return any(ip in LOCALHOST_IPS for ip in ips)
-    # except Exception:
-    #     return False
-    
-def extract_port_parsed(parsed_url):
-    """
-    Extract port, returns defaults if not found.
-    """
-    if parsed_url.port:
-        return parsed_url.port
-    return 443 if parsed_url.scheme == "https" else 80
+    if hostname in preresolved_hostnames:
+        stats.count("dns_preresolved")
+        return preresolved_hostnames[hostname]
 
-def is_localhost_request(url : str):
-    """
-    Check if a url is for a request to a localhost port by using urlparse().
-    Returns if it is a localhost request, the search type and the found port.
-    """
-    parsed_url = urlparse(url)
-    localhost_variants = {"127.0.0.1", "::1", "localhost", "0.0.0.0"}
-
-    # Check if the hostname is a localhost variant
-    if parsed_url.hostname in localhost_variants:
-        # Get the port (default to 80 for HTTP and 443 for HTTPS if not explicitly set)
-        port = parsed_url.port if parsed_url.port else (80 if parsed_url.scheme == "http" else 443)
-        return True, parsed_url.hostname, port
-    return False, None, None
+    started = time.perf_counter()
+    addresses = resolve_hostnames([hostname], cache=get_dns_cache(), stats=stats)[hostname]
+    stats.lap("dns", started)
+    return points_to_localhost(addresses)
 
-def analyze_request(file_url : str, final_url : str, rank : str, request : dict):
+def localhost_request_result(file_url : str, final_url : str, rank : str, request : dict, url : str, hostname : str, port : int, is_localhost : bool):
     """
-    Analyze a request to check if it is a request to localhost and return its details if so.
-    Returns request_result = {
+    Build the result of a request classified by classify_url, resolving its hostname if it is not a localhost variant.
+    Returns None if the request does not go to localhost, else request_result = {
                             "rank": rank of the tested url,
                             "tested_url": initial url of the visited page,
                             "final_url": final url of the visited page after loading,
@@ -125,34 +151,21 @@ def analyze_request(file_url : str, final_url : str, rank : str, request : dict)
                             "script_url": script url of initiating script, cutoff to SCRIPT_URL_CUTOFF characters,
                             }
     """
-    url = request.get("url", "")
-
-    is_localhost, search_type, port = is_localhost_request(url)
-
-    if not is_localhost:
-        parsed = urlparse(url)
-        hostname = parsed.hostname
-        if hostname is None or not parsed.port:
-            return None
-
-        if not resolves_to_localhost(hostname):
-            return None
-
+    if is_localhost:
+        search_type = hostname
+    elif resolves_to_localhost(hostname):
         search_type = "resolves"
-        port = extract_port_parsed(parsed)
+    else:
+        return None
 
     initiators = request.get("initiators", [])
     initial_initiator = initiators[0] if len(initiators) else "Unknown"
-
-    parsed_final_url = urlparse(final_url)
-    final_domain = safe_get_fld(parsed_final_url.scheme + "://" + parsed_final_url.hostname)
-    parsed_initial_initiator = urlparse(initial_initiator)
-    if parsed_initial_initiator.hostname:
-        initiator_domain = safe_get_fld(parsed_initial_initiator.scheme + "://" + parsed_initial_initiator.hostname)
-    else:
-        initiator_domain = ""
     protocol = request.get("type")
 
+    started = time.perf_counter()
+    final_domain = page_domain(final_url)
+    script_domain = initiator_domain(initial_initiator)
+    stats.lap("domains", started)
 
     request_result = {
                     "rank": rank,
@@ -163,7 +176,7 @@ def analyze_request(file_url : str, final_url : str, rank : str, request : dict)
                     "search_type": search_type,
                     "port_num": port,
                     "request_url": url,
-                    "script_domain": initiator_domain,
+                    "script_domain": script_domain,
                     "script_url": initial_initiator[:SCRIPT_URL_CUTOFF],
                     }
     return request_result
@@ -171,12 +184,13 @@ def analyze_request(file_url : str, final_url : str, rank : str, request : dict)
 def analyze_request_data(file_url : str, final_url : str, rank : str, request_data : list):
     """
     Analyze the request data for any localhost requests.
+    All requests are classified in one pass, only the candidates are looked at further.
     Returns a list of request results.
     """
     requests_results = []
 
-    for request in request_data:
-        request_result = analyze_request(file_url, final_url, rank, request)
+    for request, url, hostname, port, is_localhost in classify_requests(request_data):
+        request_result = localhost_request_result(file_url, final_url, rank, request, url, hostname, port, is_localhost)
         if not request_result:
             continue
 
@@ -184,23 +198,10 @@ def analyze_request_data(file_url : str, final_url : str, rank : str, request_da
 
     return requests_results
 
-def extract_ports(candidate_string):
-    """
-    Extracts port numbers from a WebRTC candidate.
-    Returns a list of port numbers or ["N/A"] if none are found.
-    """
-    # Define regex patterns
-    ip_port_pattern = re.findall(r'(\d+\.\d+\.\d+\.\d+)\s+(\d+)', candidate_string)
-    sctp_port_pattern = re.findall(r'a=sctp-port:(\d+)', candidate_string)
-
-    # Extract ports from matches
-    ports = [port for _, port in ip_port_pattern] + sctp_port_pattern
-    return ports if ports else ["N/A"]
-
 def analyze_webRTC_call(file_url : str, final_url : str, rank : str, webRTC_call : dict):
     """
     Analyze a request call for setting up a localhost connection.
-    Returns a list of call_results, one for each port found.
+    Returns a list of call_results, one for each distinct port found by the candidate tokenizer, in the order they appear.
     call_result = {
                     "rank": rank of the tested url,
                     "tested_url": initial url of the visited page,
@@ -225,16 +226,13 @@ def analyze_webRTC_call(file_url : str, final_url : str, rank : str, webRTC_call
         return []
 
     candidate = webRTC_call.get("candidate", "")
-    all_ports = set(extract_ports(candidate))
+    all_ports = candidate_ports(candidate)
 
-    parsed_final_url = urlparse(final_url)
-    final_domain = safe_get_fld(parsed_final_url.scheme + "://" + parsed_final_url.hostname)
+    started = time.perf_counter()
+    final_domain = page_domain(final_url)
     initiator = webRTC_call.get("source", "Unknown")
-    parsed_initiator = urlparse(initiator)
-    if parsed_initiator.hostname:
-        initiator_domain = safe_get_fld(parsed_initiator.scheme + "://" + parsed_initiator.hostname)
-    else:
-        initiator_domain = ""
+    script_domain = initiator_domain(initiator)
+    stats.lap("domains", started)
 
     all_call_results = []
     for port in all_ports:
@@ -247,7 +245,7 @@ def analyze_webRTC_call(file_url : str, final_url : str, rank : str, webRTC_call
                     "search_type": search_type,
                     "port_num": port,
                     "request_url": candidate,
-                    "script_domain": initiator_domain,
+                    "script_domain": script_domain,
                     "script_url": initiator[:SCRIPT_URL_CUTOFF],
                     }
         all_call_results.append(call_result)
@@ -257,7 +255,7 @@ def analyze_webRTC_call(file_url : str, final_url : str, rank : str, webRTC_call
 def analyze_webRTC_data(file_url : str, final_url : str, rank : str, webRTC_data : list):
     """
     Analyze the WebRTC data for any localhost calls.
-    Returns a list of unique call results.
+    Returns a list of call results.
     """
     webRTC_results = []
 
@@ -267,105 +265,728 @@ def analyze_webRTC_data(file_url : str, final_url : str, rank : str, webRTC_data
         if len(call_results) == 0:
             continue
 
-        webRTC_results = webRTC_results + call_results
-    return list(webRTC_results)
+        # Extended in place, pages with thousands of SDP events would copy the list for every call otherwise
+        webRTC_results.extend(call_results)
+    return webRTC_results
 
-@lru_cache(maxsize=100_000)
-def get_rank(tested_url):
+def stream_crawl_fields(f):
+    """
+    Read only the fields needed for the analysis from a crawl-cli output file, without building the whole document.
+    Requests are reduced to url, type and initiators, WebRTC calls are kept whole.
+    Returns initial_url, final_url and data = {"requests": [...], "webRTC": [...]}, data is None if the file has no data.
+    """
+    initial_url = None
+    final_url = None
+    has_data = False
+    request_data = []
+    webRTC_data = []
+
+    request = None
+    webRTC_builder = None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if webRTC_builder is not None:
+            webRTC_builder.event(event, value)
+            if prefix == "data.webRTC.item" and event == "end_map":
+                webRTC_data.append(webRTC_builder.value)
+                webRTC_builder = None
+        elif request is not None:
+            if prefix == "data.requests.item" and event == "end_map":
+                request_data.append(request)
+                request = None
+            elif prefix == "data.requests.item.url" or prefix == "data.requests.item.type":
+                request[prefix.rsplit(".", 1)[1]] = value
+            elif prefix == "data.requests.item.initiators" and event == "start_array":
+                request["initiators"] = []
+            elif prefix == "data.requests.item.initiators.item":
+                request["initiators"].append(value)
+        elif prefix == "data.requests.item" and event == "start_map":
+            request = {}
+        elif prefix == "data.webRTC.item" and event == "start_map":
+            webRTC_builder = ijson.ObjectBuilder()
+            webRTC_builder.event(event, value)
+        elif prefix == "data" and event == "map_key":
+            has_data = True
+        elif prefix == "initialUrl":
+            initial_url = value
+        elif prefix == "finalUrl":
+            final_url = value
+
+    if not has_data:
+        return initial_url, final_url, None
+    return initial_url, final_url, {"requests": request_data, "webRTC": webRTC_data}
+
+def load_crawl_fields(file_name : str, content : bytes = None):
+    """
+    Load a crawl-cli output file or shard record, streaming it if ijson is available.
+    content are the bytes of the file if they were already read, they are always read for a shard record.
+    Returns initial_url, final_url and the data dict (None if the file has no data).
+    """
+    if content is None and is_shard_record(file_name):
+        content = read_crawl_bytes(file_name)
+    if STREAMING_JSON and ijson is not None:
+        if content is not None:
+            return stream_crawl_fields(io.BytesIO(content))
+        with open(file_name, "rb") as f:
+            return stream_crawl_fields(f)
+
+    if content is not None:
+        file_data = json.loads(content)
+    else:
+        with open(file_name, encoding="utf-8") as f:
+            file_data = json.load(f)
+    return file_data.get("initialUrl", None), file_data.get("finalUrl", None), file_data.get("data", None)
+
+def read_record(file_name : str):
+    """
+    Read a shard record once for both the pre-filter and the analysis.
+    Returns its bytes, None for a plain file, which they read themselves.
+    """
+    return read_crawl_bytes(file_name) if is_shard_record(file_name) else None
+
+def may_have_results(file_name : str, content : bytes = None):
+    """
+    Check the raw bytes of a file for anything that could produce a request or WebRTC result:
+    a URL to a localhost variant, a URL with an explicit port or a WebRTC call with a localhost detection.
+    content are the bytes of the file if they were already read, e.g. of a shard record.
+    Empty files are not filtered, so they still fail like before.
+    """
+    if content is not None:
+        return not content or URL_CANDIDATE_PATTERN.search(content) is not None or WEBRTC_CANDIDATE_PATTERN.search(content) is not None
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return URL_CANDIDATE_PATTERN.search(data) is not None or WEBRTC_CANDIDATE_PATTERN.search(data) is not None
+
+def collect_hostnames(file_name : str):
     """
-    Get the rank of the given url.
-    Returns "?" if not found.
+    Collect the hostnames of all requests in the file with an explicit port that are not localhost variants,
+    i.e. the hostnames localhost_request_result would have to resolve.
+    Returns a set of hostnames.
     """
-    if tested_url.endswith("/"):
-        tested_url = tested_url[:-1]
-    return ranking.get(tested_url, "?")
+    hostnames = set()
+    if file_name == input_folder + "metadata.json":
+        return hostnames
+    stats.count("bytes_read", stored_size(file_name))
+    started = time.perf_counter()
+    content = read_record(file_name)
+    if PREFILTER_FILES and not may_have_results(file_name, content):
+        stats.lap("prefilter", started)
+        return hostnames
+    started = stats.lap("prefilter", started)
+    _initial_url, _final_url, data = load_crawl_fields(file_name, content)
+    stats.lap("read_json", started)
+    if not data:
+        return hostnames
+
+    for _request, _url, hostname, _port, is_localhost in classify_requests(data.get("requests", [])):
+        if not is_localhost:
+            hostnames.add(hostname)
+    return hostnames
+
+def preresolve_hostnames(files : list, main_stats : RunStats = None, worker_stats : RunStats = None):
+    """
+    Collect the distinct hostnames with an explicit port over all files and resolve them in one batch.
+    The stage times and counters go to main_stats and worker_stats (as "collect_hostnames.*") if given.
+    Returns a dict of hostname -> resolves to localhost.
+    """
+    main_stats = main_stats if main_stats is not None else RunStats()
+    worker_stats = worker_stats if worker_stats is not None else RunStats()
+    print("Collecting hostnames...")
+    start = time.perf_counter()
+    hostnames = set()
+    pool = WatchdogPool(collect_hostnames, MAX_WORKERS, TIMEOUT_SECONDS, MAX_TASKS_PER_WORKER,
+                        report=take_worker_stats, on_report=lambda report: worker_stats.merge(report, "collect_hostnames."))
+    for outcome, _file, file_hostnames, error in tqdm(pool.run(chunked(files, FILES_PER_TASK)), total=len(files), desc="Collecting hostnames"):
+        # Failing and timed out files are reported by the analysis
+        if outcome == "result" and error is None:
+            hostnames.update(file_hostnames)
+    collected = main_stats.lap("collect_hostnames", start)
+
+    resolved = resolve_hostnames(hostnames, cache=get_dns_cache(), stats=main_stats)
+    done = main_stats.lap("resolve_hostnames", collected)
+    localhost_count = sum(points_to_localhost(addresses) for addresses in resolved.values())
+    main_stats.count("hostnames", len(hostnames))
+    main_stats.count("hostnames_to_localhost", localhost_count)
+    print(f"Collected {len(hostnames)} hostnames in {collected - start:.1f}s, "
+          f"resolved them in {done - collected:.1f}s ({localhost_count} point to localhost)")
+
+    return {hostname: points_to_localhost(addresses) for hostname, addresses in resolved.items()}
+
+def init_worker(resolved_hostnames : dict, refresh_before : float, shards_folder : str = None):
+    """
+    Initialize an analysis worker with the pre-resolved hostnames, the DNS cache refresh time
+    and the folder of its output shards if it writes its own rows.
+    """
+    global preresolved_hostnames, dns_refresh_before, dns_cache, stats, worker_shards
+    # Forked workers share the parent's mapping of the index, spawned ones map the same file
+    if ranking_index.ranking_index is None:
+        open_ranking(rank_file_path, outputSize)
+    preresolved_hostnames = resolved_hostnames
+    dns_refresh_before = refresh_before
+    # Never reuse a connection inherited from the parent
+    dns_cache = None
+    stats = RunStats()
+    worker_shards = WorkerShards(shards_folder) if shards_folder else None
+
+def take_worker_stats():
+    """
+    Get the stats this worker collected since the last call, sent to the main process after every chunk.
+    """
+    return stats.take()
+
+def end_worker_chunk():
+    """
+    Called in an analysis worker after every chunk, before its results are sent: commit the rows of the chunk to the worker's shards.
+    Returns the worker's stats since the last chunk and the committed sizes of its shards, for the main process.
+    """
+    started = time.perf_counter()
+    shard_sizes = worker_shards.commit() if worker_shards is not None else {}
+    stats.lap("write_shards", started)
+    return {"stats": stats.take(), "shards": shard_sizes}
 
-def analyze_file(file_name : str):
+class WorkerShards:
+    """
+    The CSV output shards of one analysis worker (WORKER_SHARDS), one per output.
+    The rows of a chunk are kept until the chunk is done and only then appended, so the rows of a chunk whose worker
+    is killed are lost with it and its files, handed out again, do not leave duplicates behind.
     """
-    Analyze the file for any localhost requests or WebRTC calls.
+    def __init__(self, folder : str):
+        self.folder = folder
+        self.writers = {}
+        self.pending = {"requests_output": [], "webRTC_output": []}
+
+    def add(self, output : str, rows : list):
+        if rows:
+            self.pending[output].extend(rows)
+
+    def commit(self):
+        """
+        Append the pending rows to the shards.
+        Returns a dict of shard path -> committed size for this worker's shards.
+        """
+        for output, rows in self.pending.items():
+            if not rows:
+                continue
+            if output not in self.writers:
+                # Workers are recycled, the pid alone could come back
+                path = os.path.join(self.folder, f"{output}_{os.getpid()}_{time.time_ns()}.csv")
+                self.writers[output] = CsvResultsWriter(path, "w")
+            self.writers[output].write_rows(rows)
+            self.writers[output].checkpoint()
+            rows.clear()
+        return {writer.path: writer.file.tell() for writer in self.writers.values()}
+
+def analyze_file(file_name : str, content : bytes = None):
+    """
+    Analyze the file (or shard record) for any localhost requests or WebRTC calls.
+    content are the bytes of the file if they were already read.
     Returns two lists for both request results and WebRTC results.
     """
     # print(f"🔍 Processing: {file_name}")
     if file_name == input_folder + "metadata.json":
         return None, None
     # Load the data from the .json file
-    f = open(file_name, encoding="utf-8")
-    file_data = json.load(f)
-    f.close()
-
-    initial_url = file_data.get("initialUrl", None)
-    final_url = file_data.get("finalUrl", None)
+    started = time.perf_counter()
+    initial_url, final_url, data = load_crawl_fields(file_name, content)
+    started = stats.lap("read_json", started)
     if not initial_url or not final_url:
         print(f"Warning! No initial_url or final_url for {file_name}")
 
-    data = file_data.get("data", None)
     if not data:
         print(f"Error! No Data for {file_name}")
+        stats.count("files_without_data")
         return None, None
     
-    rank = get_rank(initial_url)
+    rank = get_rank(initial_url, final_url)
+    started = stats.lap("rank", started)
 
+    # The requests and WebRTC stages include their "dns" and "domains" time
     request_data = data.get("requests", [])
     request_results = analyze_request_data(initial_url, final_url, rank, request_data)
+    started = stats.lap("requests", started)
 
     webRTC_data = data.get("webRTC", [])
     webRTC_results = analyze_webRTC_data(initial_url, final_url, rank, webRTC_data)
+    stats.lap("webRTC", started)
 
+    stats.count("requests", len(request_data))
+    stats.count("webRTC_calls", len(webRTC_data))
+    stats.count("request_results", len(request_results))
+    stats.count("webRTC_results", len(webRTC_results))
     return request_results, webRTC_results
 
+def process_file(file_name : str):
+    """
+    Analyze the file, unless the pre-filter shows that it cannot have results.
+    Returns the request results, the WebRTC results, whether the file was skipped
+    and the file's partial port -> script domains maps (None without PORT_RESULTS), merged by the main process.
+    """
+    stats.count("bytes_read", stored_size(file_name))
+    started = time.perf_counter()
+    content = read_record(file_name)
+    if content is not None:
+        started = stats.lap("read_record", started)
+    if PREFILTER_FILES:
+        may_have = may_have_results(file_name, content)
+        stats.lap("prefilter", started)
+        if not may_have:
+            stats.count("skipped_files")
+            return [], [], True, None
+    request_results, webRTC_results = analyze_file(file_name, content)
+    started = time.perf_counter()
+    port_results = file_port_results(request_results, webRTC_results) if PORT_RESULTS else None
+    stats.lap("port_results", started)
+    if worker_shards is not None:
+        # The rows go to this worker's shards, only the (small) port maps are sent back
+        worker_shards.add("requests_output", request_results)
+        worker_shards.add("webRTC_output", webRTC_results)
+        return [], [], False, port_results
+    return request_results, webRTC_results, False, port_results
+
+def failed_list_path():
+    return "failed_" + location + version + ".txt"
+
+def timedout_list_path():
+    return "timedout_" + location + version + ".txt"
+
+def port_results_path():
+    return results_folder + "port_results_" + location + version + ".json"
+
+def run_report_path():
+    return results_folder + "run_report_" + location + version + ".json"
+
+def shards_folder_path():
+    return results_folder + "shards_" + location + version + "/"
+
+def checkpoint_path():
+    return results_folder + "checkpoint_" + location + version + ".json"
+
+def list_input_files():
+    """
+    List the crawl files in the input folder, including the records of the shards packed by crawl_shards.py.
+    Returns a list of (file_name, manifest key).
+    """
+    return list_crawl_files(input_folder)
+
+def list_retry_files(manifest : ProcessingManifest):
+    """
+    List the files from failed_*.txt and timedout_*.txt that have not been processed successfully since.
+    Returns a list of (file_name, manifest key).
+    """
+    files = []
+    for file in dict.fromkeys(read_file_list(failed_list_path()) + read_file_list(timedout_list_path())):
+        entry = manifest.entries.get(file)
+        if entry is not None and entry[2] == "done":
+            continue
+        try:
+            files.append((file, crawl_file_key(file)))
+        except OSError:
+            print(f"Warning! Cannot retry missing file {file}")
+    return files
+
+def rewrite_retry_lists(manifest : ProcessingManifest):
+    """
+    Rewrite failed_*.txt and timedout_*.txt to only hold the files that still fail after a retry run.
+    """
+    listed = dict.fromkeys(read_file_list(failed_list_path()) + read_file_list(timedout_list_path()))
+    for path, status in ((failed_list_path(), "failed"), (timedout_list_path(), "timedout")):
+        still_failing = [file for file in listed if manifest.entries.get(file, (0, 0, ""))[2] == status]
+        with open(path, "w") as f:
+            f.writelines(file + "\n" for file in still_failing)
+
+def chunked(items, size : int):
+    """
+    Split items into lists of at most size items, lazily.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class ResultShards:
+    """
+    The worker shards of a run (WORKER_SHARDS) with the sizes the workers committed, as reported after every chunk.
+    Bytes past the committed size belong to a chunk the main process never got the results of (its worker died
+    in between) and are dropped when merging.
+    The sizes are part of the RunCheckpoint, so the shards of an interrupted run are merged at the start of the next one.
+    While merging, the rows of every shard already durable in the outputs are checkpointed too, so a merge interrupted
+    half way resumes where it stopped instead of appending the same rows again.
+    """
+    def __init__(self, folder : str, state : dict = None):
+        self.folder = folder
+        self.sizes = dict(state["sizes"]) if state else {}
+        # Shard path -> rows already merged into the output
+        self.merged_rows = dict(state["merged_rows"]) if state else {}
+        os.makedirs(folder, exist_ok=True)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def commit(self, shard_sizes : dict):
+        self.sizes.update(shard_sizes)
+
+    def state(self):
+        return {"sizes": self.sizes, "merged_rows": self.merged_rows}
+
+    def merge(self, outputs : dict, stats : RunStats, save_checkpoint):
+        """
+        Merge the committed rows of the shards into the outputs (output name -> results writer), sorted by MERGE_SORT_BY.
+        save_checkpoint is called whenever more rows are durable in the outputs.
+        """
+        started = time.perf_counter()
+        for output, writer in outputs.items():
+            paths = sorted(path for path in self.sizes if os.path.basename(path).startswith(output + "_"))
+            for path in paths:
+                os.truncate(path, self.sizes[path])
+            # Shards partly merged already can't be sorted with the others any more
+            if MERGE_SORT_BY is not None and len(paths) > 1 and not any(self.merged_rows.get(path) for path in paths):
+                paths = [self.sort_shards(output, paths, save_checkpoint)]
+            for path in paths:
+                self.merge_shard(path, writer, stats, save_checkpoint)
+        stats.lap("merge_shards", started)
+
+    def sort_shards(self, output : str, paths : list, save_checkpoint):
+        """
+        Merge the shards of an output into a single shard sorted by MERGE_SORT_BY, which replaces them.
+        Returns the path of the sorted shard.
+        """
+        sorted_path = os.path.join(self.folder, output + "_sorted.csv")
+        temp_path = sorted_path + ".tmp"
+        sorted_writer = CsvResultsWriter(temp_path)
+        try:
+            merge_result_shards(paths, sorted_writer, MERGE_SORT_BY)
+        finally:
+            sorted_writer.close()
+        os.replace(temp_path, sorted_path)
+        for path in paths:
+            del self.sizes[path]
+        self.sizes[sorted_path] = os.path.getsize(sorted_path)
+        save_checkpoint()
+        for path in paths:
+            os.remove(path)
+        return sorted_path
+
+    def merge_shard(self, path : str, writer, stats : RunStats, save_checkpoint):
+        """
+        Append the rows of a shard not merged yet to an output, checkpointing the progress after every durable batch.
+        """
+        done = self.merged_rows.get(path, 0)
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = itertools.islice(csv.DictReader(f), done, None)
+            while True:
+                batch = list(itertools.islice(rows, MERGE_RUN_ROWS))
+                if not batch:
+                    break
+                writer.write_rows(batch)
+                writer.checkpoint(force=True)
+                done += len(batch)
+                self.merged_rows[path] = done
+                save_checkpoint()
+                stats.count("merged_rows", len(batch))
+
+    def discard(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.sizes = {}
+        self.merged_rows = {}
+
+class RunCheckpoint:
+    """
+    The last consistent state of a run, saved in one atomic write after every flush of the manifest: the size of the manifest,
+    what the outputs hold (committed_state() of their writers) and the worker shards.
+    Rows also reach the outputs between flushes (buffers written out by the OS, a half-written last line, a Parquet part
+    closed on its own), so a resumed run first cuts the manifest and the outputs back to the checkpoint and processes
+    the files recorded after it again.
+    """
+    def __init__(self, path : str):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def restore(self, manifest_path : str, output_paths : dict):
+        """
+        Cut the manifest and the outputs (output name -> results path) back to the checkpoint.
+        """
+        if not self.state:
+            return
+        if os.path.exists(manifest_path):
+            os.truncate(manifest_path, self.state["manifest_size"])
+        # Outputs of another format are other files
+        if self.state["format"] == OUTPUT_FORMAT:
+            for output, path in output_paths.items():
+                restore_results(path, self.state["outputs"][output])
+
+    def save(self, manifest : ProcessingManifest, outputs : dict, shards : ResultShards = None):
+        """
+        Save the checkpoint, once the manifest is flushed and the outputs (output name -> results writer) checkpointed.
+        """
+        self.state = {
+            "format": OUTPUT_FORMAT,
+            "manifest_size": manifest.committed_size(),
+            "outputs": {output: writer.committed_state() for output, writer in outputs.items()},
+            "shards": shards.state() if shards is not None else None,
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.state = {}
+
+class ResultsWriter:
+    """
+    Writes the results of the processed files to the outputs and records the files in the manifest.
+    The manifest is flushed, and the run checkpointed, at the end of the first chunk after every MANIFEST_FLUSH_INTERVAL files,
+    so the committed sizes of the worker shards never hold rows of files the manifest does not have yet.
+    """
+    def __init__(self, requests_output, webRTC_output, manifest : ProcessingManifest, file_keys : dict, port_results : PortResults = None,
+                 stats : RunStats = None, shards : ResultShards = None, checkpoint : RunCheckpoint = None):
+        self.requests_output = requests_output
+        self.webRTC_output = webRTC_output
+        self.manifest = manifest
+        self.file_keys = file_keys
+        self.port_results = port_results
+        self.shards = shards
+        self.checkpoint = checkpoint
+        self.stats = stats if stats is not None else RunStats()
+        self.processed_count = 0
+        self.flush_due = False
+
+    def outputs(self):
+        return {"requests_output": self.requests_output, "webRTC_output": self.webRTC_output}
+
+    def write_results(self, file : str, request_results : list, webRTC_results : list, port_results : dict = None):
+        started = time.perf_counter()
+        if request_results and len(request_results):
+            self.requests_output.write_rows(request_results)
+        if webRTC_results and len(webRTC_results):
+            self.webRTC_output.write_rows(webRTC_results)
+        if self.port_results is not None and port_results:
+            self.port_results.merge(port_results)
+        self.stats.lap("write_results", started)
+        self.record(file, "done")
+
+    def write_failure(self, file : str, error : str):
+        print(f"❌ Error processing {file}: {error}")
+        with open(failed_list_path(), 'a') as f:
+            f.write(file + "\n")
+        self.record(file, "failed")
+
+    def write_timeout(self, file : str):
+        # The file is quarantined: runs skip it through the manifest, only RETRY_FAILED_ONLY picks it up again
+        print(f"⏱️ Timeout on file: {file}, worker killed")
+        with open(timedout_list_path(), 'a') as f:
+            f.write(file + "\n")
+        self.record(file, "timedout")
+
+    def record(self, file : str, status : str):
+        self.stats.count(status + "_files")
+        self.manifest.record(file, self.file_keys[file], status)
+        self.processed_count += 1
+        if self.processed_count % MANIFEST_FLUSH_INTERVAL == 0:
+            self.flush_due = True
+
+    def end_chunk(self):
+        """
+        Called between chunks, when every file of the chunks reported so far is recorded.
+        """
+        if self.flush_due:
+            self.flush()
+
+    def flush(self, force : bool = False):
+        started = time.perf_counter()
+        # Results first, so the manifest never gets ahead of the outputs
+        requests_durable = self.requests_output.checkpoint(force)
+        webRTC_durable = self.webRTC_output.checkpoint(force)
+        if requests_durable and webRTC_durable:
+            # Merging the maps is idempotent, so files processed again after an interruption do not change them
+            if self.port_results is not None:
+                self.port_results.save(port_results_path())
+            self.manifest.flush()
+            self.save_checkpoint()
+            self.flush_due = False
+        self.stats.lap("checkpoint", started)
+
+    def save_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.manifest, self.outputs(), self.shards)
+
+    def merge_shards(self):
+        """
+        Merge the worker shards into the outputs, and remove them once the checkpoint no longer needs them.
+        """
+        self.shards.merge(self.outputs(), self.stats, self.save_checkpoint)
+        shards, self.shards = self.shards, None
+        self.save_checkpoint()
+        shards.discard()
+
+    def close(self):
+        self.flush(force=True)
+        if self.shards is not None:
+            self.merge_shards()
+        self.requests_output.close()
+        self.webRTC_output.close()
+
+def progress_postfix(worker_stats : RunStats, seconds : float):
+    """
+    Live rates of the workers for the progress bar.
+    """
+    counts = worker_stats.counts
+    return (f"{counts.get('bytes_read', 0) / 2 ** 20 / max(seconds, 1e-9):.1f} MB/s, {counts.get('skipped_files', 0)} skipped, "
+            f"{counts.get('dns_lookups', 0)} DNS lookups")
+
+def build_run_report(main_stats : RunStats, worker_stats : RunStats, pool : WatchdogPool, file_count : int, started : float):
+    """
+    Machine-readable report of a run: the settings, the stage times and counters of the main process ("main")
+    and the summed ones of the workers ("workers", CPU-bound stages summed over MAX_WORKERS processes), and the derived rates.
+    """
+    processing_seconds = main_stats.seconds.get("processing", 0)
+    bytes_read = worker_stats.counts.get("bytes_read", 0)
+    busy_seconds = pool.busy_seconds if pool is not None else 0
+    idle_seconds = pool.idle_seconds if pool is not None else 0
+    return {
+        "location": location,
+        "version": version,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "wall_seconds": time.time() - started,
+        "settings": {
+            "MAX_WORKERS": MAX_WORKERS,
+            "FILES_PER_TASK": FILES_PER_TASK,
+            "TIMEOUT_SECONDS": TIMEOUT_SECONDS,
+            "STREAMING_JSON": STREAMING_JSON and ijson is not None,
+            "PRERESOLVE_DNS": PRERESOLVE_DNS,
+            "PREFILTER_FILES": PREFILTER_FILES,
+            "OUTPUT_FORMAT": OUTPUT_FORMAT,
+            "WORKER_SHARDS": WORKER_SHARDS,
+            "MERGE_SORT_BY": MERGE_SORT_BY,
+            "RETRY_FAILED_ONLY": RETRY_FAILED_ONLY,
+        },
+        "files": file_count,
+        "files_per_second": file_count / processing_seconds if processing_seconds else None,
+        "mb_per_second": bytes_read / 2 ** 20 / processing_seconds if processing_seconds else None,
+        "main": main_stats.to_dict(),
+        "workers": worker_stats.to_dict(),
+        # Share of the analysis workers' time spent on files rather than waiting for the main process to hand them out
+        "worker_utilization": busy_seconds / (busy_seconds + idle_seconds) if busy_seconds + idle_seconds else None,
+        "workers_killed": pool.killed_count if pool is not None else 0,
+        "workers_recycled": pool.recycled_count if pool is not None else 0,
+    }
+
 def main():
-    files = glob.glob(input_folder + '*.json', recursive = False)
-    crawl_count = 0
+    started = time.time()
+    main_stats = RunStats()
+    worker_stats = RunStats()
+    step = time.perf_counter()
+
+    manifest_path = results_folder + "manifest_" + location + version + ".csv"
+    # Retrying the failed files of earlier runs only makes sense on top of their outputs
+    resume = RESUME or RETRY_FAILED_ONLY
+    checkpoint = RunCheckpoint(checkpoint_path())
+    output_paths = {output: results_path(results_folder + output + "_" + location + version, OUTPUT_FORMAT)
+                    for output in ("requests_output", "webRTC_output")}
+    if not resume:
+        checkpoint.discard()
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+    # Drops what an interrupted run wrote after its last checkpoint, its files are processed again
+    checkpoint.restore(manifest_path, output_paths)
+    manifest = ProcessingManifest(manifest_path)
+    # Only append to the outputs if they belong to the runs recorded in the manifest
+    output_mode = "a" if len(manifest) or RETRY_FAILED_ONLY else "w"
+
+    if RETRY_FAILED_ONLY:
+        files = list_retry_files(manifest)
+    else:
+        files = [(file, key) for file, key in list_input_files() if not manifest.is_unchanged(file, key)]
+    # Appending the new rows of a changed file would leave its old ones in the outputs
+    changed_files = [file for file, key in files if manifest.has_results(file)]
+    if changed_files:
+        raise ValueError(f"{len(changed_files)} files changed since they were processed, e.g. {changed_files[0]}, "
+                         f"set RESUME = False to process everything again")
+    file_keys = dict(files)
+    print(f"{len(files)} files to process, {len(manifest)} already in the manifest")
+    step = main_stats.lap("list_files", step)
 
     print("Retrieving Ranking...")
-    with open(rank_file_path) as file:
-        reader = csv.reader(file)
-        count = 0
-
-        for row in reader:
-            ranking[row[0]] = row[1]
-            count += 1
-            if count > outputSize:
-                break
-
-    with open(results_folder + "requests_output_" + location + version + ".csv", "w", newline="", encoding="utf-8") as f1, \
-        open(results_folder + "webRTC_output_" + location + version + ".csv", "w", newline="", encoding="utf-8") as f2:
-        WRITER_REQS = None
-        WRITER_RTC = None
+    open_ranking(rank_file_path, outputSize)
+    step = main_stats.lap("open_ranking", step)
+
+    global dns_refresh_before
+    if FORCE_DNS_REFRESH:
+        dns_refresh_before = time.time()
+    resolved_hostnames = preresolve_hostnames(list(file_keys), main_stats, worker_stats) if PRERESOLVE_DNS else {}
+
+    requests_output = open_results_writer(results_folder + "requests_output_" + location + version, OUTPUT_FORMAT, output_mode)
+    webRTC_output = open_results_writer(results_folder + "webRTC_output_" + location + version, OUTPUT_FORMAT, output_mode)
+    # The maps of earlier runs are extended like the outputs
+    port_results = None
+    if PORT_RESULTS:
+        port_results = PortResults.load(port_results_path()) if output_mode == "a" else PortResults()
+    writer = ResultsWriter(requests_output, webRTC_output, manifest, file_keys, port_results, main_stats, checkpoint=checkpoint)
+    if os.path.exists(shards_folder_path()):
+        # Shards left by an interrupted run hold the rows of files it recorded in the manifest
+        leftover_shards = ResultShards(shards_folder_path(), checkpoint.state.get("shards"))
+        if output_mode == "a" and len(leftover_shards):
+            print(f"Merging {len(leftover_shards)} shards left by an interrupted run")
+            writer.shards = leftover_shards
+            writer.merge_shards()
+        else:
+            leftover_shards.discard()
+    shards = ResultShards(shards_folder_path()) if WORKER_SHARDS else None
+    writer.shards = shards
+    pool = None
+    try:
         print("Starting processing...")
-        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_file = {executor.submit(analyze_file, file): file for file in files}
-
-            for future in tqdm(as_completed(future_to_file), total=len(future_to_file), desc="Processing files"):
-                file = future_to_file[future]
-                try:
-                    request_results, webRTC_results = future.result(timeout=TIMEOUT_SECONDS)
-
-                    crawl_count += 1
-                    # if not crawl_count % 100:
-                    #     print(crawl_count)
-
-                    if request_results and len(request_results):
-                        if WRITER_REQS is None:
-                            WRITER_REQS = csv.DictWriter(f1, fieldnames=request_results[0].keys())
-                            WRITER_REQS.writeheader()
-                        for res in request_results:
-                            WRITER_REQS.writerow(res)
-                    if webRTC_results and len(webRTC_results):
-                        if WRITER_RTC is None:
-                            WRITER_RTC = csv.DictWriter(f2, fieldnames=webRTC_results[0].keys())
-                            WRITER_RTC.writeheader()
-                        for res in webRTC_results:
-                            WRITER_RTC.writerow(res)
-
-                except concurrentTimeoutError:
-                    print(f"⏱️ Timeout on file: {file}")
-                    with open("timedout_" + location + version + ".txt", 'a') as f:
-                        f.write(file + "\n")
-                except Exception as e:
-                    print(f"❌ Error processing {file}: {e}")
-                    with open("failed_" + location + version + ".txt", 'a') as f:
-                        f.write(file + "\n")
+        skipped_count = 0
+        step = time.perf_counter()
+
+        def on_report(report):
+            worker_stats.merge(report["stats"])
+            # The results of the chunk are handed out after its report, all files of the chunks before are recorded
+            writer.end_chunk()
+            if shards is not None:
+                shards.commit(report["shards"])
+            if PROGRESS_STATS:
+                progress.set_postfix_str(progress_postfix(worker_stats, time.perf_counter() - step), refresh=False)
+
+        pool = WatchdogPool(process_file, MAX_WORKERS, TIMEOUT_SECONDS, MAX_TASKS_PER_WORKER,
+                            initializer=init_worker, initargs=(resolved_hostnames, dns_refresh_before, shards.folder if shards is not None else None),
+                            report=end_worker_chunk, on_report=on_report)
+        progress = tqdm(pool.run(chunked(file_keys, FILES_PER_TASK)), total=len(file_keys), desc="Processing files")
+        for outcome, file, results, error in progress:
+            if outcome == "timeout":
+                writer.write_timeout(file)
+            elif outcome == "died":
+                writer.write_failure(file, f"worker died with exit code {error}")
+            elif error is not None:
+                writer.write_failure(file, error)
+            else:
+                request_results, webRTC_results, skipped, partial_port_results = results
+                skipped_count += skipped
+                writer.write_results(file, request_results, webRTC_results, partial_port_results)
+        main_stats.lap("processing", step)
+        if PREFILTER_FILES:
+            print(f"Skipped {skipped_count} of {len(file_keys)} files without localhost candidates")
+        if pool.killed_count:
+            print(f"Replaced {pool.killed_count} stuck or dead workers")
+    finally:
+        writer.close()
+        manifest.close()
+        if RUN_REPORT:
+            # Also written for interrupted runs, with what they got through
+            write_run_report(run_report_path(), build_run_report(main_stats, worker_stats, pool, len(file_keys), started))
+
+    if RETRY_FAILED_ONLY:
+        rewrite_retry_lists(manifest)
 
 if __name__ == "__main__":
     main()
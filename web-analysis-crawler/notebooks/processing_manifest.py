@@ -0,0 +1,83 @@
+import csv
+import os
+
+MANIFEST_FIELDS = ["path", "size", "mtime_ns", "status"]
+
+def file_key(stat_result : os.stat_result):
+    """
+    Key a processed file by its size and modification time.
+    """
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+class ProcessingManifest:
+    """
+    Append-only record of the files a run has processed, keyed by path, size and mtime.
+    Status is "done", "failed" or "timedout", the last entry for a path wins.
+    New entries are held back until flush(), which has to be called after the output rows of those files
+    have been made durable, so the manifest never claims a file whose results are not on disk.
+    """
+    def __init__(self, path : str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    self.entries[row["path"]] = (int(row["size"]), int(row["mtime_ns"]), row["status"])
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        if is_new:
+            self.writer.writerow(MANIFEST_FIELDS)
+        self.pending = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_unchanged(self, path : str, key : tuple):
+        """
+        Check if the file was already processed in the state described by key.
+        """
+        entry = self.entries.get(path)
+        return entry is not None and entry[:2] == key
+
+    def has_results(self, path : str):
+        """
+        Check if the file was processed successfully, so its rows are in the outputs.
+        """
+        entry = self.entries.get(path)
+        return entry is not None and entry[2] == "done"
+
+    def record(self, path : str, key : tuple, status : str):
+        """
+        Record that a file was processed with the given status.
+        """
+        self.entries[path] = (key[0], key[1], status)
+        self.pending.append([path, key[0], key[1], status])
+
+    def flush(self):
+        self.writer.writerows(self.pending)
+        self.pending = []
+        self.file.flush()
+
+    def committed_size(self):
+        """
+        Bytes of the manifest written by the last flush.
+        """
+        return self.file.tell()
+
+    def close(self):
+        """
+        Close the manifest, dropping the entries that were never flushed.
+        """
+        self.file.close()
+
+def read_file_list(path : str):
+    """
+    Read a list of file names, one per line, as written to failed_*.txt and timedout_*.txt.
+    Returns the unique file names in their original order, empty if the list does not exist.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
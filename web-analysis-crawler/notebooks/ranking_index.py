@@ -0,0 +1,177 @@
+import csv
+import mmap
+import os
+import struct
+import sys
+from array import array
+from functools import lru_cache
+
+from url_classification import split_url, safe_get_fld
+
+RANK_LIMIT = 100000
+# Magic, number of keys, row limit the index was built with, size of the keys blob
+HEADER = struct.Struct("=8sIII")
+MAGIC = b"RANKIDX" + (b"L" if sys.byteorder == "little" else b"B")
+
+def normalize_host(url : str):
+    """
+    Get the host of a url without scheme, port, path and a leading "www.".
+    Returns None if the url has no host.
+    """
+    try:
+        _scheme, hostname, _port = split_url(url)
+    except ValueError:
+        return None
+    if not hostname:
+        return None
+    hostname = hostname.rstrip(".")
+    if hostname.startswith("www."):
+        hostname = hostname[4:]
+    return hostname
+
+def lookup_keys(url : str):
+    """
+    Get the index keys of a url, most specific first: its normalized host and its registrable domain.
+    """
+    host = normalize_host(url)
+    if host is None:
+        return []
+    keys = ["h:" + host]
+    domain = safe_get_fld("http://" + host)
+    if domain:
+        keys.append("d:" + domain)
+    return keys
+
+def index_path_for(rank_file_path : str):
+    return rank_file_path + ".idx"
+
+def build_ranking_index(rank_file_path : str, index_path : str = None, limit : int = RANK_LIMIT):
+    """
+    Build the ranking index of the first limit rows of a rank file (origin,rank rows like the CrUX top list).
+    Every origin is keyed by its normalized host and its registrable domain, a key shared by several origins keeps the best rank.
+    The index is a sorted, memory-mappable file: header, key offsets, ranks and the keys blob.
+    """
+    index_path = index_path or index_path_for(rank_file_path)
+    best = {}
+    with open(rank_file_path, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        count = 0
+        for row in reader:
+            count += 1
+            if count > limit + 1:
+                break
+            if len(row) < 2 or not row[1].strip().isdigit():
+                continue
+            rank = int(row[1])
+            for key in lookup_keys(row[0]):
+                if rank < best.get(key, 0xFFFFFFFF):
+                    best[key] = rank
+
+    keys = sorted(key.encode("utf-8") for key in best)
+    offsets = array("I", [0])
+    ranks = array("I")
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+        ranks.append(best[key.decode("utf-8")])
+    blob = b"".join(keys)
+
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(keys), limit, len(blob)))
+        offsets.tofile(f)
+        ranks.tofile(f)
+        f.write(blob)
+    os.replace(temp_path, index_path)
+    return index_path
+
+class RankingIndex:
+    """
+    Read-only, memory-mapped ranking index.
+    All processes that open the same index share its pages through the page cache instead of each holding a dict.
+    """
+    def __init__(self, index_path : str):
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.limit, _blob_size = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{index_path} is not a ranking index for this platform")
+        view = memoryview(self.data)
+        offsets_start = HEADER.size
+        ranks_start = offsets_start + 4 * (self.count + 1)
+        self.keys_start = ranks_start + 4 * self.count
+        self.offsets = view[offsets_start:ranks_start].cast("I")
+        self.ranks = view[ranks_start:self.keys_start].cast("I")
+
+    def key_at(self, i : int):
+        return self.data[self.keys_start + self.offsets[i]:self.keys_start + self.offsets[i + 1]]
+
+    def find(self, key : str):
+        """
+        Binary search a key.
+        Returns its rank or None if it is not in the index.
+        """
+        key = key.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key_at(low) == key:
+            return self.ranks[low]
+        return None
+
+    def get_rank(self, tested_url : str, final_url : str = None):
+        """
+        Get the rank of a page, trying the host of the tested url, then the host of the final url
+        (e.g. after a redirect to another host), then their registrable domains.
+        Returns the rank as a string, "?" if not found.
+        """
+        tested_keys = lookup_keys(tested_url) if tested_url else []
+        final_keys = lookup_keys(final_url) if final_url else []
+        for key in tested_keys[:1] + final_keys[:1] + tested_keys[1:] + final_keys[1:]:
+            rank = self.find(key)
+            if rank is not None:
+                return str(rank)
+        return "?"
+
+def load_ranking_index(rank_file_path : str, limit : int = RANK_LIMIT):
+    """
+    Open the ranking index of a rank file, (re)building it first if it is missing, older than the rank file or built with another limit.
+    """
+    index_path = index_path_for(rank_file_path)
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(rank_file_path):
+        build_ranking_index(rank_file_path, index_path, limit)
+    index = RankingIndex(index_path)
+    if index.limit != limit:
+        build_ranking_index(rank_file_path, index_path, limit)
+        index = RankingIndex(index_path)
+    return index
+
+# Index of the current process, opened by open_ranking
+ranking_index = None
+
+def open_ranking(rank_file_path : str, limit : int = RANK_LIMIT):
+    """
+    Open the ranking index used by get_rank in this process.
+    """
+    global ranking_index
+    ranking_index = load_ranking_index(rank_file_path, limit)
+    get_rank.cache_clear()
+    return ranking_index
+
+@lru_cache(maxsize=100_000)
+def get_rank(tested_url : str, final_url : str = None):
+    """
+    Get the rank of the given url from the index opened with open_ranking.
+    Returns "?" if not found.
+    """
+    return ranking_index.get_rank(tested_url, final_url)
+
+if __name__ == "__main__":
+    # Prebuild the index: python ranking_index.py 202502.csv [limit]
+    path = build_ranking_index(sys.argv[1], limit=int(sys.argv[2]) if len(sys.argv) > 2 else RANK_LIMIT)
+    index = RankingIndex(path)
+    print(f"Built {path} with {index.count} keys")
@@ -0,0 +1,461 @@
+import csv
+import glob
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+RESULT_FIELDS = ["rank", "tested_url", "final_url", "final_domain", "protocol", "search_type", "port_num", "request_url", "script_domain", "script_url"]
+# Rows per Parquet part file, a part is only readable once it is closed
+PARQUET_PART_ROWS = 250_000
+# Seconds after which a checkpoint closes the current part however few rows it has, so the manifest
+# (flushed with every MANIFEST_FLUSH_INTERVAL files in process_output.py) does not fall far behind the outputs
+PARQUET_PART_SECONDS = 60
+# Rows sorted in memory at a time when merging shards sorted, and written to the output at a time
+MERGE_RUN_ROWS = 100_000
+# Dimension tables of the normalized format: id column and the result fields they hold.
+# The request_url of the candidates is the request url for requests and the whole candidate or SDP for WebRTC calls.
+NORMALIZED_DIMENSIONS = {
+    "pages": ("page_id", ["rank", "tested_url", "final_url", "final_domain"]),
+    "scripts": ("script_id", ["script_domain", "script_url"]),
+    "candidates": ("candidate_id", ["request_url"]),
+}
+# The fact table keeps one row per result with the ids of its page, script and candidate
+FACT_FIELDS = ["page_id", "protocol", "search_type", "port_num", "candidate_id", "script_id"]
+
+def results_schema():
+    """
+    Typed schema of the request and WebRTC results.
+    rank stays a string because unranked pages are "?", ports that could not be found ("N/A") are null.
+    """
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("rank", pa.string()),
+        ("tested_url", pa.string()),
+        ("final_url", pa.string()),
+        ("final_domain", pa.string()),
+        ("protocol", categorical),
+        ("search_type", categorical),
+        ("port_num", pa.int32()),
+        ("request_url", pa.string()),
+        ("script_domain", categorical),
+        ("script_url", pa.string()),
+    ])
+
+def parse_port(port):
+    """
+    Convert a port as found by the analysis to an int, None if there is no port.
+    """
+    try:
+        return int(port)
+    except (TypeError, ValueError):
+        return None
+
+def results_path(base_path : str, output_format : str):
+    """
+    Path of a results output without extension in the given format, a file for csv,
+    a directory of parts for parquet and a directory of tables for normalized.
+    """
+    if output_format == "normalized":
+        return base_path + ".normalized"
+    return base_path + (".parquet" if output_format == "parquet" else ".csv")
+
+class CsvResultsWriter:
+    """
+    Writes result rows to a CSV file, appending if mode is "a".
+    """
+    def __init__(self, path : str, mode : str = "w"):
+        self.path = path
+        self.file = open(path, mode, newline="", encoding="utf-8")
+        self.writer = None
+
+    def write_rows(self, rows : list):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=rows[0].keys())
+            if self.file.tell() == 0:
+                self.writer.writeheader()
+        self.writer.writerows(rows)
+
+    def checkpoint(self, force : bool = False):
+        """
+        Make the rows written so far durable.
+        Returns True if they are.
+        """
+        self.file.flush()
+        return True
+
+    def committed_state(self):
+        """
+        What the last checkpoint made durable, for restore_results: the size of the file.
+        """
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class ParquetResultsWriter:
+    """
+    Writes result rows to a directory of Parquet part files with the typed results schema.
+    Every writer (i.e. every run) adds new parts, so appending to earlier runs just means keeping their parts.
+    A part is written under a hidden temporary name, which readers ignore, and only renamed to part-*.parquet once it is closed,
+    so a run killed in the middle of a part never leaves a part without a footer behind.
+    """
+    def __init__(self, path : str, mode : str = "w"):
+        if pa is None:
+            raise ImportError("pyarrow is needed for the parquet output format")
+        self.path = path
+        if mode == "w" and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        # Parts a killed run never closed, their files are processed again
+        for temp_path in glob.glob(os.path.join(path, ".part-*.parquet.tmp")):
+            os.remove(temp_path)
+        self.schema = results_schema()
+        self.part_prefix = f"part-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-"
+        self.part_count = 0
+        self.writer = None
+        self.part_path = None
+        self.part_opened = 0.0
+        self.rows = []
+        self.part_rows = 0
+
+    def write_rows(self, rows : list):
+        if not self.rows and self.writer is None:
+            # The age of a part counts from its first row
+            self.part_opened = time.monotonic()
+        self.rows.extend(rows)
+        if len(self.rows) >= 10_000:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            self.part_path = os.path.join(self.path, self.part_prefix + f"{self.part_count:05d}.parquet")
+            self.writer = pq.ParquetWriter(self.temp_part_path(), self.schema)
+            self.part_count += 1
+        # Empty strings become nulls, which is how they read back from the CSV outputs
+        columns = {field: [row[field] if row[field] != "" else None for row in self.rows] for field in RESULT_FIELDS}
+        columns["port_num"] = [parse_port(port) for port in columns["port_num"]]
+        columns["rank"] = [str(rank) if rank is not None else None for rank in columns["rank"]]
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+        self.part_rows += len(self.rows)
+        self.rows = []
+
+    def temp_part_path(self):
+        return os.path.join(self.path, "." + os.path.basename(self.part_path) + ".tmp")
+
+    def checkpoint(self, force : bool = False):
+        """
+        Close the current part once it is large enough or PARQUET_PART_SECONDS old (or if forced), which makes its rows durable.
+        Returns True if all rows written so far are durable.
+        """
+        pending_rows = self.part_rows + len(self.rows)
+        if not force and pending_rows < PARQUET_PART_ROWS and (pending_rows == 0 or time.monotonic() - self.part_opened < PARQUET_PART_SECONDS):
+            return pending_rows == 0
+        self.write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.temp_part_path(), self.part_path)
+            self.writer = None
+            self.part_rows = 0
+        return True
+
+    def committed_state(self):
+        """
+        What the last checkpoint made durable, for restore_results: the names of the closed parts.
+        """
+        return part_names(self.path)
+
+    def close(self):
+        self.checkpoint(force=True)
+
+def part_names(path : str):
+    return sorted(os.path.basename(part_path) for part_path in glob.glob(os.path.join(path, "part-*.parquet")))
+
+def content_id(*values):
+    """
+    Content-hashed id of a dimension row: 63 bits of the BLAKE2b hash of its values, the same in every run and process,
+    so workers and appending runs agree on the ids without sharing any state.
+    Two different rows share an id with a probability of about n**2 / 2**64 for n rows of a table.
+    """
+    text = "\x1f".join("" if value is None else str(value) for value in values)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big") >> 1
+
+def read_ids(table_path : str, id_field : str):
+    """
+    Read the ids of a dimension table, empty if it does not exist.
+    """
+    if not os.path.exists(table_path):
+        return set()
+    with open(table_path, newline="", encoding="utf-8") as f:
+        return {int(row[id_field]) for row in csv.DictReader(f)}
+
+class NormalizedResultsWriter:
+    """
+    Writes result rows to a directory of normalized CSV tables: the dimension tables of NORMALIZED_DIMENSIONS,
+    which hold every distinct page, script and candidate once under its content_id, and the fact table facts.csv.
+    A page is identified by its tested and final url, it keeps the rank it was first written with.
+    """
+    def __init__(self, path : str, mode : str = "w"):
+        self.path = path
+        if mode == "w" and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.dimensions = {}
+        # Ids written so far, including those of earlier runs when appending
+        self.known_ids = {}
+        for name, (id_field, _fields) in NORMALIZED_DIMENSIONS.items():
+            table_path = os.path.join(path, name + ".csv")
+            self.known_ids[name] = read_ids(table_path, id_field)
+            self.dimensions[name] = CsvResultsWriter(table_path, mode)
+        self.facts = CsvResultsWriter(os.path.join(path, "facts.csv"), mode)
+
+    def write_rows(self, rows : list):
+        new_rows = {name: [] for name in NORMALIZED_DIMENSIONS}
+        facts = []
+        for row in rows:
+            ids = {
+                "pages": content_id(row["tested_url"], row["final_url"]),
+                "scripts": content_id(row["script_domain"], row["script_url"]),
+                "candidates": content_id(row["request_url"]),
+            }
+            for name, row_id in ids.items():
+                known = self.known_ids[name]
+                if row_id not in known:
+                    known.add(row_id)
+                    id_field, fields = NORMALIZED_DIMENSIONS[name]
+                    dimension_row = {id_field: row_id}
+                    dimension_row.update((field, row[field]) for field in fields)
+                    new_rows[name].append(dimension_row)
+            facts.append({
+                "page_id": ids["pages"],
+                "protocol": row["protocol"],
+                "search_type": row["search_type"],
+                "port_num": row["port_num"],
+                "candidate_id": ids["candidates"],
+                "script_id": ids["scripts"],
+            })
+        for name, dimension_rows in new_rows.items():
+            if dimension_rows:
+                self.dimensions[name].write_rows(dimension_rows)
+        self.facts.write_rows(facts)
+
+    def checkpoint(self, force : bool = False):
+        """
+        Make the rows written so far durable, the dimension rows before the facts that refer to them.
+        Returns True if they are.
+        """
+        for writer in self.dimensions.values():
+            writer.checkpoint(force)
+        return self.facts.checkpoint(force)
+
+    def committed_state(self):
+        """
+        What the last checkpoint made durable, for restore_results: the size of every table.
+        """
+        state = {name: writer.committed_state() for name, writer in self.dimensions.items()}
+        state["facts"] = self.facts.committed_state()
+        return state
+
+    def close(self):
+        for writer in self.dimensions.values():
+            writer.close()
+        self.facts.close()
+
+def open_results_writer(base_path : str, output_format : str, mode : str = "w"):
+    """
+    Open a results writer for the output base_path (without extension) in the given format ("csv", "parquet" or "normalized").
+    """
+    path = results_path(base_path, output_format)
+    if output_format == "parquet":
+        return ParquetResultsWriter(path, mode)
+    if output_format == "normalized":
+        return NormalizedResultsWriter(path, mode)
+    return CsvResultsWriter(path, mode)
+
+def restore_results(path : str, state):
+    """
+    Cut an output back to the committed_state() of its writer at a checkpoint, before reopening it to append:
+    rows written after the checkpoint (a buffer flushed in between, a half-written last line or a part closed on its own) are dropped.
+    """
+    if path.endswith(".csv"):
+        if os.path.exists(path) and os.path.getsize(path) > state:
+            os.truncate(path, state)
+    elif path.endswith(".normalized"):
+        for name, size in state.items():
+            restore_results(os.path.join(path, name + ".csv"), size)
+    else:
+        for name in set(part_names(path)) - set(state):
+            os.remove(os.path.join(path, name))
+
+def write_results(df : pd.DataFrame, path : str):
+    """
+    Write a results DataFrame as CSV or, if path does not end with .csv, as a single Parquet file.
+    """
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, index=False)
+
+def merge_sort_key(sort_by : str):
+    """
+    Sort key of result rows read from CSV for sort_by, "rank" (ranked pages by rank, then the unranked "?" ones) or any result field.
+    """
+    if sort_by == "rank":
+        return lambda row: (0, int(row["rank"]), row["tested_url"]) if row["rank"].isdigit() else (1, 0, row["tested_url"])
+    return lambda row: row[sort_by]
+
+def sorted_runs(path : str, key, run_rows : int, run_folder : str):
+    """
+    Split a CSV shard into sorted runs of at most run_rows rows, written to run_folder.
+    Returns the paths of the runs.
+    """
+    paths = []
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        while True:
+            rows = sorted(itertools.islice(reader, run_rows), key=key)
+            if not rows:
+                return paths
+            run_path = os.path.join(run_folder, f"run-{len(os.listdir(run_folder))}.csv")
+            with open(run_path, "w", newline="", encoding="utf-8") as run:
+                writer = csv.DictWriter(run, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+            paths.append(run_path)
+
+def merge_result_shards(shard_paths : list, output, sort_by : str = None, run_rows : int = MERGE_RUN_ROWS):
+    """
+    Merge CSV result shards (e.g. written by the workers of process_output.py) into a results writer (see open_results_writer),
+    one after the other, or sorted by sort_by with a k-way merge of sorted runs of at most run_rows rows,
+    so memory stays bounded by a run whatever the size of the shards.
+    Returns the number of rows.
+    """
+    files = []
+    run_folder = None
+    try:
+        if sort_by is None:
+            for path in shard_paths:
+                files.append(open(path, newline="", encoding="utf-8"))
+            rows = itertools.chain.from_iterable(csv.DictReader(f) for f in files)
+        else:
+            key = merge_sort_key(sort_by)
+            run_folder = tempfile.mkdtemp(prefix="runs-", dir=os.path.dirname(shard_paths[0]) if shard_paths else None)
+            for path in shard_paths:
+                for run_path in sorted_runs(path, key, run_rows, run_folder):
+                    files.append(open(run_path, newline="", encoding="utf-8"))
+            rows = heapq.merge(*(csv.DictReader(f) for f in files), key=key)
+
+        row_count = 0
+        while True:
+            batch = list(itertools.islice(rows, run_rows))
+            if not batch:
+                return row_count
+            output.write_rows(batch)
+            row_count += len(batch)
+    finally:
+        for f in files:
+            f.close()
+        if run_folder is not None:
+            shutil.rmtree(run_folder, ignore_errors=True)
+
+def normalized_tables(columns : list = None):
+    """
+    Get the columns to read from the fact table and the dimension tables needed for the given result columns (all if None).
+    Returns the fact columns and a dict of dimension name -> its columns, id first.
+    """
+    columns = columns or RESULT_FIELDS
+    dimensions = {}
+    for name, (id_field, fields) in NORMALIZED_DIMENSIONS.items():
+        needed = [field for field in fields if field in columns]
+        if needed:
+            dimensions[name] = [id_field] + needed
+    fact_columns = [field for field in FACT_FIELDS if field in columns]
+    fact_columns += [NORMALIZED_DIMENSIONS[name][0] for name in dimensions]
+    return fact_columns, dimensions
+
+def read_dimensions(path : str, dimensions : dict, dtype=None):
+    return {name: pd.read_csv(os.path.join(path, name + ".csv"), usecols=columns, dtype=dtype) for name, columns in dimensions.items()}
+
+def join_normalized(facts : pd.DataFrame, dimension_tables : dict, columns : list = None):
+    """
+    Rebuild the flat view of fact rows from the dimension tables, in the order of the facts.
+    """
+    for name, table in dimension_tables.items():
+        facts = facts.merge(table, on=NORMALIZED_DIMENSIONS[name][0], how="left")
+    return facts[[field for field in RESULT_FIELDS if field in (columns or RESULT_FIELDS)]]
+
+def read_normalized(path : str, columns : list = None, dtype=None):
+    """
+    Read a normalized output as the flat results table (or only the given columns of it).
+    Returns a DataFrame.
+    """
+    fact_columns, dimensions = normalized_tables(columns)
+    facts = pd.read_csv(os.path.join(path, "facts.csv"), usecols=fact_columns, dtype=dtype)
+    return join_normalized(facts, read_dimensions(path, dimensions, dtype), columns)
+
+def write_flat_view(path : str, output_path : str, chunk_rows : int = 1_000_000):
+    """
+    Write the flat CSV output of a normalized output, as process_output.py writes it with OUTPUT_FORMAT = "csv".
+    """
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        for number, chunk in enumerate(iter_results(path, chunk_rows=chunk_rows, dtype=str)):
+            chunk.to_csv(f, header=number == 0, index=False)
+
+def read_results(path : str, columns : list = None):
+    """
+    Read a results output, a CSV file, a Parquet file or directory of parts, or a normalized output as its flat view.
+    Categorical columns from Parquet get their categories sorted, so grouping on them orders like the CSV values.
+    Returns a DataFrame.
+    """
+    if path.endswith(".csv"):
+        return pd.read_csv(path, usecols=columns)
+    if path.endswith(".normalized"):
+        return read_normalized(path, columns)
+
+    df = pd.read_parquet(path, columns=columns)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.set_categories(sorted(df[column].cat.categories))
+    return df
+
+def iter_results(path : str, columns : list = None, chunk_rows : int = 1_000_000, dtype : dict = None):
+    """
+    Read a results output like read_results, but as DataFrames of at most chunk_rows rows, so it never has to fit in memory.
+    dtype is passed on to pd.read_csv for CSV outputs, Parquet columns keep their schema types.
+    Column types are inferred per chunk, e.g. a CSV chunk without missing ports has an int port_num column.
+    """
+    if path.endswith(".csv"):
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows, dtype=dtype)
+        return
+    if path.endswith(".normalized"):
+        # The dimension tables are read whole, they are small next to the facts
+        fact_columns, dimensions = normalized_tables(columns)
+        dimension_tables = read_dimensions(path, dimensions, dtype)
+        for facts in pd.read_csv(os.path.join(path, "facts.csv"), usecols=fact_columns, chunksize=chunk_rows, dtype=dtype):
+            yield join_normalized(facts, dimension_tables, columns)
+        return
+
+    if pa is None:
+        raise ImportError("pyarrow is needed to read parquet outputs")
+    import pyarrow.dataset as ds
+    for batch in ds.dataset(path, format="parquet").to_batches(columns=columns, batch_size=chunk_rows):
+        yield batch.to_pandas()
+
+if __name__ == "__main__":
+    # Rebuild the flat CSV of a normalized output: python results_io.py requests_output_x.normalized requests_output_x.csv
+    write_flat_view(sys.argv[1], sys.argv[2])
@@ -0,0 +1,60 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+class RunStats:
+    """
+    Cumulative seconds per stage and event counters of a run, cheap enough to update for every file.
+    Stages are timed with lap(), one perf_counter call per stage:
+        started = time.perf_counter()
+        ...
+        started = stats.lap("read_json", started)
+    Worker processes keep their own and send what they collected since the last take() to the main process, which merges it.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def lap(self, stage : str, started : float):
+        """
+        Add the time since started to stage.
+        Returns the current time, the start of the next stage.
+        """
+        now = time.perf_counter()
+        self.seconds[stage] += now - started
+        return now
+
+    def count(self, name : str, amount : int = 1):
+        self.counts[name] += amount
+
+    def merge(self, stats : dict, prefix : str = ""):
+        """
+        Add the stats of a to_dict() (e.g. sent by a worker), with prefix in front of their names.
+        """
+        for stage, seconds in stats["seconds"].items():
+            self.seconds[prefix + stage] += seconds
+        for name, amount in stats["counts"].items():
+            self.counts[prefix + name] += amount
+
+    def to_dict(self):
+        return {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+
+    def take(self):
+        """
+        Get the stats collected so far and start over.
+        Returns a to_dict().
+        """
+        stats = self.to_dict()
+        self.seconds.clear()
+        self.counts.clear()
+        return stats
+
+def write_run_report(path : str, report : dict):
+    """
+    Write a run report as JSON, atomically so a reader never sees half of it.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    os.replace(temp_path, path)
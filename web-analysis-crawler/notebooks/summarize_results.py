@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
 import json
 
+from hyperloglog import HyperLogLog, KeyedHyperLogLog, hash_values
+from results_io import read_results, iter_results, results_path
+
 # results_input__folder = "results/"
 results_input__folder = "_new_results/"
 
@@ -13,39 +17,145 @@ location = "new_york"
 # version = "_ios"
 version = "_post"
 
+# "csv", "parquet" or "normalized", as written by process_output.py
+results_format = "csv"
+
 # output_folder = "results/"
 output_folder = "_new_results/"
 
-webrtc_csv_path = results_input__folder + 'webRTC_output_' + location + version + '.csv'
-requests_csv_path = results_input__folder + 'requests_output_' + location + version + '.csv'
+webrtc_csv_path = results_path(results_input__folder + 'webRTC_output_' + location + version, results_format)
+requests_csv_path = results_path(results_input__folder + 'requests_output_' + location + version, results_format)
 # resolved_csv_path = results_input__folder + 'resolved_requests_output_' + location + version + '.csv'
 output_json_path = output_folder + 'summary_output_' + location + version + '.json'
 markdown_output_path = output_folder + 'summary_report_' + location + version + '.md'
 
 min_urls_threshold = 5
 
-# Load CSVs
-webrtc_df = pd.read_csv(webrtc_csv_path)
-requests_df = pd.read_csv(requests_csv_path)
-# resolved_df = pd.read_csv(resolved_csv_path)
+# Read the results in chunks of this many rows and keep only the aggregates in memory, None reads them whole
+CHUNK_ROWS = None
+# Estimate the distinct final url counts with HyperLogLog sketches instead of keeping every distinct final url (read in chunks).
+# The relative standard error is 1.04 / sqrt(2 ** precision), see hyperloglog.py, the port counts per domain stay exact.
+APPROXIMATE_DISTINCT = False
+SKETCH_PRECISION = 14  # Total unique final urls: 16 KiB, 0.81%
+KEYED_SKETCH_PRECISION = 10  # Per domain, port and (port, domain): 1 KiB each, 3.25%
+# The sketches of a run are saved as <sketch_output_base>_<table>.npz, sketches saved by other runs
+# (e.g. other locations or versions) listed here by their base path are merged into the summary
+sketch_output_base = output_folder + 'summary_sketches_' + location + version
+merge_sketch_bases = []
+DEFAULT_CHUNK_ROWS = 1_000_000
+# Port and domain ids of a pair are combined as port id * PAIR_BASE + domain id
+PAIR_BASE = 1 << 32
 
-# Filter requests by protocol
-http_df = requests_df[requests_df['protocol'].str.lower() == 'http']
-websocket_df = requests_df[requests_df['protocol'].str.lower() == 'websocket']
+# Columns the summaries count on, dictionary-encoded once per table
+ENCODED_COLUMNS = ['final_url', 'script_domain', 'port_num']
 
-# Helper function
-def get_summary(df, label):
-    unique_final_urls = df['final_url'].nunique()
+def encode_results(df):
+    """
+    Dictionary-encode the summary columns of a results table once.
+    Codes are shifted by one so 0 stands for a missing value, categories are sorted so codes order like the values.
+    Returns a dict of column -> (codes, uniques).
+    """
+    encoded = {}
+    for column in ENCODED_COLUMNS:
+        codes, uniques = pd.factorize(df[column], sort=True)
+        encoded[column] = (codes.astype(np.int64) + 1, uniques)
+    return encoded
+
+def sorted_unique(values):
+    """
+    Sorted unique values of an int array, by sorting (faster than np.unique's hashing on large arrays).
+    """
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+def distinct_per_group(groups, values, value_count):
+    """
+    Count the distinct non-missing values per non-missing group, for code arrays where 0 is missing.
+    Returns the present group codes (sorted) and their counts.
+    """
+    pairs = sorted_unique(groups * value_count + values)
+    pair_groups = pairs // value_count
+    pair_values = pairs % value_count
+    keep = pair_groups > 0
+    pair_groups = pair_groups[keep]
+    present = sorted_unique(pair_groups)
+    counts = np.bincount(pair_groups, weights=pair_values[keep] > 0)[present]
+    return present, counts.astype(np.int64)
+
+def unique_triples(ports, domains, urls, port_count, domain_count, url_count):
+    """
+    Deduplicate (port, domain, final url) code triples, codes are below the given counts.
+    Returns the ports, domains and urls of the unique triples.
+    """
+    if port_count * domain_count * url_count < 2 ** 62:
+        triples = sorted_unique((ports * domain_count + domains) * url_count + urls)
+        return triples // (domain_count * url_count), (triples // url_count) % domain_count, triples % url_count
+    triples = pd.DataFrame({'port_num': ports, 'script_domain': domains, 'final_url': urls}).drop_duplicates()
+    return triples['port_num'].to_numpy(), triples['script_domain'].to_numpy(), triples['final_url'].to_numpy()
+
+def aggregate(encoded, mask=None):
+    """
+    Compute all distinct counts of a summary in a single pass over the (port, domain, final url) triples of the rows in mask.
+    Returns a dict with the unique final url count and the per-domain, per-port and per-(port, domain) distinct counts as Series.
+    """
+    codes = {column: encoded[column][0] if mask is None else encoded[column][0][mask] for column in ENCODED_COLUMNS}
+    uniques = {column: encoded[column][1] for column in ENCODED_COLUMNS}
+
+    # The only pass over the rows: deduplicate the (port, domain, url) triples
+    ports, domains, urls = unique_triples(
+        codes['port_num'], codes['script_domain'], codes['final_url'],
+        len(uniques['port_num']) + 1, len(uniques['script_domain']) + 1, len(uniques['final_url']) + 1,
+    )
+    return aggregate_triples(ports, domains, urls, uniques)
+
+def aggregate_triples(ports, domains, urls, uniques):
+    """
+    Compute the distinct counts of a summary from its unique (port, domain, final url) code triples and the values of the codes.
+    """
+    url_count = len(uniques['final_url']) + 1
+    domain_count = len(uniques['script_domain']) + 1
+    port_count = len(uniques['port_num']) + 1
+
+    def series(present, counts, column):
+        return pd.Series(counts, index=pd.Index(uniques[column].take(present - 1), name=column))
+
+    domain_codes, domain_url_counts = distinct_per_group(domains, urls, url_count)
+    port_domain_codes, port_domain_counts = distinct_per_group(domains, ports, port_count)
+    url_port_codes, port_url_counts = distinct_per_group(ports, urls, url_count)
 
-    domain_final_url_counts = df.groupby('script_domain')['final_url'].nunique()
-    domain_port_counts = df.groupby('script_domain')['port_num'].nunique()
+    pair_codes, pair_url_counts = distinct_per_group(np.where((ports > 0) & (domains > 0), ports * domain_count + domains, 0), urls, url_count)
+    pair_ports = pair_codes // domain_count
+    pair_domains = pair_codes % domain_count
+    port_domain_url_counts = pd.DataFrame({
+        'port_num': uniques['port_num'].take(pair_ports - 1),
+        'script_domain': uniques['script_domain'].take(pair_domains - 1),
+        'unique_final_urls_count': pair_url_counts,
+    })
+
+    return {
+        "unique_final_url_count": int(np.count_nonzero(sorted_unique(urls))),
+        "domain_final_url_counts": series(domain_codes, domain_url_counts, 'script_domain'),
+        "domain_port_counts": series(port_domain_codes, port_domain_counts, 'script_domain'),
+        "port_final_url_counts": series(url_port_codes, port_url_counts, 'port_num'),
+        "port_domain_final_url_counts": port_domain_url_counts,
+    }
+
+def build_summary(aggregates, label):
+    """
+    Build the summary and its Markdown section from the aggregates of a table.
+    """
+    unique_final_urls = aggregates["unique_final_url_count"]
+    domain_final_url_counts = aggregates["domain_final_url_counts"]
+    domain_port_counts = aggregates["domain_port_counts"]
 
     # Filter by threshold for unique final URLs per domain
     filtered_domains = domain_final_url_counts[domain_final_url_counts >= min_urls_threshold].index
     filtered_port_counts = domain_port_counts.loc[filtered_domains].sort_values(ascending=False).head(10)
 
     # Top script domain per port based on unique final_urls
-    grouped = df.groupby(['port_num', 'script_domain'])['final_url'].nunique().reset_index(name='unique_final_urls_count')
+    grouped = aggregates["port_domain_final_url_counts"]
 
     # No filter applied anymore
     top_script_domain_per_port = (
@@ -63,13 +173,21 @@ def get_summary(df, label):
         "top_script_domains_by_unique_ports": domain_port_counts.sort_values(ascending=False).head(10),
         "top_script_domains_by_unique_ports_min_urls": filtered_port_counts,
         "top_script_domains_by_unique_final_urls": domain_final_url_counts.sort_values(ascending=False).head(10),
-        "top_ports_by_unique_final_urls": df.groupby('port_num')['final_url'].nunique().sort_values(ascending=False),
+        "top_ports_by_unique_final_urls": aggregates["port_final_url_counts"].sort_values(ascending=False),
         "top_script_domain_per_port": top_script_domain_per_port_dict  # Use the list of dictionaries
     }
 
+    # Estimated counts say how far off they may be
+    if "relative_error" in aggregates:
+        summary["distinct_count_relative_error"] = aggregates["relative_error"]
+
     # Markdown
     markdown = f"## {label} Summary\n"
     markdown += f"**Total Unique Final URLs:** {unique_final_urls}\n\n"
+    if "relative_error" in aggregates:
+        errors = aggregates["relative_error"]
+        markdown += (f"*Unique final URL counts are HyperLogLog estimates, relative standard error {errors['total']:.2%} for the total "
+                     f"and {errors['keyed']:.2%} per domain and port.*\n\n")
 
     for key, series in summary.items():
         if key == "top_script_domain_per_port":
@@ -90,29 +208,343 @@ def get_summary(df, label):
 
     return summary, markdown
 
-# Summaries
-webrtc_summary, webrtc_md = get_summary(webrtc_df, "WebRTC")
-http_summary, http_md = get_summary(http_df, "HTTP Requests")
-ws_summary, ws_md = get_summary(websocket_df, "WebSocket Requests")
-# resolved_summary, resolved_md = get_summary(resolved_df, "Resolved Requests")
-
-# JSON output
-summary_dict = {
-    "webrtc": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in webrtc_summary.items()},
-    "http_requests": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in http_summary.items()},
-    "websocket_requests": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in ws_summary.items()},
-    # "resolved_requests:": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in resolved_summary.items()}
-}
-
-with open(output_json_path, 'w') as f:
-    json.dump(summary_dict, f, indent=4)
-
-# Markdown output
-with open(markdown_output_path, 'w') as f:
-    f.write("# Summary Report\n\n")
-    f.write(webrtc_md)
-    f.write(http_md)
-    f.write(ws_md)
-    # f.write(resolved_md)
-
-print(f"Summary written to:\n- {output_json_path}\n- {markdown_output_path}")
+def get_summary(df, label):
+    """
+    Summarize a results table.
+    """
+    return build_summary(aggregate(encode_results(df)), label)
+
+def protocol_mask(df, protocol):
+    """
+    Mask of the rows of a requests table with the given protocol (case-insensitive), computed on the encoded protocols.
+    """
+    codes, uniques = pd.factorize(df['protocol'])
+    matching = [i for i, value in enumerate(uniques) if str(value).lower() == protocol]
+    return np.isin(codes, matching)
+
+def port_key(value):
+    """
+    Key of a port value that is the same whether a chunk read it as an int, a float or a string.
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return int(number) if number.is_integer() else number
+
+class ValueIds:
+    """
+    Dictionary encoding of a column that grows chunk by chunk.
+    Ids start at 1 so 0 stands for a missing value, they are in order of appearance until sorted_codes() sorts them.
+    """
+    def __init__(self, normalize=None):
+        self.normalize = normalize
+        self.ids = {}
+        self.values = []
+        self.missing = False
+
+    def __len__(self):
+        return len(self.values)
+
+    def id(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            self.values.append(value)
+            value_id = self.ids[value] = len(self.values)
+        return value_id
+
+    def encode(self, column):
+        """
+        Get the ids of the values of a chunk's column, only its distinct values go through the dictionary.
+        """
+        codes, uniques = pd.factorize(column)
+        if self.normalize is not None:
+            uniques = [self.normalize(value) for value in uniques]
+        self.missing = self.missing or bool((codes < 0).any())
+        lookup = np.array([0] + [self.id(value) for value in uniques], dtype=np.int64)
+        return lookup[codes + 1]
+
+    def typed_values(self):
+        if self.normalize is not port_key:
+            return np.array(self.values, dtype=object)
+        # Ports read whole are ints, floats if any is missing and strings if any is not a number
+        if all(isinstance(value, (int, float)) for value in self.values):
+            is_float = self.missing or any(isinstance(value, float) for value in self.values)
+            return np.array(self.values, dtype=np.float64 if is_float else np.int64)
+        return np.array([str(value) for value in self.values], dtype=object)
+
+    def sorted_codes(self):
+        """
+        Map the ids to codes in value order, like the codes of pd.factorize(sort=True) shifted by one.
+        Returns the id -> code array (0 stays 0) and the values by code.
+        """
+        values = self.typed_values()
+        order = np.argsort(values, kind="stable")
+        codes = np.zeros(len(values) + 1, dtype=np.int64)
+        codes[order + 1] = np.arange(1, len(values) + 1)
+        return codes, pd.Index(values[order])
+
+class ChunkEncoder:
+    """
+    Encodes the summary columns of the chunks of one results table with dictionaries shared by all chunks.
+    Final urls get ids for exact counts, or only hashes for the sketches, so no final url is kept in memory.
+    """
+    def __init__(self, approximate : bool):
+        self.approximate = approximate
+        self.domains = ValueIds()
+        self.ports = ValueIds(port_key)
+        self.urls = None if approximate else ValueIds()
+
+    def encode(self, chunk):
+        encoded = {
+            'script_domain': self.domains.encode(chunk['script_domain']),
+            'port_num': self.ports.encode(chunk['port_num']),
+        }
+        if self.urls is not None:
+            encoded['final_url'] = self.urls.encode(chunk['final_url'])
+        else:
+            codes, uniques = pd.factorize(chunk['final_url'])
+            encoded['url_present'] = codes >= 0
+            encoded['url_hashes'] = hash_values(uniques)[codes] if len(uniques) else np.zeros(len(codes), dtype=np.uint64)
+        return encoded
+
+class ExactAggregator:
+    """
+    Streaming version of aggregate(): keeps the unique (port, domain, final url) id triples of the chunks seen so far.
+    """
+    def __init__(self, encoder : ChunkEncoder):
+        self.encoder = encoder
+        self.triples = np.zeros((0, 3), dtype=np.int64)
+        self.pending = []
+        self.pending_rows = 0
+
+    def update(self, encoded, mask=None):
+        ports, domains, urls = (encoded[column] if mask is None else encoded[column][mask] for column in ('port_num', 'script_domain', 'final_url'))
+        triples = np.column_stack(self.unique(ports, domains, urls))
+        self.pending.append(triples)
+        self.pending_rows += len(triples)
+        # Amortized compaction, the pending triples never outgrow the compacted ones by much
+        if self.pending_rows > max(len(self.triples), DEFAULT_CHUNK_ROWS):
+            self.compact()
+
+    def unique(self, ports, domains, urls):
+        encoder = self.encoder
+        return unique_triples(ports, domains, urls, len(encoder.ports) + 1, len(encoder.domains) + 1, len(encoder.urls) + 1)
+
+    def compact(self):
+        triples = np.concatenate([self.triples] + self.pending)
+        self.triples = np.column_stack(self.unique(triples[:, 0], triples[:, 1], triples[:, 2]))
+        self.pending = []
+        self.pending_rows = 0
+
+    def result(self):
+        self.compact()
+        port_codes, port_uniques = self.encoder.ports.sorted_codes()
+        domain_codes, domain_uniques = self.encoder.domains.sorted_codes()
+        url_codes, url_uniques = self.encoder.urls.sorted_codes()
+        uniques = {'port_num': port_uniques, 'script_domain': domain_uniques, 'final_url': url_uniques}
+        return aggregate_triples(port_codes[self.triples[:, 0]], domain_codes[self.triples[:, 1]], url_codes[self.triples[:, 2]], uniques)
+
+class SketchAggregator:
+    """
+    Streaming, approximate version of aggregate(): HyperLogLog sketches of the final urls in total, per domain,
+    per port and per (port, domain), and the exact set of (port, domain) pairs for the port counts per domain.
+    Sketches can be saved and merged with the sketches of other runs.
+    """
+    def __init__(self, encoder : ChunkEncoder, precision : int = SKETCH_PRECISION, keyed_precision : int = KEYED_SKETCH_PRECISION):
+        self.encoder = encoder
+        self.urls = HyperLogLog(precision)
+        # Keyed by domain id - 1, port id - 1 and pair id
+        self.domain_urls = KeyedHyperLogLog(keyed_precision)
+        self.port_urls = KeyedHyperLogLog(keyed_precision)
+        self.pair_urls = KeyedHyperLogLog(keyed_precision)
+        # Ids of the domains and ports of this table's rows (the encoder may be shared with other masks)
+        self.domain_ids = set()
+        self.port_ids = set()
+        # Pair id -> port id * PAIR_BASE + domain id, and the same codes sorted with their pair ids for lookups
+        self.pair_codes = np.zeros(0, dtype=np.int64)
+        self.sorted_pair_codes = np.zeros(0, dtype=np.int64)
+        self.sorted_pair_ids = np.zeros(0, dtype=np.int64)
+
+    def pair_ids(self, ports, domains):
+        """
+        Get the ids of (port id, domain id) pairs, new pairs get the next ids.
+        """
+        codes = ports * PAIR_BASE + domains
+        uniques = sorted_unique(codes)
+        positions = np.searchsorted(self.sorted_pair_codes, uniques)
+        known = positions < len(self.sorted_pair_codes)
+        known[known] = self.sorted_pair_codes[positions[known]] == uniques[known]
+        if not known.all():
+            self.pair_codes = np.concatenate((self.pair_codes, uniques[~known]))
+            self.sorted_pair_ids = np.argsort(self.pair_codes, kind="stable")
+            self.sorted_pair_codes = self.pair_codes[self.sorted_pair_ids]
+        return self.sorted_pair_ids[np.searchsorted(self.sorted_pair_codes, codes)]
+
+    def update(self, encoded, mask=None):
+        ports, domains, present, hashes = (encoded[column] if mask is None else encoded[column][mask] for column in ('port_num', 'script_domain', 'url_present', 'url_hashes'))
+        self.domain_ids.update(sorted_unique(domains[domains > 0]).tolist())
+        self.port_ids.update(sorted_unique(ports[ports > 0]).tolist())
+        self.urls.add_hashes(hashes[present])
+
+        with_domain = present & (domains > 0)
+        self.domain_urls.add_hashes(domains[with_domain] - 1, hashes[with_domain])
+        with_port = present & (ports > 0)
+        self.port_urls.add_hashes(ports[with_port] - 1, hashes[with_port])
+
+        in_pair = (ports > 0) & (domains > 0)
+        pair_ids = self.pair_ids(ports[in_pair], domains[in_pair])
+        self.pair_urls.add_hashes(pair_ids[present[in_pair]], hashes[in_pair & present])
+
+    def save(self, path : str):
+        """
+        Save the sketches with the values they are keyed by.
+        """
+        keys = {
+            "domains": self.encoder.domains.values,
+            "ports": self.encoder.ports.values,
+            "port_missing": self.encoder.ports.missing,
+            "domain_ids": sorted(self.domain_ids),
+            "port_ids": sorted(self.port_ids),
+        }
+        sketches = {"domain_urls": self.domain_urls, "port_urls": self.port_urls, "pair_urls": self.pair_urls}
+        arrays = {f"{name}_{array}": value for name, keyed in sketches.items() for array, value in keyed.to_arrays().items()}
+        np.savez(path, keys=np.array(json.dumps(keys)), urls=self.urls.registers, pair_codes=self.pair_codes, **arrays)
+
+    def merge_file(self, path : str):
+        """
+        Merge the sketches saved by another run, which have to have the same precisions.
+        """
+        with np.load(path) as data:
+            keys = json.loads(str(data["keys"]))
+            self.urls.merge(HyperLogLog(int(np.log2(len(data["urls"]))), data["urls"]))
+            domain_ids = np.array([0] + [self.encoder.domains.id(value) for value in keys["domains"]], dtype=np.int64)
+            port_ids = np.array([0] + [self.encoder.ports.id(value) for value in keys["ports"]], dtype=np.int64)
+            self.encoder.ports.missing = self.encoder.ports.missing or keys["port_missing"]
+            self.domain_ids.update(domain_ids[keys["domain_ids"]].tolist())
+            self.port_ids.update(port_ids[keys["port_ids"]].tolist())
+            pair_ids = self.pair_ids(port_ids[data["pair_codes"] // PAIR_BASE], domain_ids[data["pair_codes"] % PAIR_BASE])
+
+            def saved(name):
+                return KeyedHyperLogLog.from_arrays({array: data[f"{name}_{array}"] for array in ("codes", "ranks", "dense_rows", "dense", "precision")})
+
+            self.domain_urls.merge(saved("domain_urls"), domain_ids[1:] - 1)
+            self.port_urls.merge(saved("port_urls"), port_ids[1:] - 1)
+            self.pair_urls.merge(saved("pair_urls"), pair_ids)
+
+    def result(self):
+        """
+        Get the aggregates like aggregate() does, with the final url counts rounded to the nearest integer.
+        """
+        port_codes, port_uniques = self.encoder.ports.sorted_codes()
+        domain_codes, domain_uniques = self.encoder.domains.sorted_codes()
+        self.domain_urls.grow(len(self.encoder.domains))
+        self.port_urls.grow(len(self.encoder.ports))
+        self.pair_urls.grow(len(self.pair_codes))
+
+        def counts(sketches, ids):
+            return np.rint(sketches.counts()[ids]).astype(np.int64)
+
+        domain_ids = np.array(sorted(self.domain_ids, key=lambda i: domain_codes[i]), dtype=np.int64)
+        port_ids = np.array(sorted(self.port_ids, key=lambda i: port_codes[i]), dtype=np.int64)
+        pairs = np.column_stack((self.pair_codes // PAIR_BASE, self.pair_codes % PAIR_BASE))
+        pair_order = np.lexsort((domain_codes[pairs[:, 1]], port_codes[pairs[:, 0]]))
+        ports_per_domain = np.bincount(pairs[:, 1], minlength=len(self.encoder.domains) + 1)
+
+        domain_index = pd.Index(domain_uniques.take(domain_codes[domain_ids] - 1), name='script_domain')
+        return {
+            "unique_final_url_count": int(round(self.urls.count())),
+            "domain_final_url_counts": pd.Series(counts(self.domain_urls, domain_ids - 1), index=domain_index),
+            "domain_port_counts": pd.Series(ports_per_domain[domain_ids], index=domain_index),
+            "port_final_url_counts": pd.Series(counts(self.port_urls, port_ids - 1), index=pd.Index(port_uniques.take(port_codes[port_ids] - 1), name='port_num')),
+            "port_domain_final_url_counts": pd.DataFrame({
+                'port_num': port_uniques.take(port_codes[pairs[pair_order, 0]] - 1),
+                'script_domain': domain_uniques.take(domain_codes[pairs[pair_order, 1]] - 1),
+                'unique_final_urls_count': counts(self.pair_urls, pair_order),
+            }),
+            "relative_error": {"total": self.urls.relative_error, "keyed": self.domain_urls.relative_error},
+        }
+
+def summarize_in_memory():
+    """
+    Aggregate the result tables read whole.
+    """
+    webrtc_df = read_results(webrtc_csv_path)
+    requests_df = read_results(requests_csv_path)
+    # resolved_df = pd.read_csv(resolved_csv_path)
+
+    # Encode the requests once for both protocols
+    requests_encoded = encode_results(requests_df)
+    return {
+        "webrtc": aggregate(encode_results(webrtc_df)),
+        "http_requests": aggregate(requests_encoded, protocol_mask(requests_df, 'http')),
+        "websocket_requests": aggregate(requests_encoded, protocol_mask(requests_df, 'websocket')),
+    }
+
+def summarize_chunked():
+    """
+    Aggregate the result tables chunk by chunk, exactly or with sketches if APPROXIMATE_DISTINCT.
+    """
+    chunk_rows = CHUNK_ROWS or DEFAULT_CHUNK_ROWS
+    dtype = {'final_url': str, 'script_domain': str, 'protocol': str}
+
+    def aggregator(encoder):
+        return SketchAggregator(encoder) if APPROXIMATE_DISTINCT else ExactAggregator(encoder)
+
+    webrtc_encoder = ChunkEncoder(APPROXIMATE_DISTINCT)
+    webrtc = aggregator(webrtc_encoder)
+    for chunk in iter_results(webrtc_csv_path, ENCODED_COLUMNS, chunk_rows, dtype):
+        webrtc.update(webrtc_encoder.encode(chunk))
+
+    requests_encoder = ChunkEncoder(APPROXIMATE_DISTINCT)
+    http = aggregator(requests_encoder)
+    ws = aggregator(requests_encoder)
+    for chunk in iter_results(requests_csv_path, ENCODED_COLUMNS + ['protocol'], chunk_rows, dtype):
+        encoded = requests_encoder.encode(chunk)
+        http.update(encoded, protocol_mask(chunk, 'http'))
+        ws.update(encoded, protocol_mask(chunk, 'websocket'))
+
+    aggregators = {"webrtc": webrtc, "http_requests": http, "websocket_requests": ws}
+    if APPROXIMATE_DISTINCT:
+        for table, sketches in aggregators.items():
+            # Save this run's sketches before merging in the others
+            sketches.save(f"{sketch_output_base}_{table}.npz")
+            for base in merge_sketch_bases:
+                sketches.merge_file(f"{base}_{table}.npz")
+    return {table: aggregator.result() for table, aggregator in aggregators.items()}
+
+def main():
+    if CHUNK_ROWS is None and not APPROXIMATE_DISTINCT:
+        aggregates = summarize_in_memory()
+    else:
+        aggregates = summarize_chunked()
+
+    # Summaries
+    webrtc_summary, webrtc_md = build_summary(aggregates["webrtc"], "WebRTC")
+    http_summary, http_md = build_summary(aggregates["http_requests"], "HTTP Requests")
+    ws_summary, ws_md = build_summary(aggregates["websocket_requests"], "WebSocket Requests")
+    # resolved_summary, resolved_md = get_summary(resolved_df, "Resolved Requests")
+
+    # JSON output
+    summary_dict = {
+        "webrtc": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in webrtc_summary.items()},
+        "http_requests": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in http_summary.items()},
+        "websocket_requests": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in ws_summary.items()},
+        # "resolved_requests:": {k: v.to_dict() if isinstance(v, pd.Series) else v for k, v in resolved_summary.items()}
+    }
+
+    with open(output_json_path, 'w') as f:
+        json.dump(summary_dict, f, indent=4)
+
+    # Markdown output
+    with open(markdown_output_path, 'w') as f:
+        f.write("# Summary Report\n\n")
+        f.write(webrtc_md)
+        f.write(http_md)
+        f.write(ws_md)
+        # f.write(resolved_md)
+
+    print(f"Summary written to:\n- {output_json_path}\n- {markdown_output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+# Localhost request urls as trackers send them, {port} is filled in from LOCALHOST_PORTS
+LOCALHOST_URL_TEMPLATES = [
+    "http://localhost:{port}/",
+    "http://127.0.0.1:{port}/status",
+    "ws://127.0.0.1:{port}/websocket",
+    "wss://localhost:{port}/ws",
+    "http://[::1]:{port}/ping",
+    "http://0.0.0.0:{port}/",
+    "http://localhost/track.gif",
+]
+LOCALHOST_PORTS = [3000, 5000, 8080, 8443, 12387, 12388, 12580, 12581, 29009, 30102, 45112]
+REQUEST_TYPES = ["Script", "XHR", "Image", "Stylesheet", "Fetch", "Document", "Other"]
+TLDS = ["com", "org", "net", "de", "co.uk", "io"]
+IPV4_PORT_PATTERN = re.compile(r"\d+\.\d+\.\d+\.\d+\s+(\d+)")
+SCTP_PORT_PATTERN = re.compile(r"a=sctp-port:(\d+)")
+# Ranks are given in CrUX buckets
+RANK_BUCKETS = [1000, 5000, 10000, 50000, 100000, 500000, 1000000]
+
+class FakeDns:
+    """
+    Offline stand-in for the DNS with a deterministic answer per hostname (and seed).
+    A localhost_rate fraction of the hostnames resolve to 127.0.0.1 (like rebinding tracker domains), a failure_rate fraction
+    does not resolve, the others resolve to an address of TEST-NET-3 (203.0.113.0/24).
+    Every lookup sleeps latency seconds, to stand in for the network.
+    Install it with dns_resolution.custom_resolver = FakeDns(...), forked workers inherit it.
+    """
+    def __init__(self, localhost_rate : float = 0.1, failure_rate : float = 0.02, latency : float = 0.0, seed : int = 0):
+        self.localhost_rate = localhost_rate
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.seed = seed
+
+    def draw(self, hostname : str):
+        """
+        Map hostname to a number in [0, 1), the same for the same hostname and seed.
+        """
+        digest = hashlib.blake2b(f"{self.seed}:{hostname}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64
+
+    def __call__(self, hostname : str):
+        """
+        Resolve hostname.
+        Returns the list of its addresses, empty if it does not resolve.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        draw = self.draw(hostname)
+        if draw < self.localhost_rate:
+            return ["127.0.0.1"]
+        if draw < self.localhost_rate + self.failure_rate:
+            return []
+        return [f"203.0.113.{int(draw * 2 ** 32) % 254 + 1}"]
+
+def monitor_port(candidate : str):
+    """
+    Port of a candidate as extractPort of the monitor finds it: after an IPv4 address, else the SCTP port.
+    """
+    match = IPV4_PORT_PATTERN.search(candidate) or SCTP_PORT_PATTERN.search(candidate)
+    return match.group(1) if match else "N/A"
+
+def unique_url_name(url : str, hostname : str):
+    """
+    File name of the crawl of url, like createUniqueUrlName of the crawler.
+    """
+    return f"{hostname}_{hashlib.sha1(url.encode()).hexdigest()[:4]}"
+
+class CorpusGenerator:
+    """
+    Generates crawl files in the output shape of crawl-cli, with the fields the analysis reads and some of the bulk it skips.
+    Draws are made from one seeded random generator, so the same parameters always give the same corpus.
+    """
+    def __init__(self, requests_per_file : int = 40, localhost_rate : float = 0.01, port_rate : float = 0.01,
+                 hostname_count : int = 1000, script_count : int = None, webrtc_per_file : float = 0.5,
+                 webrtc_localhost_rate : float = 0.3, payload_bytes : int = 200, empty_rate : float = 0.02, seed : int = 0):
+        self.random = random.Random(seed)
+        self.requests_per_file = requests_per_file
+        self.localhost_rate = localhost_rate
+        self.port_rate = port_rate
+        self.webrtc_per_file = webrtc_per_file
+        self.webrtc_localhost_rate = webrtc_localhost_rate
+        self.empty_rate = empty_rate
+        self.payload = "x" * payload_bytes
+        # Third party hostnames of the requests, the ones with an explicit port have to be resolved by the analysis
+        self.hostnames = [f"h{number}.domain{number // 4}.{TLDS[number % len(TLDS)]}" for number in range(max(hostname_count, 1))]
+        script_count = script_count or max(hostname_count // 10, 1)
+        self.scripts = [f"https://cdn{number % 97}.scripts{number}.{TLDS[number % len(TLDS)]}/sdk/v{number % 7}/tag.js" for number in range(script_count)]
+        self.stats = {"files": 0, "bytes": 0, "requests": 0, "localhost_requests": 0, "port_requests": 0,
+                      "webRTC_calls": 0, "localhost_webRTC_calls": 0, "empty_files": 0}
+
+    def initiators(self):
+        if self.random.random() < 0.1:
+            return []
+        return [self.random.choice(self.scripts) for _ in range(self.random.randint(1, 3))]
+
+    def request(self, page_url : str):
+        draw = self.random.random()
+        if draw < self.localhost_rate:
+            self.stats["localhost_requests"] += 1
+            url = self.random.choice(LOCALHOST_URL_TEMPLATES).format(port=self.random.choice(LOCALHOST_PORTS))
+        elif draw < self.localhost_rate + self.port_rate:
+            self.stats["port_requests"] += 1
+            scheme = self.random.choice(["https", "http", "wss"])
+            url = f"{scheme}://{self.random.choice(self.hostnames)}:{self.random.choice(LOCALHOST_PORTS)}/collect?id={self.random.getrandbits(32)}"
+        elif draw < 0.3:
+            url = f"{page_url}static/{self.random.getrandbits(24):06x}.js"
+        else:
+            url = f"https://{self.random.choice(self.hostnames)}/p/{self.random.getrandbits(32):08x}?v={self.random.randint(1, 9)}"
+        request_type = "WebSocket" if url.startswith("ws") else self.random.choice(REQUEST_TYPES)
+        return {
+            "url": url,
+            "method": "GET",
+            "type": request_type,
+            "status": self.random.choice([200, 200, 200, 204, 301, 404]),
+            "size": self.random.randint(0, 100_000),
+            "remoteIPAddress": "203.0.113.7",
+            "responseHeaders": {"content-type": "text/plain", "x-padding": self.payload},
+            "initiators": self.initiators(),
+            "time": round(self.random.random(), 4),
+            "wallTime": 1_740_000_000 + self.random.random(),
+        }
+
+    def candidate(self, localhost : bool):
+        """
+        ICE candidate line, on a loopback address if localhost.
+        """
+        address = self.random.choice(["127.0.0.1", "::1", "localhost", "0.0.0.0"]) if localhost else f"192.0.2.{self.random.randint(1, 254)}"
+        return f"candidate:{self.random.getrandbits(32)} 1 udp 2122260223 {address} {self.random.choice(LOCALHOST_PORTS)} typ host generation 0"
+
+    def sdp(self, localhost : bool):
+        # Browsers put 127.0.0.1 and 0.0.0.0 in the origin and connection lines, only localhost descriptions get them here
+        origin, connection = ("127.0.0.1", "0.0.0.0") if localhost else ("192.0.2.1", "192.0.2.1")
+        lines = ["v=0", f"o=- {self.random.getrandbits(60)} 2 IN IP4 {origin}", "s=-", "t=0 0",
+                 "m=application 9 UDP/DTLS/SCTP webrtc-datachannel", f"c=IN IP4 {connection}"]
+        if localhost:
+            lines.append("a=" + self.candidate(True))
+        lines.append(f"a=sctp-port:{self.random.choice([5000, 5000, 5001])}")
+        return "\r\n".join(lines) + "\r\n"
+
+    def webRTC_call(self):
+        """
+        WebRTC call as recorded by helpers/webRTCMonitor.js.
+        """
+        source = self.random.choice(self.scripts)
+        call_type = self.random.choice(["RTCPeerConnection", "RTCDataChannel", "ICECandidate", "SDP-Local", "SDP-Remote"])
+        localhost = call_type in ("ICECandidate", "SDP-Local", "SDP-Remote") and self.random.random() < self.webrtc_localhost_rate
+        if call_type == "RTCPeerConnection":
+            candidate = json.dumps([{"iceServers": [{"urls": "stun:stun.l.google.com:19302"}]}])
+        elif call_type == "RTCDataChannel":
+            candidate = json.dumps(["channel"])
+        elif call_type == "ICECandidate":
+            candidate = self.candidate(localhost)
+        else:
+            candidate = self.sdp(localhost)
+
+        if call_type in ("RTCPeerConnection", "RTCDataChannel"):
+            detected, port = "None", "N/A"
+        else:
+            # Same detection as saveCallData of the monitor, which checks for any localhost string in the data
+            detected = next((variant for variant in ("127.0.0.1", "::1", "localhost", "0.0.0.0") if variant in candidate), "None")
+            port = monitor_port(candidate)
+        if detected != "None":
+            self.stats["localhost_webRTC_calls"] += 1
+        return {
+            "source": source,
+            "type": call_type,
+            "localhost": detected,
+            "port": port,
+            "candidate": candidate,
+            "timestamp": "2025-02-20T12:00:00.000Z",
+            "stack": [f"    at connect ({source}:1:{self.random.randint(1, 90000)})"],
+        }
+
+    def webRTC_call_count(self):
+        whole = int(self.webrtc_per_file)
+        return whole + (self.random.random() < self.webrtc_per_file - whole)
+
+    def crawl(self, number : int):
+        """
+        Crawl result of the number-th site.
+        Returns the initial url and the crawl dict.
+        """
+        hostname = f"site{number}.{TLDS[number % len(TLDS)]}"
+        initial_url = f"https://{hostname}/"
+        final_url = f"https://www.{hostname}/" if number % 3 else initial_url
+        crawl = {"initialUrl": initial_url, "finalUrl": final_url, "timeout": False,
+                 "testStarted": 1_740_000_000_000 + number, "testFinished": 1_740_000_020_000 + number}
+        if self.random.random() < self.empty_rate:
+            # Failed crawls have no data
+            self.stats["empty_files"] += 1
+            crawl["data"] = {}
+            return initial_url, hostname, crawl
+
+        request_count = self.random.randint(1, max(2 * self.requests_per_file - 1, 1))
+        webRTC_count = self.webRTC_call_count()
+        self.stats["requests"] += request_count
+        self.stats["webRTC_calls"] += webRTC_count
+        crawl["data"] = {
+            "requests": [self.request(final_url) for _ in range(request_count)],
+            "webRTC": [self.webRTC_call() for _ in range(webRTC_count)],
+            "cookies": [{"name": "_ga", "domain": "." + hostname, "value": self.payload[:40]}],
+        }
+        return initial_url, hostname, crawl
+
+    def write(self, output_folder : str, file_count : int):
+        """
+        Write file_count crawl files and a metadata.json to output_folder.
+        Returns the generation stats.
+        """
+        os.makedirs(output_folder, exist_ok=True)
+        for number in range(file_count):
+            initial_url, hostname, crawl = self.crawl(number)
+            text = json.dumps(crawl, indent=2)
+            with open(os.path.join(output_folder, unique_url_name(initial_url, hostname) + ".json"), "w", encoding="utf-8") as f:
+                f.write(text)
+            self.stats["files"] += 1
+            self.stats["bytes"] += len(text)
+        with open(os.path.join(output_folder, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump({"startTime": 1_740_000_000_000, "endTime": 1_740_000_000_000 + file_count, "result": "success",
+                       "stats": {"urls": file_count, "skipped": 0, "successes": file_count, "failures": 0},
+                       "config": {"dataCollectors": ["requests", "webRTC", "cookies"]}}, f, indent=2)
+        return dict(self.stats)
+
+def write_rank_file(path : str, file_count : int, ranked_rate : float = 0.8, seed : int = 0):
+    """
+    Write a CrUX-style rank file (origin,crux_rank) covering a ranked_rate fraction of the generated sites.
+    """
+    generator = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("origin,crux_rank\n")
+        for number in range(file_count):
+            if generator.random() < ranked_rate:
+                f.write(f"https://site{number}.{TLDS[number % len(TLDS)]},{generator.choice(RANK_BUCKETS)}\n")
+
+def generate_corpus(output_folder : str, file_count : int, rank_file_path : str = None, seed : int = 0, **parameters):
+    """
+    Generate a synthetic crawl corpus, the parameters are those of CorpusGenerator.
+    Also writes a rank file for it if rank_file_path is given.
+    Returns the generation stats.
+    """
+    stats = CorpusGenerator(seed=seed, **parameters).write(output_folder, file_count)
+    if rank_file_path:
+        write_rank_file(rank_file_path, file_count, seed=seed)
+    return stats
+
+def add_corpus_arguments(parser : argparse.ArgumentParser):
+    parser.add_argument("--files", type=int, default=1000, help="number of crawl files")
+    parser.add_argument("--requests-per-file", type=int, default=40, help="mean number of requests per file")
+    parser.add_argument("--localhost-rate", type=float, default=0.01, help="fraction of requests to a localhost url")
+    parser.add_argument("--port-rate", type=float, default=0.01, help="fraction of requests to a hostname with an explicit port")
+    parser.add_argument("--hostnames", type=int, default=1000, help="number of distinct third party hostnames")
+    parser.add_argument("--webrtc-per-file", type=float, default=0.5, help="mean number of WebRTC calls per file")
+    parser.add_argument("--webrtc-localhost-rate", type=float, default=0.3, help="fraction of candidate and SDP calls on localhost")
+    parser.add_argument("--payload-bytes", type=int, default=200, help="padding per request, to tune the file size")
+    parser.add_argument("--empty-rate", type=float, default=0.02, help="fraction of files without data")
+    parser.add_argument("--seed", type=int, default=0)
+
+def corpus_parameters(args : argparse.Namespace):
+    return {
+        "requests_per_file": args.requests_per_file,
+        "localhost_rate": args.localhost_rate,
+        "port_rate": args.port_rate,
+        "hostname_count": args.hostnames,
+        "webrtc_per_file": args.webrtc_per_file,
+        "webrtc_localhost_rate": args.webrtc_localhost_rate,
+        "payload_bytes": args.payload_bytes,
+        "empty_rate": args.empty_rate,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic crawl corpus")
+    parser.add_argument("output_folder")
+    parser.add_argument("--rank-file", help="also write a rank file for the corpus")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    stats = generate_corpus(args.output_folder, args.files, args.rank_file, args.seed, **corpus_parameters(args))
+    print(json.dumps(stats, indent=4))
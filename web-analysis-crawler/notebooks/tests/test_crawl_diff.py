@@ -0,0 +1,63 @@
+import csv
+import random
+
+import pandas as pd
+import pytest
+
+from crawl_diff import CrawlIndex, KEY_COLUMNS, diff, mark_rows
+
+def write_results(path : str, rows : list):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tested_url", "final_url", "script_domain", "port_num"])
+        writer.writerows(rows)
+
+def corpus_rows(seed : int, count : int):
+    """
+    Rows drawn from a small pool of keys, so two corpora share some keys and every corpus repeats some.
+    """
+    generator = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        site = generator.randrange(seed * 15, seed * 15 + 40)
+        final_url = "" if site % 20 == 0 else f"https://site{site}.com/"
+        script_domain = generator.choice(["", "tracker.com", "cdn.net"])
+        port = generator.choice(["", "80", "8080", "8080.0", "443"])
+        rows.append([final_url, final_url, script_domain, port])
+    return rows
+
+def exact_key(row : dict, key_columns : list):
+    # Ports written as floats are the same port
+    return tuple(str(int(float(row[column]))) if column == "port_num" and row[column] else row[column] for column in key_columns)
+
+def read_rows(path : str):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+@pytest.mark.parametrize("key_columns", [KEY_COLUMNS, ["final_url"]])
+def test_hashed_keys_mark_same_rows_as_exact_sets(tmp_path, key_columns):
+    old_path, new_path, marked_path = str(tmp_path / "old.csv"), str(tmp_path / "new.csv"), str(tmp_path / "marked.csv")
+    write_results(old_path, corpus_rows(seed=1, count=300))
+    write_results(new_path, corpus_rows(seed=2, count=300))
+    old_keys = {exact_key(row, key_columns) for row in read_rows(old_path)}
+    new_keys = {exact_key(row, key_columns) for row in read_rows(new_path)}
+
+    old_index = CrawlIndex.build(old_path, key_columns, chunk_rows=64)
+    new_index = CrawlIndex.build(new_path, key_columns, chunk_rows=64)
+    assert (len(old_index), len(new_index)) == (len(old_keys), len(new_keys))
+    counts = {name: len(keys) for name, keys in diff(old_index, new_index).items()}
+    assert counts == {"added": len(new_keys - old_keys), "removed": len(old_keys - new_keys), "common": len(old_keys & new_keys)}
+
+    mark_rows(new_path, old_index, "in_old", marked_path, chunk_rows=64)
+    marked = read_rows(marked_path)
+    assert [row["in_old"] == "True" for row in marked] == [exact_key(row, key_columns) in old_keys for row in read_rows(new_path)]
+    assert 0 < sum(row["in_old"] == "True" for row in marked) < len(marked)
+
+def test_final_url_marks_match_isin(tmp_path):
+    # The comparison filter_by_consent.py made before the index
+    old_path, new_path, marked_path = str(tmp_path / "old.csv"), str(tmp_path / "new.csv"), str(tmp_path / "marked.csv")
+    write_results(old_path, corpus_rows(seed=3, count=200))
+    write_results(new_path, corpus_rows(seed=4, count=200))
+    mark_rows(new_path, CrawlIndex.build(old_path, ["final_url"]), "sends_before_consent", marked_path)
+    expected = pd.read_csv(new_path)["final_url"].isin(pd.read_csv(old_path)["final_url"])
+    assert pd.read_csv(marked_path)["sends_before_consent"].tolist() == expected.tolist()
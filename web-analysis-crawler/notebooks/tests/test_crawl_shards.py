@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+import crawl_shards
+from crawl_shards import (CrawlShard, ShardIndex, index_path_for, list_crawl_files, load_crawl, pack_folder, read_crawl_bytes,
+                          RECORD_SEPARATOR)
+from synthetic_corpus import generate_corpus
+
+@pytest.fixture(params=["gzip", "zstd"])
+def packed(request, tmp_path, monkeypatch):
+    if request.param == "zstd":
+        pytest.importorskip("zstandard")
+    monkeypatch.setattr(crawl_shards, "open_shards", {})
+    corpus = str(tmp_path / "corpus")
+    generate_corpus(corpus, 30, requests_per_file=5)
+    # Failed crawls leave empty files, they are copied as they are
+    open(os.path.join(corpus, "failed.json"), "w").close()
+    shard_folder = str(tmp_path / "shards")
+    shard_paths, copied = pack_folder(corpus, shard_folder, request.param, shard_bytes=8 * 2 ** 10, workers=2)
+    return corpus, shard_folder, shard_paths, copied
+
+def crawl_files(corpus : str):
+    """
+    The crawl files of a corpus that get packed, by name.
+    """
+    crawls = {}
+    for name in os.listdir(corpus):
+        if name != "metadata.json" and os.path.getsize(os.path.join(corpus, name)):
+            with open(os.path.join(corpus, name), encoding="utf-8") as f:
+                crawls[name] = json.load(f)
+    return crawls
+
+def test_packed_records_read_back(packed):
+    corpus, shard_folder, shard_paths, copied = packed
+    crawls = crawl_files(corpus)
+    assert len(shard_paths) > 1
+    assert sorted(copied) == ["failed.json", "metadata.json"]
+
+    names = []
+    for shard_path in shard_paths:
+        index = ShardIndex(index_path_for(shard_path))
+        shard = CrawlShard(shard_path)
+        for number in range(len(index)):
+            name = index.name(number)
+            names.append(name)
+            assert json.loads(shard.read(number)) == crawls[name]
+            assert number in index.find(crawls[name]["initialUrl"])
+            assert load_crawl(shard_path + RECORD_SEPARATOR + name) == crawls[name]
+        assert [(name, json.loads(content)) for name, content in shard] == [(index.name(number), crawls[index.name(number)]) for number in range(len(index))]
+        assert index.find("https://not-crawled.com/") == []
+    assert sorted(names) == sorted(crawls)
+
+    listed = [path for path, _key in list_crawl_files(shard_folder + "/")]
+    assert sorted(path.rsplit(RECORD_SEPARATOR, 1)[-1].rsplit("/", 1)[-1] for path in listed) == sorted(names + copied)
+    with pytest.raises(FileNotFoundError):
+        read_crawl_bytes(shard_paths[0] + RECORD_SEPARATOR + "missing.json")
+
+def test_truncated_last_frame(packed):
+    corpus, shard_folder, shard_paths, copied = packed
+    crawls = crawl_files(corpus)
+    shard_path = shard_paths[-1]
+    with open(shard_path, "r+b") as f:
+        f.truncate(os.path.getsize(shard_path) - 5)
+
+    shard = CrawlShard(shard_path)
+    last = len(shard.index) - 1
+    for number in range(last):
+        name = shard.index.name(number)
+        assert load_crawl(shard_path + RECORD_SEPARATOR + name) == crawls[name]
+    with pytest.raises(EOFError):
+        read_crawl_bytes(shard_path + RECORD_SEPARATOR + shard.index.name(last))
+    records = iter(shard)
+    for number in range(last):
+        assert next(records)[0] == shard.index.name(number)
+    with pytest.raises(EOFError):
+        next(records)
@@ -0,0 +1,89 @@
+import multiprocessing
+
+import pytest
+
+import dns_resolution
+import process_output
+from dns_resolution import DnsCache
+
+class Clock:
+    def __init__(self, now : float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dns_resolution.time, "time", clock)
+    return clock
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = DnsCache(str(tmp_path / "dns.sqlite"), ttl=100, negative_ttl=10)
+    cache.put("site.com", ["203.0.113.1"])
+    clock.now += 99
+    assert cache.get("site.com") == ["203.0.113.1"]
+    assert cache.get_many(["site.com", "other.com"]) == {"site.com": ["203.0.113.1"]}
+    clock.now += 2
+    assert cache.get("site.com") is None
+    assert cache.get_many(["site.com"]) == {}
+
+def test_failed_lookups_use_negative_ttl(tmp_path, clock):
+    cache = DnsCache(str(tmp_path / "dns.sqlite"), ttl=100, negative_ttl=10)
+    cache.put_many({"failed.com": [], "site.com": ["127.0.0.1"]})
+    clock.now += 9
+    assert cache.get("failed.com") == []
+    clock.now += 2
+    assert cache.get("failed.com") is None
+    assert cache.get("site.com") == ["127.0.0.1"]
+
+def test_entries_resolved_before_refresh_are_ignored(tmp_path, clock):
+    path = str(tmp_path / "dns.sqlite")
+    DnsCache(path).put("old.com", ["203.0.113.1"])
+    clock.now += 1
+    refreshed = DnsCache(path, refresh_before=clock.now)
+    assert refreshed.get("old.com") is None
+    refreshed.put("new.com", ["203.0.113.2"])
+    assert refreshed.get("new.com") == ["203.0.113.2"]
+
+def put_hostnames(path : str, prefix : str, count : int):
+    cache = DnsCache(path)
+    for number in range(count):
+        cache.put(f"{prefix}{number}.com", [f"203.0.113.{number % 256}"])
+    cache.close()
+
+def test_processes_write_at_once(tmp_path):
+    path = str(tmp_path / "dns.sqlite")
+    DnsCache(path).close()
+    processes = [multiprocessing.Process(target=put_hostnames, args=(path, prefix, 300)) for prefix in ("a", "b")]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    found = DnsCache(path).get_many([f"{prefix}{number}.com" for prefix in ("a", "b") for number in range(300)])
+    assert len(found) == 600
+
+def test_fallback_lookup_caches_failures_as_negative(tmp_path, monkeypatch):
+    monkeypatch.setattr(dns_resolution, "custom_resolver", lambda hostname: [])
+    monkeypatch.setattr(process_output, "dns_cache", DnsCache(str(tmp_path / "dns.sqlite"), ttl=100, negative_ttl=10))
+    process_output.resolves_to_localhost.cache_clear()
+    assert not process_output.resolves_to_localhost("failed.com")
+    addresses, ttl = process_output.dns_cache.connection.execute(
+        "SELECT addresses, ttl FROM dns_cache WHERE hostname = 'failed.com'").fetchone()
+    assert (addresses, ttl) == ("[]", 10)
+
+def test_batch_and_fallback_lookups_agree(monkeypatch):
+    # Resolves to ::1 only, an IPv4-only lookup would miss it
+    def getaddrinfo(hostname, port, *args, **kwargs):
+        if hostname == "v6.test":
+            return [(dns_resolution.socket.AF_INET6, dns_resolution.socket.SOCK_STREAM, 6, "", ("::1", 0, 0, 0))]
+        raise OSError("not found")
+    monkeypatch.setattr(dns_resolution.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(process_output, "dns_cache", None)
+    monkeypatch.setattr(process_output, "DNS_CACHE_PATH", None)
+    process_output.resolves_to_localhost.cache_clear()
+    assert dns_resolution.resolve_hostnames(["v6.test", "missing.test"]) == {"v6.test": ["::1"], "missing.test": []}
+    assert process_output.resolves_to_localhost("v6.test")
+    assert not process_output.resolves_to_localhost("missing.test")
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from hyperloglog import HyperLogLog, KeyedHyperLogLog, hash_values
+
+def values(start : int, stop : int):
+    return [f"https://site{number}.com/" for number in range(start, stop)]
+
+@pytest.mark.parametrize("precision", [10, 14])
+@pytest.mark.parametrize("cardinality", [10, 1_000, 50_000, 300_000])
+def test_estimate_within_error_bound(precision, cardinality):
+    sketch = HyperLogLog(precision)
+    sketch.add(values(0, cardinality))
+    # Adding the same values again changes nothing
+    sketch.add(values(0, cardinality // 2))
+    # Hashing is fixed, so the bound of 3 standard errors (99.7%) is deterministic here
+    assert abs(sketch.count() - cardinality) <= 3 * sketch.relative_error * cardinality
+
+def test_keyed_sketches_go_dense_past_threshold():
+    sketches = KeyedHyperLogLog(precision=10)
+    keys = np.array([0] * 50 + [1] * 50)
+    sketches.add_hashes(keys, hash_values(values(0, 50) + values(1000, 1050)))
+    sketches.compact()
+    assert list(sketches.dense_rows[:len(sketches)]) == [-1, -1]
+    # Key 1 now has more non-zero registers than m / 8 and gets a dense row, key 0 stays sparse
+    sketches.add_hashes(np.ones(5000, dtype=np.int64), hash_values(values(2000, 7000)))
+    sketches.compact()
+    assert sketches.dense_rows[0] == -1 and sketches.dense_rows[1] >= 0
+    assert len(sketches.dense) == 1
+
+    # The estimates do not depend on how the registers are stored
+    expected = []
+    for key_values in (values(0, 50), values(1000, 1050) + values(2000, 7000)):
+        sketch = HyperLogLog(precision=10)
+        sketch.add(key_values)
+        expected.append(sketch.count())
+    assert list(sketches.counts()) == expected
+
+def test_merge_estimates_exact_union():
+    first, second, union = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+    first.add(values(0, 30_000))
+    second.add(values(20_000, 60_000))
+    union.add(values(0, 60_000))
+    first.merge(second)
+    assert np.array_equal(first.registers, union.registers)
+    assert abs(first.count() - 60_000) <= 3 * first.relative_error * 60_000
+
+def test_keyed_merge_estimates_exact_union():
+    first, second = KeyedHyperLogLog(precision=10), KeyedHyperLogLog(precision=10)
+    first.add_hashes(np.array([0] * 3000 + [1] * 20), hash_values(values(0, 3000) + values(5000, 5020)))
+    second.add_hashes(np.array([0] * 20 + [1] * 3000), hash_values(values(6000, 6020) + values(1000, 4000)))
+    # Key 0 of the second maps to key 1 of the first and key 1 to a new key 2
+    first.merge(second, key_map=[1, 2])
+    counts = first.counts()
+    exact = [3000, len(set(values(5000, 5020) + values(6000, 6020))), 3000]
+    for count, cardinality in zip(counts, exact):
+        assert abs(count - cardinality) <= 3 * first.relative_error * cardinality
+
+def test_merge_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(12))
@@ -0,0 +1,23 @@
+import json
+
+import process_output
+
+def crawl_bytes(webRTC_call):
+    # Written like the crawler, JSON.stringify(data, null, 2)
+    data = {"initialUrl": "https://example.com/", "finalUrl": "https://example.com/",
+            "data": {"requests": [{"url": "https://example.com/app.js"}], "webRTC": [webRTC_call]}}
+    return json.dumps(data, indent=2).encode()
+
+def test_webrtc_call_without_localhost_is_skipped():
+    content = crawl_bytes({"type": "RTCPeerConnection", "localhost": "None"})
+    assert b'"localhost": "None"' in content
+    assert not process_output.may_have_results("file.json", content)
+
+def test_webrtc_call_with_localhost_is_kept():
+    for variant in ("127.0.0.1", "::1", "localhost", "0.0.0.0"):
+        content = crawl_bytes({"type": "ICECandidate", "localhost": variant, "candidate": f"candidate:1 1 udp 1 {variant} 9 typ host"})
+        assert process_output.may_have_results("file.json", content)
+
+def test_compact_json_is_filtered_the_same():
+    assert not process_output.may_have_results("file.json", b'{"webRTC":[{"localhost":"None"}]}')
+    assert process_output.may_have_results("file.json", b'{"webRTC":[{"localhost":"::1"}]}')
@@ -0,0 +1,73 @@
+import csv
+
+import pytest
+from tqdm import tqdm
+
+import add_ranking
+import ranking_index
+from ranking_index import RankingIndex, build_ranking_index, open_ranking
+from run_stats import RunStats
+
+RANKS = [
+    ("https://www.google.com", 1000),
+    ("https://youtube.com", 1000),
+    ("https://site.org", 5000),
+    ("http://shop.site.org", 10000),
+    ("https://www.other.co.uk", 10000),
+]
+
+def old_get_rank(ranking : dict, tested_url : str):
+    """
+    The lookup add_ranking.py did before the index: the exact origin of the tested url in a dict of the rank file.
+    """
+    if tested_url.endswith("/"):
+        tested_url = tested_url[:-1]
+    return ranking.get(tested_url, "?")
+
+@pytest.fixture
+def rank_file(tmp_path):
+    path = str(tmp_path / "rank.csv")
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["origin", "rank"])
+        writer.writerows(RANKS)
+    return path
+
+@pytest.fixture
+def opened_ranking(rank_file, monkeypatch):
+    monkeypatch.setattr(ranking_index, "ranking_index", None)
+    return open_ranking(rank_file)
+
+def test_get_rank_matches_dict_lookup(rank_file):
+    index = RankingIndex(build_ranking_index(rank_file))
+    ranking = {origin: str(rank) for origin, rank in RANKS}
+    urls = [origin + "/" for origin, rank in RANKS] + [origin for origin, rank in RANKS] + ["https://unranked.com/", "https://unranked.com"]
+    for url in urls:
+        assert index.get_rank(url) == old_get_rank(ranking, url)
+    assert index.get_rank("https://unranked.com/") == "?"
+
+def test_get_rank_falls_back_to_final_url(rank_file):
+    index = RankingIndex(build_ranking_index(rank_file))
+    assert index.get_rank("https://unranked.com/", "https://www.other.co.uk/home") == "10000"
+    assert index.get_rank("https://unranked.com/", "https://unranked.net/") == "?"
+    # The host of the final url comes before the registrable domain of the tested url
+    assert index.get_rank("https://blog.site.org/", "http://shop.site.org/") == "10000"
+    assert index.get_rank("https://blog.site.org/", "https://unranked.com/") == "5000"
+    assert index.get_rank("", "https://youtube.com/watch") == "1000"
+
+def test_rows_without_tested_url_are_counted(opened_ranking):
+    rows = [["https://site.org/", ""], ["", "https://youtube.com/"], ["", ""]]
+    stats = RunStats()
+    add_ranking.rank_rows([row + [""] for row in rows], 0, 1, 2, stats)
+    assert stats.counts["missing_tested_url"] == 2
+
+def test_rank_csv_pads_and_ranks(opened_ranking, tmp_path):
+    input_path, output_path = str(tmp_path / "input.csv"), str(tmp_path / "output.csv")
+    with open(input_path, "w", newline="", encoding="utf-8") as f:
+        f.write("tested_url,final_url,port_num\nhttps://site.org/,,80\nhttps://unranked.com/,https://youtube.com/,443\n,\n")
+    stats = RunStats()
+    with tqdm(disable=True) as progress:
+        assert add_ranking.rank_csv(input_path, output_path, progress, stats) == 3
+    with open(output_path, newline="", encoding="utf-8") as f:
+        assert [row["rank"] for row in csv.DictReader(f)] == ["5000", "1000", "?"]
+    assert stats.counts["missing_tested_url"] == 1
@@ -0,0 +1,71 @@
+import csv
+
+import pytest
+
+import process_output
+from process_output import ResultShards, ResultsWriter, RunCheckpoint, WorkerShards
+from processing_manifest import ProcessingManifest
+from results_io import CsvResultsWriter
+from run_stats import RunStats
+
+def shard_row(number : int):
+    return {"tested_url": f"https://site{number}.com/", "port_num": str(number)}
+
+def write_shards(folder : str, numbers_per_shard : list):
+    shards = ResultShards(folder)
+    for numbers in numbers_per_shard:
+        worker_shards = WorkerShards(folder)
+        worker_shards.add("requests_output", [shard_row(number) for number in numbers])
+        shards.commit(worker_shards.commit())
+        worker_shards.writers["requests_output"].close()
+    return shards
+
+def read_ports(path : str):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [int(row["port_num"]) for row in csv.DictReader(f)]
+
+class FailingWriter(CsvResultsWriter):
+    """
+    Stands for a run killed after a number of checkpoints, once the rows of the last one reached the file.
+    """
+    def __init__(self, path : str, checkpoints : int):
+        super().__init__(path, "w")
+        self.checkpoints = checkpoints
+
+    def checkpoint(self, force : bool = False):
+        super().checkpoint(force)
+        if self.checkpoints == 0:
+            raise KeyboardInterrupt
+        self.checkpoints -= 1
+        return True
+
+@pytest.mark.parametrize("sort_by", [None, "port_num"])
+def test_interrupted_merge_resumes_without_duplicates(tmp_path, monkeypatch, sort_by):
+    monkeypatch.setattr(process_output, "MERGE_RUN_ROWS", 2)
+    monkeypatch.setattr(process_output, "MERGE_SORT_BY", sort_by)
+    folder = str(tmp_path / "shards")
+    manifest_path = str(tmp_path / "manifest.csv")
+    output_paths = {"requests_output": str(tmp_path / "requests_output.csv"), "webRTC_output": str(tmp_path / "webRTC_output.csv")}
+    checkpoint = RunCheckpoint(str(tmp_path / "checkpoint.json"))
+    shards = write_shards(folder, [[5, 1, 3], [4, 2]])
+
+    # Killed on the checkpoint of the second merged batch: its rows are in the output but not in the checkpoint
+    writer = ResultsWriter(FailingWriter(output_paths["requests_output"], checkpoints=2), CsvResultsWriter(output_paths["webRTC_output"]),
+                           ProcessingManifest(manifest_path), {}, shards=shards, checkpoint=checkpoint)
+    with pytest.raises(KeyboardInterrupt):
+        writer.close()
+    writer.requests_output.close()
+
+    # The next run cuts the output back to the checkpoint and merges what is left of the shards
+    checkpoint = RunCheckpoint(checkpoint.path)
+    checkpoint.restore(manifest_path, output_paths)
+    writer = ResultsWriter(CsvResultsWriter(output_paths["requests_output"], "a"), CsvResultsWriter(output_paths["webRTC_output"], "a"),
+                           ProcessingManifest(manifest_path), {}, checkpoint=checkpoint)
+    writer.shards = ResultShards(folder, checkpoint.state["shards"])
+    assert len(writer.shards)
+    writer.merge_shards()
+    writer.close()
+
+    ports = read_ports(output_paths["requests_output"])
+    assert ports == ([1, 2, 3, 4, 5] if sort_by else [5, 1, 3, 4, 2])
+    assert checkpoint.state["shards"] is None
@@ -0,0 +1,61 @@
+import os
+
+import pandas as pd
+import pytest
+
+import results_io
+from results_io import RESULT_FIELDS, open_results_writer, read_results, iter_results
+
+def result_row(number : int):
+    return {"rank": str(number), "tested_url": f"https://site{number}.com/", "final_url": f"https://site{number}.com/",
+            "final_domain": f"site{number}.com", "protocol": "http", "search_type": "localhost", "port_num": str(8000 + number % 3),
+            "request_url": f"http://localhost:{8000 + number % 3}/", "script_domain": f"cdn{number % 2}.net",
+            "script_url": f"https://cdn{number % 2}.net/s.js"}
+
+def test_parquet_part_is_only_visible_once_closed(tmp_path):
+    pytest.importorskip("pyarrow")
+    writer = open_results_writer(str(tmp_path / "out"), "parquet")
+    writer.write_rows([result_row(number) for number in range(20_000)])
+    # A part with rows, not closed yet: a reader sees no part-*.parquet, only the hidden temporary file
+    visible = [name for name in os.listdir(writer.path) if not name.startswith(".")]
+    assert visible == []
+    # The run is killed here, the next writer drops the unfinished part
+    writer = open_results_writer(str(tmp_path / "out"), "parquet", "a")
+    assert os.listdir(writer.path) == []
+    writer.write_rows([result_row(1)])
+    writer.close()
+    assert len(read_results(writer.path)) == 1
+
+def test_parquet_checkpoint_closes_old_parts(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    writer = open_results_writer(str(tmp_path / "out"), "parquet")
+    writer.write_rows([result_row(1)])
+    assert not writer.checkpoint()
+    monkeypatch.setattr(results_io, "PARQUET_PART_SECONDS", 0)
+    assert writer.checkpoint()
+    assert len(read_results(writer.path)) == 1
+    writer.close()
+
+def test_normalized_round_trip(tmp_path):
+    # Rows repeat pages, scripts and candidates, within a run and across the appending run
+    first_rows = [result_row(number % 4) for number in range(10)]
+    second_rows = [result_row(number % 6) for number in range(8)]
+    writer = open_results_writer(str(tmp_path / "out"), "normalized")
+    writer.write_rows(first_rows)
+    writer.close()
+    writer = open_results_writer(str(tmp_path / "out"), "normalized", "a")
+    writer.write_rows(second_rows)
+    writer.close()
+
+    for name, rows in (("pages", range(6)), ("scripts", range(2)), ("candidates", range(3))):
+        dimension = pd.read_csv(os.path.join(writer.path, name + ".csv"), dtype=str)
+        assert len(dimension) == len(rows)
+        assert dimension.iloc[:, 0].is_unique
+
+    expected = first_rows + second_rows
+    df = read_results(writer.path).astype(str)
+    assert list(df.columns) == RESULT_FIELDS
+    assert df.to_dict("records") == expected
+    chunks = list(iter_results(writer.path, chunk_rows=5, dtype=str))
+    assert len(chunks) == 4
+    assert pd.concat(chunks).to_dict("records") == expected
@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from results_io import read_results, results_path
+from synthetic_corpus import generate_corpus
+
+NOTEBOOKS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs process_output.main() on a corpus in its own process, killed with os._exit after kill_after files if it is not 0:
+# the output buffers are written out first, a CSV output with half a line more and a Parquet output with one more part
+RUN_SCRIPT = """
+import os
+import sys
+
+import dns_resolution
+import process_output
+import results_io
+from synthetic_corpus import FakeDns
+
+corpus, results_folder, output_format, worker_shards, resume, kill_after = sys.argv[1:]
+process_output.location = "test"
+process_output.version = ""
+process_output.input_folder = corpus + "/"
+process_output.results_folder = results_folder + "/"
+process_output.rank_file_path = corpus + ".rank.csv"
+process_output.DNS_CACHE_PATH = None
+process_output.MAX_WORKERS = 2
+process_output.FILES_PER_TASK = 4
+process_output.MANIFEST_FLUSH_INTERVAL = 10
+process_output.OUTPUT_FORMAT = output_format
+process_output.WORKER_SHARDS = worker_shards == "1"
+process_output.RESUME = resume == "1"
+process_output.RUN_REPORT = False
+results_io.PARQUET_PART_ROWS = 3
+dns_resolution.custom_resolver = FakeDns()
+
+write_results = process_output.ResultsWriter.write_results
+
+def write_results_and_die(self, *args):
+    write_results(self, *args)
+    if self.processed_count == int(kill_after):
+        for output in self.outputs().values():
+            if output_format == "csv":
+                output.file.write("0,https://half")
+                output.file.flush()
+            else:
+                output.checkpoint(force=True)
+        os._exit(9)
+
+process_output.ResultsWriter.write_results = write_results_and_die
+process_output.main()
+"""
+
+def run(corpus : str, results_folder : str, output_format : str, worker_shards : bool, resume : bool, kill_after : int = 0):
+    os.makedirs(results_folder, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=NOTEBOOKS_FOLDER)
+    arguments = [corpus, results_folder, output_format, str(int(worker_shards)), str(int(resume)), str(kill_after)]
+    return subprocess.run([sys.executable, "-c", RUN_SCRIPT] + arguments, cwd=results_folder, env=env, capture_output=True, text=True, timeout=120)
+
+def read_rows(results_folder : str, output : str, output_format : str):
+    df = read_results(results_path(os.path.join(results_folder, output + "_test"), output_format))
+    return df.astype(object).where(df.notna(), "").astype(str).values.tolist()
+
+@pytest.mark.parametrize("output_format, worker_shards", [("csv", False), ("parquet", False), ("csv", True)])
+def test_killed_run_resumes_without_duplicate_or_partial_rows(tmp_path, output_format, worker_shards):
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+    corpus = str(tmp_path / "corpus")
+    generate_corpus(corpus, 120, corpus + ".rank.csv", localhost_rate=0.05, webrtc_localhost_rate=0.8)
+
+    assert run(corpus, str(tmp_path / "clean"), output_format, worker_shards, resume=False).returncode == 0
+    killed = run(corpus, str(tmp_path / "resumed"), output_format, worker_shards, resume=False, kill_after=37)
+    assert killed.returncode == 9
+    resumed = run(corpus, str(tmp_path / "resumed"), output_format, worker_shards, resume=True)
+    assert resumed.returncode == 0, resumed.stderr
+
+    for output in ("requests_output", "webRTC_output"):
+        expected = read_rows(str(tmp_path / "clean"), output, output_format)
+        assert expected
+        assert sorted(read_rows(str(tmp_path / "resumed"), output, output_format)) == sorted(expected)
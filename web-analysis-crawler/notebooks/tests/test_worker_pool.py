@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import worker_pool
+from worker_pool import WatchdogPool
+
+def run_item(item):
+    if item == "slow":
+        time.sleep(60)
+    if item == "die":
+        os._exit(3)
+    return item, os.getpid()
+
+def exit_once(marker_path : str):
+    """
+    A report that kills the worker after its first chunk, once per marker file.
+    """
+    if not os.path.exists(marker_path):
+        open(marker_path, "w").close()
+        os._exit(4)
+
+def fail_initializer():
+    raise SystemExit(5)
+
+def run_pool(pool : WatchdogPool, chunks : list):
+    events = {}
+    for kind, item, result, error in pool.run(chunks):
+        events.setdefault(kind, []).append((item, result, error))
+    return events
+
+@pytest.fixture(autouse=True)
+def fast_watchdog(monkeypatch):
+    monkeypatch.setattr(worker_pool, "WATCHDOG_INTERVAL", 0.05)
+
+def test_timed_out_item_is_killed_and_rest_of_chunk_requeued():
+    pool = WatchdogPool(run_item, max_workers=1, timeout=0.5)
+    events = run_pool(pool, [[1, "slow", 3]])
+    assert events["timeout"] == [("slow", None, None)]
+    assert sorted(item for item, result, error in events["result"]) == [1, 3]
+    assert pool.killed_count == 1
+
+def test_item_killing_its_worker_is_reported_and_rest_of_chunk_requeued():
+    pool = WatchdogPool(run_item, max_workers=2, timeout=30)
+    events = run_pool(pool, [[1, "die", 3], [4]])
+    assert events["died"] == [("die", None, 3)]
+    assert sorted(item for item, result, error in events["result"]) == [1, 3, 4]
+    assert pool.killed_count == 1
+
+def test_worker_dying_between_items_requeues_whole_chunk(tmp_path):
+    marker_path = str(tmp_path / "exited")
+    pool = WatchdogPool(run_item, max_workers=1, timeout=30, report=lambda: exit_once(marker_path))
+    events = run_pool(pool, [[1, 2, 3]])
+    assert "died" not in events
+    assert sorted(item for item, result, error in events["result"]) == [1, 2, 3]
+    assert pool.killed_count == 1
+
+def test_failing_initializer_raises():
+    pool = WatchdogPool(run_item, max_workers=1, timeout=30, initializer=fail_initializer)
+    with pytest.raises(RuntimeError):
+        run_pool(pool, [[1]])
+
+def test_workers_are_recycled_after_max_tasks():
+    pool = WatchdogPool(run_item, max_workers=1, timeout=30, max_tasks_per_worker=2)
+    events = run_pool(pool, [[number] for number in range(5)])
+    pids = [pid for item, (number, pid), error in events["result"]]
+    assert [item for item, result, error in events["result"]] == list(range(5))
+    assert len(set(pids)) == 3
+    assert pids[0] == pids[1] and pids[2] == pids[3] and pids[1] != pids[2]
+    assert pool.recycled_count == 2
+
+# Kills the main process with the first result, after printing the pid of the worker it came from
+KILLED_MAIN_SCRIPT = """
+import os
+import sys
+
+sys.path.insert(0, sys.argv[1])
+from tests.test_worker_pool import run_item
+from worker_pool import WatchdogPool
+
+for kind, item, (number, pid), error in WatchdogPool(run_item, max_workers=3, timeout=30).run([[1], [2], [3]]):
+    print(pid, flush=True)
+    os._exit(9)
+"""
+
+def test_workers_stop_when_main_process_dies():
+    notebooks_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    killed = subprocess.run([sys.executable, "-c", KILLED_MAIN_SCRIPT, notebooks_folder], capture_output=True, text=True, timeout=30)
+    assert killed.returncode == 9
+    pid = int(killed.stdout)
+    deadline = time.monotonic() + 10
+    while os.path.exists(f"/proc/{pid}") and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not os.path.exists(f"/proc/{pid}")
@@ -0,0 +1,96 @@
+import re
+from functools import lru_cache
+from urllib.parse import urlparse
+
+from tld import get_fld
+
+LOCALHOST_VARIANTS = frozenset({"127.0.0.1", "::1", "localhost", "0.0.0.0"})
+
+# Scheme, host and port of a URL, split the way urlparse splits them for plain ASCII URLs
+URL_PATTERN = re.compile(r'(?:([A-Za-z][A-Za-z0-9+\-.]*):)?(?://(?:[^/?#]*@)?([^:/?#]*)(?::([^/?#]*))?)?')
+# URLs urlparse treats specially (IPv6 brackets, stripped whitespace), these go through urlparse itself
+SPECIAL_URL_PATTERN = re.compile(r'[\[\]\t\r\n]|^[\x00-\x20]')
+
+@lru_cache(maxsize=100_000)
+def safe_get_fld(url):
+    """
+    Get domain with cache.
+    """
+    try:
+        return get_fld(url, fail_silently=True)
+    except Exception:
+        return None
+
+def split_url(url : str):
+    """
+    Get the scheme, hostname and port of a url, with the same results (and errors) as urlparse().
+    Returns scheme, hostname (None if there is none) and port (None if there is none).
+    """
+    if not url.isascii() or SPECIAL_URL_PATTERN.search(url):
+        parsed = urlparse(url)
+        return parsed.scheme, parsed.hostname, parsed.port
+
+    match = URL_PATTERN.match(url)
+    scheme = (match.group(1) or "").lower()
+    hostname = match.group(2) or None
+    if hostname is not None:
+        # Like urlparse, an IPv6 zone after % keeps its case
+        address, percent, zone = hostname.partition("%")
+        hostname = address.lower() + percent + zone
+
+    port = match.group(3)
+    if not port:
+        return scheme, hostname, None
+    if not port.isdigit():
+        raise ValueError(f"Port could not be cast to integer value as {port!r}")
+    port = int(port)
+    if not 0 <= port <= 65535:
+        raise ValueError("Port out of range 0-65535")
+    return scheme, hostname, port
+
+def classify_url(url : str):
+    """
+    Check if a url could be a request to a localhost port.
+    Returns None if it cannot, otherwise hostname, port and whether the hostname is a localhost variant.
+    Localhost variants without an explicit port get the default port (80 for HTTP, 443 otherwise),
+    other hostnames are only returned if the url has an explicit port, they still have to be resolved.
+    """
+    scheme, hostname, port = split_url(url)
+    if hostname in LOCALHOST_VARIANTS:
+        return hostname, port if port else (80 if scheme == "http" else 443), True
+    if hostname is None or not port:
+        return None
+    return hostname, port, False
+
+def classify_requests(request_data : list):
+    """
+    Classify all requests of a page in one pass.
+    Returns a list of (request, url, hostname, port, is_localhost) for the requests that could go to localhost.
+    """
+    candidates = []
+    for request in request_data:
+        url = request.get("url", "")
+        classified = classify_url(url)
+        if classified is not None:
+            candidates.append((request, url) + classified)
+    return candidates
+
+@lru_cache(maxsize=100_000)
+def page_domain(url : str):
+    """
+    Get the domain of a page url, memoized since every result of a page needs it.
+    Fails like the analysis always did if the url has no hostname.
+    """
+    scheme, hostname, _port = split_url(url)
+    return safe_get_fld(scheme + "://" + hostname)
+
+@lru_cache(maxsize=100_000)
+def initiator_domain(url : str):
+    """
+    Get the domain of an initiating script url, memoized since the same scripts initiate many requests.
+    Returns "" if the url has no hostname.
+    """
+    scheme, hostname, _port = split_url(url)
+    if hostname:
+        return safe_get_fld(scheme + "://" + hostname)
+    return ""
@@ -0,0 +1,38 @@
+import re
+from functools import lru_cache
+
+# One pass over an ICE candidate or SDP blob, every match is one of:
+CANDIDATE_TOKEN_PATTERN = re.compile(
+    # an ICE candidate, alone or as an a=candidate line of an SDP (foundation, component, transport, priority,
+    # connection address and port): the address can be IPv4, IPv6 or an mDNS .local name
+    r"candidate:\S+[ \t]+\d+[ \t]+\S+[ \t]+\d+[ \t]+(?P<address>\S+)[ \t]+(?P<port>\d+)"
+    # the SCTP port of a data channel
+    r"|a=sctp-port:(?P<sctp_port>\d+)"
+    # any other IPv4 address followed by a number, where the ports were always looked for
+    r"|(?P<ipv4>\d+\.\d+\.\d+\.\d+)\s+(?P<ipv4_port>\d+)"
+)
+# Candidates and SDPs are repeated across the calls of a page and across pages (e.g. the same SDK offer)
+CANDIDATE_CACHE_SIZE = 4096
+
+def tokenize_candidates(text : str):
+    """
+    Find the endpoints in an ICE candidate or SDP blob in one pass.
+    Yields (kind, address, port) with kind "candidate" for the connection address and port of a candidate,
+    "sctp-port" (address None) for an SCTP port and "address" for another IPv4 address followed by a number.
+    """
+    for match in CANDIDATE_TOKEN_PATTERN.finditer(text):
+        if match.group("port") is not None:
+            yield "candidate", match.group("address"), match.group("port")
+        elif match.group("sctp_port") is not None:
+            yield "sctp-port", None, match.group("sctp_port")
+        else:
+            yield "address", match.group("ipv4"), match.group("ipv4_port")
+
+@lru_cache(maxsize=CANDIDATE_CACHE_SIZE)
+def candidate_ports(text : str):
+    """
+    Get the distinct ports of an ICE candidate or SDP blob, in the order they appear, memoized.
+    Returns a tuple of port strings, ("N/A",) if none are found.
+    """
+    ports = tuple(dict.fromkeys(port for _kind, _address, port in tokenize_candidates(text)))
+    return ports if ports else ("N/A",)
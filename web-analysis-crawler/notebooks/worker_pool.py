@@ -0,0 +1,214 @@
+import multiprocessing
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+WATCHDOG_INTERVAL = 1
+RETIRE_JOIN_SECONDS = 5
+
+def worker_loop(conn, current_index, current_started, func, initializer, initargs, report):
+    """
+    Run func on every item of the chunks received on conn and send back the list of
+    (item, result, error) per chunk, with the seconds the worker waited for and worked on the chunk
+    and the result of report() if given. A chunk of None stops the worker.
+    Before each item its index in the chunk and its start time are published for the watchdog.
+    The worker also stops if the main process dies, the other workers may keep its end of conn open.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    parent = multiprocessing.parent_process()
+
+    while True:
+        waiting = time.perf_counter()
+        if parent is not None and conn not in wait([conn, parent.sentinel]):
+            return
+        try:
+            chunk = conn.recv()
+        except EOFError:
+            return
+        if chunk is None:
+            return
+
+        started = time.perf_counter()
+        results = []
+        for index, item in enumerate(chunk):
+            current_started.value = time.monotonic()
+            current_index.value = index
+            try:
+                results.append((item, func(item), None))
+            except Exception as e:
+                results.append((item, None, str(e)))
+        current_index.value = -1
+        conn.send((results, started - waiting, time.perf_counter() - started, report() if report is not None else None))
+
+class Worker:
+    """
+    A worker process of the WatchdogPool with the chunk it is working on.
+    """
+    def __init__(self, context, func, initializer, initargs, report):
+        self.conn, child_conn = context.Pipe()
+        # No locks, the watchdog may kill the worker at any moment
+        self.current_index = context.Value("i", -1, lock=False)
+        self.current_started = context.Value("d", 0.0, lock=False)
+        self.process = context.Process(
+            target=worker_loop,
+            args=(child_conn, self.current_index, self.current_started, func, initializer, initargs, report),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.chunk = None
+        self.tasks_done = 0
+
+    def assign(self, chunk : list):
+        self.chunk = chunk
+        try:
+            self.conn.send(chunk)
+        except OSError:
+            # The worker is dead already, the watchdog hands the chunk out again
+            pass
+
+    def running_item(self, timeout : float):
+        """
+        Get the index of the item the worker has been running for more than timeout seconds.
+        Returns None if the worker is not over its budget.
+        """
+        index = self.current_index.value
+        if index < 0 or time.monotonic() - self.current_started.value <= timeout:
+            return None
+        return index
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(RETIRE_JOIN_SECONDS)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class WatchdogPool:
+    """
+    Process pool that enforces a wall-clock budget per item.
+    Work is handed out in chunks, one chunk per idle worker, so only max_workers chunks are in flight.
+    A worker that runs longer than timeout seconds on a single item is killed and replaced, the item is
+    reported as timed out and the rest of its chunk is handed out again. A worker that dies is handled the same way.
+    Workers are recycled after max_tasks_per_worker chunks, to cap the growth of per-process caches.
+    If given, report is called in the worker after every chunk and its result is passed to on_report in the main process,
+    e.g. to collect the workers' stats. What a killed worker collected since its last chunk is lost.
+    """
+    def __init__(self, func, max_workers : int, timeout : float, max_tasks_per_worker : int = None, initializer=None, initargs=(),
+                 report=None, on_report=None):
+        self.func = func
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.initializer = initializer
+        self.initargs = initargs
+        self.report = report
+        self.on_report = on_report
+        self.context = multiprocessing.get_context()
+        self.workers = []
+        self.killed_count = 0
+        self.recycled_count = 0
+        self.chunks_done = 0
+        # Seconds the workers spent waiting for chunks and working on them, over the finished chunks
+        self.idle_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    def start_worker(self):
+        return Worker(self.context, self.func, self.initializer, self.initargs, self.report)
+
+    def replace(self, worker : Worker):
+        self.workers[self.workers.index(worker)] = self.start_worker()
+
+    def run(self, chunks):
+        """
+        Run func on every item of the chunks.
+        Yields ("result", item, result, error) for every finished item, error is None if func succeeded,
+        ("timeout", item, None, None) for an item that exceeded the budget
+        and ("died", item, None, exit code) for an item during which the worker died.
+        A worker that dies between items has its whole chunk handed out again.
+        """
+        chunks = iter(chunks)
+        requeued = deque()
+        self.workers = [self.start_worker() for _ in range(self.max_workers)]
+        try:
+            while True:
+                for worker in self.workers:
+                    if worker.chunk is not None:
+                        continue
+                    chunk = requeued.popleft() if requeued else next(chunks, None)
+                    if chunk is None:
+                        break
+                    worker.assign(chunk)
+
+                busy = [worker for worker in self.workers if worker.chunk is not None]
+                if not busy:
+                    return
+
+                ready = wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy], WATCHDOG_INTERVAL)
+                for worker in busy:
+                    if worker.conn in ready:
+                        try:
+                            message = worker.conn.recv()
+                        except (EOFError, OSError):
+                            message = None
+                        if message is not None:
+                            results, idle_seconds, busy_seconds, report = message
+                            self.idle_seconds += idle_seconds
+                            self.busy_seconds += busy_seconds
+                            if self.on_report is not None and report is not None:
+                                self.on_report(report)
+                            worker.chunk = None
+                            worker.tasks_done += 1
+                            self.chunks_done += 1
+                            for item, result, error in results:
+                                yield "result", item, result, error
+                            if self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker:
+                                worker.stop()
+                                self.replace(worker)
+                                self.recycled_count += 1
+                            continue
+
+                    if not worker.process.is_alive():
+                        index = worker.current_index.value
+                        chunk = worker.chunk
+                        worker.kill()
+                        if index < 0 and worker.current_started.value == 0 and self.chunks_done == 0:
+                            # Requeueing would only kill the next worker the same way, e.g. a failing initializer
+                            raise RuntimeError(f"Worker died before running any item, exit code {worker.process.exitcode}")
+                        self.replace(worker)
+                        self.killed_count += 1
+                        if index < 0:
+                            # Died between items (e.g. sending the results), none of them is to blame
+                            requeued.append(chunk)
+                            continue
+                        yield "died", chunk[index], None, worker.process.exitcode
+                        if len(chunk) > 1:
+                            requeued.append(chunk[:index] + chunk[index + 1:])
+                        continue
+
+                    index = worker.running_item(self.timeout)
+                    if index is not None:
+                        chunk = worker.chunk
+                        worker.kill()
+                        self.replace(worker)
+                        self.killed_count += 1
+                        yield "timeout", chunk[index], None, None
+                        if len(chunk) > 1:
+                            requeued.append(chunk[:index] + chunk[index + 1:])
+        finally:
+            for worker in self.workers:
+                if worker.chunk is None:
+                    worker.stop()
+                else:
+                    worker.kill()
+            self.workers = []